@@ -5,9 +5,17 @@ See LICENSE for details
 
 """
 
-from astacus.common.storage import HexDigestStorage, JsonStorage
+from astacus.common.exceptions import NotFoundException
+from astacus.common.limiter import RateLimiter
+from astacus.common.storage import HexDigestStorage, JsonStorage, Storage, ThreadLocalStorage
+from collections.abc import Awaitable, Callable, Sequence
 from starlette.concurrency import run_in_threadpool
 
+import asyncio
+
+# Native multi-object deletes are sent in batches of at most this many keys
+DELETE_BATCH_SIZE = 1000
+
 
 class AsyncHexDigestStorage:
     """Subset of the HexDigestStorage API proxied async -> sync via starlette threadpool
@@ -18,12 +26,50 @@ class AsyncHexDigestStorage:
 
     """
 
-    def __init__(self, storage: HexDigestStorage) -> None:
+    def __init__(
+        self, storage: HexDigestStorage, *, delete_parallel: int = 1, delete_rate_limit: float | None = None
+    ) -> None:
         self.storage = storage
+        # Used by delete_hexdigests if the storage has no bulk delete
+        self.delete_parallel = delete_parallel
+        self.delete_rate_limit = delete_rate_limit
 
     async def delete_hexdigest(self, hexdigest: str) -> None:
         return await run_in_threadpool(self.storage.delete_hexdigest, hexdigest)
 
+    async def delete_hexdigests(
+        self, hexdigests: Sequence[str], *, progress_callback: Callable[[int], None] | None = None
+    ) -> None:
+        """Delete the hexdigests, ignoring the ones that do not exist.
+
+        progress_callback is called with the number of hexdigests deleted so far.
+        """
+        if self.storage.supports_bulk_delete:
+            await delete_in_batches(
+                hexdigests,
+                delete_batch=lambda batch: run_in_threadpool(self.storage.delete_hexdigests, batch),
+                rate_limit=self.delete_rate_limit,
+                progress_callback=progress_callback,
+            )
+            return
+        # Separate threads must not share a (non thread-safe) storage object
+        storage = self.storage
+        thread_local = ThreadLocalStorage(storage=storage) if isinstance(storage, Storage) else None
+
+        def _delete(hexdigest: str) -> None:
+            try:
+                (thread_local.local_storage if thread_local is not None else storage).delete_hexdigest(hexdigest)
+            except NotFoundException:
+                pass
+
+        await delete_concurrently(
+            hexdigests,
+            delete_one=lambda hexdigest: run_in_threadpool(_delete, hexdigest),
+            parallel=self.delete_parallel,
+            rate_limit=self.delete_rate_limit,
+            progress_callback=progress_callback,
+        )
+
     async def list_hexdigests(self) -> list[str]:
         return await run_in_threadpool(self.storage.list_hexdigests)
 
@@ -48,3 +94,47 @@ class AsyncJsonStorage:
 
     async def upload_json_bytes(self, name: str, data: bytes) -> bool:
         return await run_in_threadpool(self.storage.upload_json_bytes, name, data)
+
+
+async def delete_in_batches(
+    keys: Sequence[str],
+    *,
+    delete_batch: Callable[[Sequence[str]], Awaitable[None]],
+    rate_limit: float | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+) -> None:
+    """Delete keys with a native multi-object delete, one batch (= request) at a time."""
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        if rate_limiter is not None:
+            await rate_limiter.wait()
+        batch = keys[start : start + DELETE_BATCH_SIZE]
+        await delete_batch(batch)
+        if progress_callback is not None:
+            progress_callback(start + len(batch))
+
+
+async def delete_concurrently(
+    keys: Sequence[str],
+    *,
+    delete_one: Callable[[str], Awaitable[None]],
+    parallel: int,
+    rate_limit: float | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+) -> None:
+    """Delete keys one by one, with at most parallel deletes in flight and at most rate_limit started per second."""
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    remaining_keys = iter(keys)
+    deleted = 0
+
+    async def _worker() -> None:
+        nonlocal deleted
+        for key in remaining_keys:
+            if rate_limiter is not None:
+                await rate_limiter.wait()
+            await delete_one(key)
+            deleted += 1
+            if progress_callback is not None:
+                progress_callback(deleted)
+
+    await asyncio.gather(*(_worker() for _ in range(min(parallel, len(keys)))))
@@ -20,13 +20,20 @@ the list/download are returned mostly from the cache_storage. The
 assumption is that backups are immutable, that is, if file backup-X
 exists, its contents stay the same.
 
+Decoded jsons of immutable (frozen) struct types, such as the minimal
+backup manifests, are also kept in memory for the lifetime of the object,
+which is a single operation in the coordinator, so steps reading them do
+not decode them again. Other decoded jsons can be large and are mutated
+by their users, they are decoded for each caller.
+
 """
 from .exceptions import NotFoundException
-from .storage import JsonStorage, MultiStorage
+from .storage import JsonStorage, MultiStorage, ST
 from collections.abc import Iterator
 
 import contextlib
 import mmap
+import msgspec
 
 
 class CachingJsonStorage(JsonStorage):
@@ -36,6 +43,7 @@ class CachingJsonStorage(JsonStorage):
     def __init__(self, *, backend_storage: JsonStorage, cache_storage: JsonStorage) -> None:
         self.backend_storage = backend_storage
         self.cache_storage = cache_storage
+        self._decoded_cache: dict[tuple[str, type[msgspec.Struct]], msgspec.Struct] = {}
 
     @property
     def _backend_json_set(self) -> set[str]:
@@ -51,6 +59,10 @@ class CachingJsonStorage(JsonStorage):
         self._backend_json_set.remove(x)
         self._backend_json_list = None
 
+    def _decoded_cache_remove(self, name: str) -> None:
+        for key in [key for key in self._decoded_cache if key[0] == name]:
+            self._decoded_cache.pop(key, None)
+
     def delete_json(self, name: str) -> None:
         if name not in self._backend_json_set:
             raise NotFoundException()
@@ -58,6 +70,7 @@ class CachingJsonStorage(JsonStorage):
             self.cache_storage.delete_json(name)
         except NotFoundException:
             pass
+        self._decoded_cache_remove(name)
         self.backend_storage.delete_json(name)
         self._backend_json_set_remove(name)
 
@@ -74,12 +87,23 @@ class CachingJsonStorage(JsonStorage):
             with self.cache_storage.open_json_bytes(name) as json_bytes:
                 yield json_bytes
 
+    def download_json(self, name: str, struct_type: type[ST]) -> ST:
+        if not struct_type.__struct_config__.frozen:
+            return super().download_json(name, struct_type)
+        decoded = self._decoded_cache.get((name, struct_type))
+        if decoded is None:
+            decoded = super().download_json(name, struct_type)
+            self._decoded_cache[(name, struct_type)] = decoded
+        assert isinstance(decoded, struct_type)
+        return decoded
+
     def list_jsons(self) -> list[str]:
         if self._backend_json_list is None:
             self._backend_json_list = sorted(self._backend_json_set)
         return self._backend_json_list
 
     def upload_json_bytes(self, name: str, data: bytes | mmap.mmap) -> bool:
+        self._decoded_cache_remove(name)
         self.cache_storage.upload_json_bytes(name, data)
         self.backend_storage.upload_json_bytes(name, data)
         self._backend_json_set_add(name)
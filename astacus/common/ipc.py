@@ -37,6 +37,14 @@ class NodeFeatures(Enum):
     snapshot_groups = "snapshot_groups"
     # Added on 2023-10-16
     release_snapshot_files = "release_snapshot_files"
+    # Added on 2026-10-18
+    chunked_files = "chunked_files"
+    # Added on 2026-10-18
+    snapshot_state_columns = "snapshot_state_columns"
+    # Added on 2026-10-18
+    paged_snapshot_results = "paged_snapshot_results"
+    # Added on 2026-10-18
+    upload_checkpoints = "upload_checkpoints"
 
 
 class Retention(msgspec.Struct, kw_only=True):
@@ -79,6 +87,10 @@ class SnapshotFile(msgspec.Struct, kw_only=True, omit_defaults=True):
     mtime_ns: int
     hexdigest: str = ""
     content_b64: str | None = None
+    # Consecutive chunks of a large file, if it was snapshotted in chunks.
+    # hexdigest is still the digest of the whole file, but only the chunks
+    # are stored in the object storage.
+    chunks: Sequence["SnapshotHash"] = ()
 
     def __lt__(self, o: "SnapshotFile") -> bool:
         # In our use case, paths uniquely identify files we care about
@@ -98,6 +110,14 @@ class SnapshotFile(msgspec.Struct, kw_only=True, omit_defaults=True):
     def open_for_reading(self, root_path: Path) -> SizeLimitedFile:
         return SizeLimitedFile(path=root_path / self.relative_path, file_size=self.file_size)
 
+    def stored_hashes(self) -> Sequence["SnapshotHash"]:
+        """Return the objects that need to be in the object storage to restore the file."""
+        if self.chunks:
+            return self.chunks
+        if self.hexdigest:
+            return [SnapshotHash(hexdigest=self.hexdigest, size=self.file_size)]
+        return []
+
 
 class SnapshotState(msgspec.Struct, kw_only=True, omit_defaults=True):
     root_globs: Sequence[str] = msgspec.field(default_factory=list)
@@ -115,6 +135,8 @@ class SnapshotRequestGroup(msgspec.Struct, kw_only=True):
     excluded_names: Sequence[str] = ()
     # None means "no limit": all files matching the glob will be embedded
     embedded_file_size_max: int | None = DEFAULT_EMBEDDED_FILE_SIZE
+    # If set, files larger than this are snapshotted in chunks of this size
+    chunk_size: int | None = None
 
 
 class SnapshotRequestV2(NodeRequest):
@@ -128,12 +150,15 @@ def create_snapshot_request(
     snapshot_groups: Sequence[SnapshotGroup], *, node_features: Set[str]
 ) -> SnapshotRequestV2 | SnapshotRequest:
     if NodeFeatures.snapshot_groups.value in node_features:
+        # Older nodes would not know what to do with the chunks, so they store files whole
+        chunked_files = NodeFeatures.chunked_files.value in node_features
         return SnapshotRequestV2(
             groups=[
                 SnapshotRequestGroup(
                     root_glob=group.root_glob,
                     excluded_names=group.excluded_names,
                     embedded_file_size_max=group.embedded_file_size_max,
+                    chunk_size=group.chunk_size if chunked_files else None,
                 )
                 for group in snapshot_groups
             ],
@@ -163,6 +188,75 @@ class SnapshotHash(msgspec.Struct, kw_only=True, frozen=True):
         return hash(self.hexdigest)
 
 
+class SnapshotStateColumns(msgspec.Struct, kw_only=True, omit_defaults=True):
+    """
+    Column oriented encoding of a SnapshotState, for backup manifests.
+
+    Each directory is stored once and each attribute of the files has its own array,
+    so readers can decode only the arrays they need and skip the others.
+    """
+
+    version: int = 1
+    root_globs: Sequence[str] = ()
+    # Distinct directories of the files, including the trailing slash
+    directories: Sequence[str] = ()
+    # For each file, the index of its directory and its name within the directory
+    directory_indexes: Sequence[int] = ()
+    names: Sequence[str] = ()
+    file_sizes: Sequence[int] = ()
+    mtimes_ns: Sequence[int] = ()
+    hexdigests: Sequence[str] = ()
+    # Sparse columns, by file index
+    contents_b64: dict[int, str] = msgspec.field(default_factory=dict)
+    chunks: dict[int, Sequence[SnapshotHash]] = msgspec.field(default_factory=dict)
+
+    @classmethod
+    def from_state(cls, state: SnapshotState) -> Self:
+        directories: dict[str, int] = {}
+        directory_indexes: list[int] = []
+        names: list[str] = []
+        contents_b64: dict[int, str] = {}
+        chunks: dict[int, Sequence[SnapshotHash]] = {}
+        for i, snapshotfile in enumerate(state.files):
+            name_start = snapshotfile.relative_path.rfind("/") + 1
+            directory = snapshotfile.relative_path[:name_start]
+            directory_indexes.append(directories.setdefault(directory, len(directories)))
+            names.append(snapshotfile.relative_path[name_start:])
+            if snapshotfile.content_b64 is not None:
+                contents_b64[i] = snapshotfile.content_b64
+            if snapshotfile.chunks:
+                chunks[i] = snapshotfile.chunks
+        return cls(
+            root_globs=state.root_globs,
+            directories=list(directories),
+            directory_indexes=directory_indexes,
+            names=names,
+            file_sizes=[snapshotfile.file_size for snapshotfile in state.files],
+            mtimes_ns=[snapshotfile.mtime_ns for snapshotfile in state.files],
+            hexdigests=[snapshotfile.hexdigest for snapshotfile in state.files],
+            contents_b64=contents_b64,
+            chunks=chunks,
+        )
+
+    def to_state(self) -> SnapshotState:
+        if self.version != 1:
+            raise ValueError(f"Unsupported snapshot state columns version {self.version}")
+        files = [
+            SnapshotFile(
+                relative_path=self.directories[directory_index] + name,
+                file_size=file_size,
+                mtime_ns=mtime_ns,
+                hexdigest=hexdigest,
+                content_b64=self.contents_b64.get(i),
+                chunks=self.chunks.get(i, ()),
+            )
+            for i, (directory_index, name, file_size, mtime_ns, hexdigest) in enumerate(
+                zip(self.directory_indexes, self.names, self.file_sizes, self.mtimes_ns, self.hexdigests, strict=True)
+            )
+        ]
+        return SnapshotState(root_globs=self.root_globs, files=files)
+
+
 class SnapshotUploadRequest(NodeRequest):
     # list of hashes to be uploaded
     hashes: Sequence[SnapshotHash]
@@ -180,9 +274,20 @@ class SnapshotUploadRequestV20221129(SnapshotUploadRequest):
     validate_file_hashes: bool = True
 
 
+# Added on 2026-10-18
+class SnapshotUploadRequestV20261018(SnapshotUploadRequestV20221129):
+    # Uploads with the same checkpoint id resume from where the previous ones
+    # stopped on the node, instead of uploading everything again. The
+    # coordinator uses one id per backup operation.
+    checkpoint_id: str = ""
+
+
 class SnapshotUploadResult(NodeResult, kw_only=True):
     total_size: int = 0
     total_stored_size: int = 0
+    # when was the upload started ( / done ); not set by older nodes
+    start: datetime | None = None
+    end: datetime | None = None
 
 
 class SnapshotResult(NodeResult):
@@ -203,6 +308,46 @@ class SnapshotResult(NodeResult):
     # populated only if state is available
     hashes: Sequence[SnapshotHash] | None = None
 
+    # Replaces state in backup manifests stored with the column oriented encoding
+    state_columns: SnapshotStateColumns | None = None
+
+    def get_state(self) -> SnapshotState | None:
+        if self.state_columns is not None:
+            return self.state_columns.to_state()
+        return self.state
+
+    def get_root_globs(self) -> Sequence[str] | None:
+        if self.state_columns is not None:
+            return self.state_columns.root_globs
+        return self.state.root_globs if self.state is not None else None
+
+    def get_page(self, *, cursor: int, limit: int) -> "SnapshotResultPage":
+        """Return up to limit entries of state.files followed by hashes, starting at cursor"""
+        files = self.state.files if self.state is not None else []
+        hashes = self.hashes or []
+        end = min(cursor + limit, len(files) + len(hashes))
+        page = SnapshotResultPage(
+            files=files[cursor:end],
+            hashes=hashes[max(cursor - len(files), 0) : max(end - len(files), 0)],
+            next_cursor=end if end < len(files) + len(hashes) else None,
+        )
+        if cursor == 0:
+            page.result = msgspec.structs.replace(
+                self,
+                state=msgspec.structs.replace(self.state, files=[]) if self.state is not None else None,
+                hashes=[] if self.hashes is not None else None,
+            )
+        return page
+
+
+class SnapshotResultPage(msgspec.Struct, kw_only=True):
+    # The result without state.files and hashes, only on the first page
+    result: SnapshotResult | None = None
+    files: Sequence[SnapshotFile] = ()
+    hashes: Sequence[SnapshotHash] = ()
+    # Cursor of the next page, None on the last page
+    next_cursor: int | None = None
+
 
 class SnapshotDownloadRequest(NodeRequest):
     # which (sub)object storage entry should be used
@@ -219,6 +364,11 @@ class SnapshotDownloadRequest(NodeRequest):
     # retrieved via backup manifest.
     root_globs: Sequence[str]
 
+    # Files with the same content may be restored as hardlinks of each other,
+    # which is only safe if the files are never modified in place. Older nodes
+    # ignore this and copy the files.
+    hardlink_duplicates: bool = False
+
 
 class SnapshotClearRequest(NodeRequest):
     # Files not matching this are not deleted
@@ -322,7 +472,7 @@ class BackupManifest(msgspec.Struct, kw_only=True):
     filename: str = ""
 
 
-class ManifestMin(msgspec.Struct, kw_only=True):
+class ManifestMin(msgspec.Struct, kw_only=True, frozen=True):
     start: datetime
     end: datetime
     filename: str
@@ -332,6 +482,23 @@ class ManifestMin(msgspec.Struct, kw_only=True):
         return cls(start=manifest.start, end=manifest.end, filename=manifest.filename)
 
 
+class HexdigestIndex(msgspec.Struct, kw_only=True):
+    # Backup manifests counted in references
+    manifests: list[str] = msgspec.field(default_factory=list)
+    # Number of backup manifests referencing each hexdigest
+    references: dict[str, int] = msgspec.field(default_factory=dict)
+    # When the index was last rebuilt from the backup manifests, along with a check of all stored hexdigests
+    rebuilt_at: datetime | None = None
+
+
+class HexdigestListing(msgspec.Struct, kw_only=True):
+    # When the hexdigests were last listed from the object storage; the
+    # hexdigests uploaded or deleted by the backups and cleanups since then
+    # are added and removed as they happen
+    listed_at: datetime
+    hexdigests: list[str] = msgspec.field(default_factory=list)
+
+
 # coordinator.list
 
 
@@ -374,3 +541,6 @@ class CleanupRequest(msgspec.Struct, kw_only=True):
     storage: str = ""
     retention: Retention | None = None
     explicit_delete: Sequence[str] = msgspec.field(default_factory=list)
+    # Rebuild the hexdigest index from the kept backup manifests and delete every
+    # stored hexdigest they do not reference, instead of only the newly unreferenced ones
+    rebuild_hexdigest_index: bool = False
@@ -2,20 +2,62 @@
 Copyright (c) 2021 Aiven Ltd
 See LICENSE for details
 """
-from collections.abc import Awaitable, Iterable
+from collections.abc import AsyncIterator, Awaitable, Iterable
+from typing import TypeVar
 
 import asyncio
+import itertools
+import time
+
+T = TypeVar("T")
 
 
 class Limiter:
     def __init__(self, limit: int):
         self.semaphore = asyncio.Semaphore(limit)
 
-    async def run(self, awaitable: Awaitable) -> None:
+    async def run(self, awaitable: Awaitable[T]) -> T:
         async with self.semaphore:
-            await awaitable
+            return await awaitable
+
+
+class RateLimiter:
+    """Spread calls to wait() so that at most rate of them return per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
 
+    async def wait(self) -> None:
+        now = time.monotonic()
+        wait_until = max(now, self.next_time)
+        self.next_time = wait_until + self.interval
+        if wait_until > now:
+            await asyncio.sleep(wait_until - now)
 
-async def gather_limited(limit: int, awaitables: Iterable[Awaitable]) -> None:
+
+async def gather_limited(limit: int, awaitables: Iterable[Awaitable[T]]) -> list[T]:
     limiter = Limiter(limit)
-    await asyncio.gather(*[limiter.run(awaitable) for awaitable in awaitables])
+    return await asyncio.gather(*[limiter.run(awaitable) for awaitable in awaitables])
+
+
+async def iterate_completed_limited(limit: int, awaitables: Iterable[Awaitable[T]]) -> AsyncIterator[T]:
+    """Yield the results of the awaitables as they complete, running at most limit of them at a time.
+
+    The awaitables are taken from the iterable only as earlier ones complete, and no reference to
+    the results is kept once they are yielded.
+    """
+    remaining = iter(awaitables)
+    pending: set[asyncio.Future[T]] = set()
+    try:
+        while True:
+            for awaitable in itertools.islice(remaining, limit - len(pending)):
+                pending.add(asyncio.ensure_future(awaitable))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            while done:
+                yield done.pop().result()
+    finally:
+        for task in pending:
+            task.cancel()
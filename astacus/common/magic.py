@@ -12,6 +12,25 @@ ASTACUS_TMPDIR = ".astacus"
 # Hexdigest is 32 bytes, so something orders of magnitude more at least
 DEFAULT_EMBEDDED_FILE_SIZE = 200
 
+# How many backup manifests the coordinator downloads and decodes at the same time
+DEFAULT_MANIFEST_DOWNLOAD_PARALLEL = 8
+
+# The hexdigest index is rebuilt and all stored hexdigests are checked against it when it is older than
+# this (seconds), which deletes the objects of failed backups that no backup manifest refers to
+DEFAULT_HEXDIGEST_INDEX_MAX_AGE = 7 * 24 * 60 * 60
+
+# How many key prefixes of the object storage are listed at the same time
+DEFAULT_LIST_PARALLEL = 8
+
+# Objects at least this large are downloaded in the lane of the large (bandwidth bound) downloads
+DEFAULT_LARGE_DOWNLOAD_SIZE = 64 * 1024 * 1024
+
+# Downloaded objects up to this size are kept in memory until they are decoded
+DOWNLOAD_SPOOL_SIZE = 16 * 1024 * 1024
+
+# How many snapshot files and hashes are transferred in one page of a snapshot result
+DEFAULT_SNAPSHOT_RESULT_PAGE_SIZE = 10000
+
 
 class StrEnum(str, Enum):
     def __str__(self) -> str:
@@ -32,3 +51,7 @@ class ErrorCode(StrEnum):
 # In storage, json files with this prefix are backup manifests
 JSON_BACKUP_PREFIX = "backup-"
 JSON_DELTA_PREFIX = "delta-"
+# In storage, json file counting the backup manifests referencing each hexdigest
+JSON_HEXDIGEST_INDEX = "hexdigest-index"
+# In storage, json file with the hexdigests known to be stored, used instead of listing them
+JSON_HEXDIGEST_LISTING = "hexdigest-listing"
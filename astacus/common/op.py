@@ -47,6 +47,9 @@ class Op:
     class StartResult(AstacusModel):
         op_id: int
         status_url: str
+        # Lightweight progress-only variant of status_url; empty if the
+        # server does not provide one (and status_url has to be polled)
+        progress_url: str = ""
 
     op_id: int
     stats: StatsClient
@@ -97,6 +100,8 @@ class OpMixin:
     stats: StatsClient
     request_url: URL
     background_tasks: BackgroundTasks
+    # Whether '<status_url>/progress' is served for the started ops
+    serves_progress: bool = False
 
     def allocate_op_id(self) -> int:
         try:
@@ -147,7 +152,8 @@ class OpMixin:
         else:
             self.background_tasks.add_task(_sync_wrapper)
 
-        return Op.StartResult(op_id=op.op_id, status_url=status_url)
+        progress_url = f"{status_url}/progress" if self.serves_progress else ""
+        return Op.StartResult(op_id=op.op_id, status_url=status_url, progress_url=progress_url)
 
     def get_op_and_op_info(self, *, op_id, op_name=None):
         op_info = self.state.op_info
@@ -6,32 +6,46 @@ See LICENSE for details
 Rohmu-specific actual object storage implementation
 
 """
+from .statsd import StatsClient
 from .storage import MultiStorage, Storage, StorageUploadResult
+from .upload_checkpoint import UploadCheckpoint
 from .utils import AstacusModel, fifo_cache
-from astacus.common import exceptions
-from collections.abc import Iterator, Mapping
+from astacus.common import exceptions, magic
+from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
 from enum import Enum
-from pydantic import Field
-from rohmu import errors, rohmufile
+from pydantic import Field, validator
+from rohmu import BaseTransfer, errors, rohmufile
 from rohmu.compressor import CompressionStream
 from rohmu.encryptor import EncryptorStream
+from rohmu.object_storage.base import ConcurrentUpload, KEY_TYPE_OBJECT, TransferWithConcurrentUploadSupport
 from rohmu.typing import Metadata
-from typing import BinaryIO, TypeAlias
+from typing import BinaryIO, cast, TypeAlias
 
 import contextlib
 import io
+import itertools
 import logging
 import mmap
 import os
 import rohmu
 import tempfile
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 
+# The first characters of the hexdigests, by which their listing is partitioned
+HEXDIGEST_PARTITIONS = "0123456789abcdef"
+
+# S3 rejects the completion of multipart uploads with smaller parts (except the last one)
+MIN_MULTIPART_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+
+
 class RohmuModel(AstacusModel):
     class Config:
         # As we're keen to both export and decode json, just using enum
@@ -80,6 +94,25 @@ class RohmuConfig(RohmuModel):
     # Compression (optional)
     compression: RohmuCompression = RohmuCompression()
 
+    # Files of at least this size are uploaded in parts, compressing and
+    # encrypting each part while the previous one is being transferred (if
+    # the storage supports multipart uploads). None disables it.
+    multipart_upload_threshold: int | None = None
+    multipart_upload_part_size: int = 64 * 1024 * 1024
+
+    # Hexdigests are listed split by their first hex digit, with this many
+    # of the prefixes listed concurrently (if the storage can list any key
+    # prefix, the local storage lists only directories)
+    list_parallel: int = magic.DEFAULT_LIST_PARALLEL
+
+    @validator("multipart_upload_part_size")
+    @classmethod
+    def check_multipart_upload_part_size(cls, v: int) -> int:
+        # Checked here, as the storage would refuse it only after all the parts have been transferred
+        if v < MIN_MULTIPART_UPLOAD_PART_SIZE:
+            raise ValueError(f"multipart_upload_part_size must be at least {MIN_MULTIPART_UPLOAD_PART_SIZE}")
+        return v
+
 
 class RohmuMetadata(RohmuModel):
     encryption_key_id: str | None = Field(None, alias="encryption-key-id")
@@ -100,12 +133,26 @@ def rohmu_error_wrapper(fun):
     return _f
 
 
+class _StaleMultipartUploadError(Exception):
+    """The resumed multipart upload no longer exists in the object storage, or its parts do not match."""
+
+
 class RohmuStorage(Storage):
     """Implementation of the storage API, on top of rohmu."""
 
-    def __init__(self, config: RohmuConfig, *, storage: str | None = None) -> None:
+    def __init__(
+        self,
+        config: RohmuConfig,
+        *,
+        storage: str | None = None,
+        stats: StatsClient | None = None,
+        upload_checkpoint: UploadCheckpoint | None = None,
+    ) -> None:
         assert config
         self.config = config
+        self.stats = stats
+        # If set, multipart uploads are recorded in it, and resumed from it if they were interrupted
+        self.upload_checkpoint = upload_checkpoint
         self.hexdigest_key = "data"
         self.json_key = "json"
         self._choose_storage(storage)
@@ -114,9 +161,14 @@ class RohmuStorage(Storage):
             raise exceptions.CompressionOrEncryptionRequired()
 
     @rohmu_error_wrapper
-    def _download_key_to_file(self, key, f: BinaryIO) -> bool:
-        with tempfile.TemporaryFile(dir=self.config.temporary_directory) as temp_file:
-            raw_metadata: Metadata = self.storage.get_contents_to_fileobj(key, temp_file)
+    def _download_key_to_file(self, key, f: BinaryIO, *, transfer: BaseTransfer | None = None) -> bool:
+        transfer = self.storage if transfer is None else transfer
+        # The metadata needed for decoding comes with the content of the GET, which rohmu resumes if it is
+        # interrupted; small objects are kept in memory until they are decoded
+        with tempfile.SpooledTemporaryFile(
+            max_size=magic.DOWNLOAD_SPOOL_SIZE, dir=self.config.temporary_directory
+        ) as temp_file:
+            raw_metadata: Metadata = transfer.get_contents_to_fileobj(key, cast(BinaryIO, temp_file))
             temp_file.seek(0)
             rohmufile.read_file(
                 input_obj=temp_file,
@@ -130,6 +182,28 @@ class RohmuStorage(Storage):
     def _list_key(self, key: str) -> list[str]:
         return [os.path.basename(o["name"]) for o in self.storage.list_iter(key, with_metadata=False)]
 
+    def _list_key_prefix(self, key_prefix: str) -> list[str]:
+        # Not a directory listing: every key starting with key_prefix
+        return [
+            os.path.basename(item.value["name"])
+            for item in self._get_thread_transfer().iter_key(key_prefix, with_metadata=False, include_key=True)
+            if item.type == KEY_TYPE_OBJECT and isinstance(item.value, dict)
+        ]
+
+    def _iter_key_partitioned(self, key: str, *, partitions: str) -> Iterator[str]:
+        """Yield the names under key, listing the keys starting with each of the partitions concurrently.
+
+        The names not starting with one of the partitions are not listed.
+        """
+        with ThreadPoolExecutor(max_workers=self.config.list_parallel) as executor:
+            futures = [executor.submit(self._list_key_prefix, f"{key}/{partition}") for partition in partitions]
+            try:
+                for future in as_completed(futures):
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
     @fifo_cache(size=1)
     def _loaded_private_key_lookup(self, key_id: str) -> RSAPrivateKey:
         private_key_pem = self.config.encryption_keys[key_id].private.encode("ascii")
@@ -149,6 +223,24 @@ class RohmuStorage(Storage):
 
     @rohmu_error_wrapper
     def _upload_key_from_file(self, key: str, f: BinaryIO, file_size: int) -> StorageUploadResult:
+        start_position = f.tell()
+        wrapped_file, rohmu_metadata = self._wrap_file_for_upload(f)
+        threshold = self.config.multipart_upload_threshold
+        if threshold is not None and file_size >= threshold and self.storage.supports_concurrent_upload:
+            try:
+                self._upload_key_in_parts(key, wrapped_file, rohmu_metadata)
+            except _StaleMultipartUploadError:
+                # Its checkpoint is dropped, so this starts a new multipart upload from the beginning of the file
+                f.seek(start_position)
+                wrapped_file, rohmu_metadata = self._wrap_file_for_upload(f)
+                self._upload_key_in_parts(key, wrapped_file, rohmu_metadata)
+        else:
+            start = time.monotonic()
+            self.storage.store_file_object(key, wrapped_file, metadata=rohmu_metadata)
+            self._report_upload_stage("store", wrapped_file.tell(), time.monotonic() - start)
+        return StorageUploadResult(size=file_size, stored_size=wrapped_file.tell())
+
+    def _wrap_file_for_upload(self, f: BinaryIO) -> tuple[BinaryIO, Metadata]:
         encryption_key_id = self.config.encryption_key_id
         compression = self.config.compression
         metadata = RohmuMetadata()
@@ -160,9 +252,97 @@ class RohmuStorage(Storage):
             metadata.encryption_key_id = encryption_key_id
             rsa_public_key = self._loaded_public_key_lookup(encryption_key_id)
             wrapped_file = EncryptorStream(wrapped_file, rsa_public_key)
-        rohmu_metadata = metadata.dict(exclude_defaults=True, by_alias=True)
-        self.storage.store_file_object(key, wrapped_file, metadata=rohmu_metadata)
-        return StorageUploadResult(size=file_size, stored_size=wrapped_file.tell())
+        return wrapped_file, metadata.dict(exclude_defaults=True, by_alias=True)
+
+    def _upload_key_in_parts(self, key: str, wrapped_file: BinaryIO, metadata: Metadata) -> None:
+        """Upload the (compressed and/or encrypted) wrapped_file as a multipart upload.
+
+        Parts are transferred in a separate thread, so reading, compressing and
+        encrypting part N overlaps with the transfer of part N-1; at most two
+        parts are held in memory at a time.
+
+        Raises _StaleMultipartUploadError, after dropping its checkpoint, if
+        the storage rejects a resumed upload, e.g. because it was aborted by
+        the object storage or its parts no longer match the checkpointed ones.
+        """
+        storage = cast(TransferWithConcurrentUploadSupport, self.storage)
+        part_size = self.config.multipart_upload_part_size
+        # Encryption is not deterministic, so the parts of an encrypted file can not be resumed
+        checkpoint = None if self.config.encryption_key_id else self.upload_checkpoint
+        resumed_upload = self._get_resumable_upload(key, metadata) if checkpoint is not None else None
+        if resumed_upload is not None:
+            logger.info("Resuming upload of %r after %d parts", key, len(resumed_upload.chunks_to_etags))
+            upload = resumed_upload
+        else:
+            upload = storage.create_concurrent_upload(key, metadata=metadata)
+            if checkpoint is not None:
+                checkpoint.set_multipart_upload(upload, part_size=part_size)
+
+        def _transfer(part_number: int, data: bytes) -> None:
+            start = time.monotonic()
+            storage.upload_concurrent_chunk(upload, part_number, io.BytesIO(data))
+            self._report_upload_stage("transfer", len(data), time.monotonic() - start)
+            if checkpoint is not None:
+                checkpoint.set_multipart_upload(upload, part_size=part_size)
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                pending_part: Future[None] | None = None
+                for part_number in itertools.count(1):
+                    start = time.monotonic()
+                    data = wrapped_file.read(part_size)
+                    self._report_upload_stage("encode", len(data), time.monotonic() - start)
+                    if pending_part is not None:
+                        pending_part.result()
+                    # Empty files still need one (empty) part
+                    if not data and part_number > 1:
+                        break
+                    if part_number in upload.chunks_to_etags:
+                        # Transferred by the interrupted upload; encoding it again was still needed to
+                        # get to the next part
+                        pending_part = None
+                        continue
+                    pending_part = executor.submit(_transfer, part_number, data)
+            storage.complete_concurrent_upload(upload)
+        except BaseException as ex:
+            if resumed_upload is not None and isinstance(ex, (errors.StorageError, OSError)):
+                logger.warning("Failed to resume upload of %r, restarting it: %r", key, ex)
+                self.abort_multipart_upload(upload)
+                raise _StaleMultipartUploadError(key) from ex
+            # With a checkpoint, the parts transferred so far are kept for the next attempt
+            if checkpoint is None:
+                storage.abort_concurrent_upload(upload)
+            raise
+        if checkpoint is not None:
+            checkpoint.delete_multipart_upload(key)
+
+    def _get_resumable_upload(self, key: str, metadata: Metadata) -> ConcurrentUpload | None:
+        assert self.upload_checkpoint is not None
+        saved = self.upload_checkpoint.get_multipart_upload(key)
+        if saved is None:
+            return None
+        # The parts must be split (and encoded) the same way as before
+        if saved.part_size == self.config.multipart_upload_part_size and saved.upload.metadata == metadata:
+            return saved.upload
+        logger.info("Not resuming upload of %r with different parameters", key)
+        self.abort_multipart_upload(saved.upload)
+        return None
+
+    def abort_multipart_upload(self, upload: ConcurrentUpload) -> None:
+        """Abort an unfinished multipart upload, logging instead of raising on failure."""
+        storage = cast(TransferWithConcurrentUploadSupport, self.storage)
+        try:
+            storage.abort_concurrent_upload(upload)
+        except errors.Error as ex:
+            logger.warning("Failed to abort upload of %r: %r", upload.key, ex)
+        if self.upload_checkpoint is not None:
+            self.upload_checkpoint.delete_multipart_upload(upload.key)
+
+    def _report_upload_stage(self, stage: str, size: int, seconds: float) -> None:
+        # Throughput of each stage is the ratio of these two
+        if self.stats is not None:
+            self.stats.increase("astacus_storage_upload_bytes", inc_value=size, tags={"stage": stage})
+            self.stats.timing("astacus_storage_upload_duration", seconds, tags={"stage": stage})
 
     storage_name: str = ""
 
@@ -172,9 +352,22 @@ class RohmuStorage(Storage):
         self.storage_name = storage
         self.storage_config = self.config.storages[storage]
         self.storage = rohmu.get_transfer_from_model(self.storage_config)
+        self.supports_bulk_delete = transfer_supports_bulk_delete(self.storage)
+        self._thread_transfers = threading.local()
+        self._thread_transfers.transfer = self.storage
+
+    def _get_thread_transfer(self) -> BaseTransfer:
+        # Rohmu transfers are not thread-safe, threads other than the creating one get their own
+        transfer = getattr(self._thread_transfers, "transfer", None)
+        if transfer is None:
+            transfer = rohmu.get_transfer_from_model(self.storage_config)
+            self._thread_transfers.transfer = transfer
+        return transfer
 
     def copy(self) -> "RohmuStorage":
-        return RohmuStorage(config=self.config, storage=self.storage_name)
+        return RohmuStorage(
+            config=self.config, storage=self.storage_name, stats=self.stats, upload_checkpoint=self.upload_checkpoint
+        )
 
     # HexDigestStorage implementation
 
@@ -183,8 +376,26 @@ class RohmuStorage(Storage):
         key = os.path.join(self.hexdigest_key, hexdigest)
         self.storage.delete_key(key)
 
+    def delete_hexdigests(self, hexdigests: Sequence[str]) -> None:
+        if not self.supports_bulk_delete:
+            super().delete_hexdigests(hexdigests)
+            return
+        keys = [os.path.join(self.hexdigest_key, hexdigest) for hexdigest in hexdigests]
+        rohmu_error_wrapper(self.storage.delete_keys)(keys)
+
+    def hexdigest_exists(self, hexdigest: str) -> bool:
+        key = os.path.join(self.hexdigest_key, hexdigest)
+        try:
+            rohmu_error_wrapper(self.storage.get_metadata_for_key)(key)
+        except exceptions.NotFoundException:
+            return False
+        return True
+
     def list_hexdigests(self) -> list[str]:
-        return self._list_key(self.hexdigest_key)
+        if self.config.list_parallel <= 1 or not storage_config_supports_prefix_listing(self.storage_config):
+            return self._list_key(self.hexdigest_key)
+        # The hexdigests are lowercase hex digests
+        return list(self._iter_key_partitioned(self.hexdigest_key, partitions=HEXDIGEST_PARTITIONS))
 
     def download_hexdigest_to_file(self, hexdigest: str, f: BinaryIO) -> bool:
         key = os.path.join(self.hexdigest_key, hexdigest)
@@ -204,7 +415,8 @@ class RohmuStorage(Storage):
     def open_json_bytes(self, name: str) -> Iterator[mmap.mmap]:
         key = os.path.join(self.json_key, name)
         with tempfile.TemporaryFile(dir=self.config.temporary_directory) as temp_file:
-            self._download_key_to_file(key, temp_file)
+            # Manifests are downloaded concurrently from several threads
+            self._download_key_to_file(key, temp_file, transfer=self._get_thread_transfer())
             temp_file.seek(0)
             with mmap.mmap(temp_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
                 yield mapped_file
@@ -223,6 +435,16 @@ class RohmuStorage(Storage):
         return True
 
 
+def storage_config_supports_prefix_listing(config: RohmuStorageConfig) -> bool:
+    # The object storages list any key prefix, the local storage lists only directories
+    return not isinstance(config, rohmu.LocalObjectStorageConfig)
+
+
+def transfer_supports_bulk_delete(transfer: BaseTransfer) -> bool:
+    # Transfers without a native multi-object delete inherit the one deleting keys one by one
+    return type(transfer).delete_keys is not BaseTransfer.delete_keys
+
+
 class MultiRohmuStorage(MultiStorage[RohmuStorage]):
     def __init__(self, *, config: RohmuConfig) -> None:
         self.config = config
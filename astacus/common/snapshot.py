@@ -16,6 +16,10 @@ class SnapshotGroup:
     excluded_names: Sequence[str] = ()
     # None means "no limit": all files matching the glob will be embedded
     embedded_file_size_max: int | None = DEFAULT_EMBEDDED_FILE_SIZE
+    # If set, files larger than this are split into chunks of this size, which
+    # are hashed and stored separately; unchanged chunks of a modified file do
+    # not need to be uploaded again. None means files are stored whole.
+    chunk_size: int | None = None
 
     def without_excluded_names(self) -> Self:
         return dataclasses.replace(self, excluded_names=())
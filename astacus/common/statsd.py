@@ -15,7 +15,8 @@ This is combination of:
 
 """
 from .magic import StrEnum
-from .utils import AstacusModel
+from .utils import AstacusModel, ParallelMapStats
+from collections.abc import Callable
 from contextlib import asynccontextmanager, contextmanager
 
 import socket
@@ -114,3 +115,13 @@ class StatsClient:
             raise NotImplementedError("Unsupported message format")
 
         self._socket.sendto(b"".join(parts), self._dest_addr)
+
+
+def parallel_map_stats_reporter(stats: StatsClient, *, tags: Tags | None = None) -> Callable[[ParallelMapStats], None]:
+    """Return a utils.parallel_map_to stats_callback sending the queue depth and worker utilisation as gauges."""
+
+    def _report(parallel_map_stats: ParallelMapStats) -> None:
+        stats.gauge("astacus_parallel_map_queued", parallel_map_stats.queued, tags=tags)
+        stats.gauge("astacus_parallel_map_utilisation", parallel_map_stats.utilisation, tags=tags)
+
+    return _report
@@ -6,7 +6,7 @@ See LICENSE for details
 """
 from .exceptions import NotFoundException
 from abc import ABC, abstractmethod
-from collections.abc import Iterator
+from collections.abc import Iterator, Sequence
 from pathlib import Path
 from typing import BinaryIO, Callable, ContextManager, Generic, ParamSpec, TypeAlias, TypeVar
 
@@ -35,10 +35,21 @@ class StorageUploadResult(msgspec.Struct, kw_only=True, frozen=True):
 
 
 class HexDigestStorage(ABC):
+    # True if delete_hexdigests deletes many hexdigests with a single request
+    supports_bulk_delete: bool = False
+
     @abstractmethod
     def delete_hexdigest(self, hexdigest: str) -> None:
         ...
 
+    def delete_hexdigests(self, hexdigests: Sequence[str]) -> None:
+        """Delete the hexdigests, ignoring the ones that do not exist."""
+        for hexdigest in hexdigests:
+            try:
+                self.delete_hexdigest(hexdigest)
+            except NotFoundException:
+                pass
+
     def download_hexdigest_bytes(self, hexdigest: str) -> bytes:
         b = io.BytesIO()
         self.download_hexdigest_to_file(hexdigest, b)
@@ -55,6 +66,10 @@ class HexDigestStorage(ABC):
             self.download_hexdigest_to_file(hexdigest, f)
         os.rename(tempfilename, filename)
 
+    @abstractmethod
+    def hexdigest_exists(self, hexdigest: str) -> bool:
+        ...
+
     @abstractmethod
     def list_hexdigests(self) -> list[str]:
         ...
@@ -143,6 +158,9 @@ class FileStorage(Storage):
         logger.info("_list %s => %d", suffix, len(results))
         return results
 
+    def hexdigest_exists(self, hexdigest: str) -> bool:
+        return self._hexdigest_to_path(hexdigest).exists()
+
     def list_hexdigests(self) -> list[str]:
         return self._list(self.hexdigest_suffix)
 
@@ -0,0 +1,163 @@
+"""
+
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+
+Local record of the uploads of a node, so that a retried upload resumes
+where the previous attempt stopped: hexdigests that were completely
+uploaded are not uploaded again, and multipart uploads continue from the
+first part that was not transferred yet.
+
+The checkpoint belongs to a session chosen by the coordinator (one per
+backup operation); starting a different session discards the previous
+one, as the objects it uploaded may since have been deleted from the
+object storage.
+
+"""
+from astacus.common.storage import StorageUploadResult
+from collections.abc import Sequence
+from contextlib import closing
+from pathlib import Path
+from rohmu.object_storage.base import ConcurrentUpload
+
+import dataclasses
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class MultipartUploadCheckpoint:
+    storage: str
+    upload: ConcurrentUpload
+    part_size: int
+
+
+class UploadCheckpoint:
+    """Upload checkpoint of one storage, persisted in a SQLite database.
+
+    The instances are safe to use from several threads.
+    """
+
+    def __init__(self, db: Path, *, storage: str) -> None:
+        self.db = db
+        self.storage = storage
+        self._lock = threading.Lock()
+        db.parent.mkdir(parents=True, exist_ok=True)
+        self._con = sqlite3.connect(db, isolation_level=None, check_same_thread=False)
+        with closing(self._con.cursor()) as cur:
+            cur.execute("create table if not exists session (id text not null);")
+            cur.execute(
+                """
+                create table if not exists uploaded (
+                    storage text not null,
+                    hexdigest text not null,
+                    size integer not null,
+                    stored_size integer not null,
+                    primary key (storage, hexdigest)
+                );
+                """
+            )
+            cur.execute(
+                """
+                create table if not exists multipart_uploads (
+                    storage text not null,
+                    key text not null,
+                    upload text not null,
+                    part_size integer not null,
+                    primary key (storage, key)
+                );
+                """
+            )
+
+    def close(self) -> None:
+        self._con.close()
+
+    def start_session(self, session: str) -> Sequence[MultipartUploadCheckpoint]:
+        """Continue the session if it is the current one, otherwise discard the checkpoint and start it.
+
+        Returns the unfinished multipart uploads of the discarded checkpoint (of all storages),
+        which the caller should abort.
+        """
+        with self._lock:
+            row = self._con.execute("select id from session;").fetchone()
+            if row is not None and row[0] == session:
+                return []
+            logger.info("Starting upload checkpoint session %r (previous %r)", session, row[0] if row else None)
+            stale_uploads = [
+                MultipartUploadCheckpoint(storage=storage, upload=_decode_upload(upload), part_size=part_size)
+                for storage, upload, part_size in self._con.execute(
+                    "select storage, upload, part_size from multipart_uploads;"
+                )
+            ]
+            self._con.execute("begin;")
+            self._con.execute("delete from session;")
+            self._con.execute("delete from uploaded;")
+            self._con.execute("delete from multipart_uploads;")
+            self._con.execute("insert into session (id) values (?);", (session,))
+            self._con.execute("commit;")
+            return stale_uploads
+
+    def get_uploaded(self, hexdigest: str) -> StorageUploadResult | None:
+        with self._lock:
+            row = self._con.execute(
+                "select size, stored_size from uploaded where storage = ? and hexdigest = ?;", (self.storage, hexdigest)
+            ).fetchone()
+        if row is None:
+            return None
+        return StorageUploadResult(size=row[0], stored_size=row[1])
+
+    def set_uploaded(self, hexdigest: str, result: StorageUploadResult) -> None:
+        with self._lock:
+            self._con.execute(
+                "insert or replace into uploaded (storage, hexdigest, size, stored_size) values (?, ?, ?, ?);",
+                (self.storage, hexdigest, result.size, result.stored_size),
+            )
+
+    def get_multipart_upload(self, key: str) -> MultipartUploadCheckpoint | None:
+        with self._lock:
+            row = self._con.execute(
+                "select upload, part_size from multipart_uploads where storage = ? and key = ?;", (self.storage, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return MultipartUploadCheckpoint(storage=self.storage, upload=_decode_upload(row[0]), part_size=row[1])
+
+    def set_multipart_upload(self, upload: ConcurrentUpload, *, part_size: int) -> None:
+        """Record the upload, including the parts transferred so far."""
+        with self._lock:
+            self._con.execute(
+                "insert or replace into multipart_uploads (storage, key, upload, part_size) values (?, ?, ?, ?);",
+                (self.storage, upload.key, _encode_upload(upload), part_size),
+            )
+
+    def delete_multipart_upload(self, key: str) -> None:
+        with self._lock:
+            self._con.execute("delete from multipart_uploads where storage = ? and key = ?;", (self.storage, key))
+
+
+def _encode_upload(upload: ConcurrentUpload) -> str:
+    return json.dumps(
+        {
+            "backend": upload.backend,
+            "backend_id": upload.backend_id,
+            "key": upload.key,
+            "metadata": upload.metadata,
+            "chunks_to_etags": upload.chunks_to_etags,
+        }
+    )
+
+
+def _decode_upload(data: str) -> ConcurrentUpload:
+    value = json.loads(data)
+    return ConcurrentUpload(
+        backend=value["backend"],
+        backend_id=value["backend_id"],
+        key=value["key"],
+        metadata=value["metadata"],
+        # JSON object keys are strings
+        chunks_to_etags={int(part_number): etag for part_number, etag in value["chunks_to_etags"].items()},
+    )
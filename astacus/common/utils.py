@@ -12,18 +12,20 @@ from __future__ import annotations
 
 from abc import ABC
 from collections import deque
-from collections.abc import AsyncIterable, AsyncIterator, Callable, Hashable, Iterable, Mapping
+from collections.abc import AsyncIterable, AsyncIterator, Callable, Hashable, Iterable, Mapping, Sequence
 from contextlib import contextmanager
-from multiprocessing.dummy import Pool  # fastapi + fork = bad idea
 from pathlib import Path
 from pydantic import BaseModel
 from typing import Any, Final, Generic, TypeAlias, TypeVar
 
 import asyncio
+import concurrent.futures
 import contextlib
+import dataclasses
 import datetime
 import httpcore
 import httpx
+import itertools
 import json as _json
 import logging
 import os
@@ -101,6 +103,17 @@ def http_request(url, *, caller, method="get", timeout=10, ignore_status_code: b
     return None
 
 
+@contextlib.asynccontextmanager
+async def _httpx_client(client: httpx.AsyncClient | None) -> AsyncIterator[httpx.AsyncClient]:
+    # A shared client is used as-is (and its connections reused), otherwise
+    # a new client is created for (and closed after) the single request
+    if client is not None:
+        yield client
+        return
+    async with httpx.AsyncClient() as new_client:
+        yield new_client
+
+
 async def httpx_request(
     url: str | httpx.URL,
     *,
@@ -109,6 +122,7 @@ async def httpx_request(
     timeout: float = 10.0,
     json: bool = True,
     ignore_status_code: bool = False,
+    client: httpx.AsyncClient | None = None,
     **kw,
 ) -> httpx.Response | Mapping[str, Any] | None:
     """Wrapper for httpx.request which handles timeouts as non-exceptions,
@@ -118,7 +132,7 @@ async def httpx_request(
     # TBD: may need to redact url in future, if we actually wind up
     # using passwords in urls here.
     logger.info("async-request %s %s by %s", method, url, caller)
-    async with httpx.AsyncClient() as client:
+    async with _httpx_client(client) as client:
         try:
             r = await client.request(method, url, timeout=timeout, **kw)
             if not r.is_error:
@@ -145,6 +159,7 @@ async def httpx_request_stream(
     method: str = "get",
     timeout: float = 10.0,
     ignore_status_code: bool = False,
+    client: httpx.AsyncClient | None = None,
     **kw,
 ) -> AsyncIterator[httpx.Response | None]:
     """Wrapper for httpx.request which handles timeouts as non-exceptions,
@@ -153,7 +168,7 @@ async def httpx_request_stream(
     # TBD: may need to redact url in future, if we actually wind up
     # using passwords in urls here.
     logger.info("async-request %s %s by %s", method, url, caller)
-    async with httpx.AsyncClient() as client:
+    async with _httpx_client(client) as client:
         try:
             async with client.stream(method, url, timeout=timeout, **kw) as r:
                 if not r.is_error or ignore_status_code:
@@ -282,10 +297,17 @@ def exponential_backoff(
 
 
 class SizeLimitedFile:
-    def __init__(self, *, path, file_size):
+    """Read-only view of file_size bytes of the file, starting at offset.
+
+    The positions (seek, tell) are relative to the offset.
+    """
+
+    def __init__(self, *, path, file_size, offset=0):
         self._f = open(path, "rb")  # pylint: disable=consider-using-with
         self._file_size = file_size
-        self.tell = self._f.tell
+        self._offset = offset
+        if offset:
+            self._f.seek(offset)
 
     def __enter__(self):
         return self
@@ -293,8 +315,11 @@ class SizeLimitedFile:
     def __exit__(self, t, v, tb):
         self._f.close()
 
+    def tell(self):
+        return self._f.tell() - self._offset
+
     def read(self, n=None):
-        can_read = max(0, self._file_size - self._f.tell())
+        can_read = max(0, self._file_size - self.tell())
         if n is None:
             n = can_read
         n = min(can_read, n)
@@ -303,10 +328,10 @@ class SizeLimitedFile:
     def seek(self, ofs, whence=0):
         if whence == os.SEEK_END:
             ofs += self._file_size
-            whence = os.SEEK_SET
-        if whence == os.SEEK_SET:
-            ofs = max(0, min(self._file_size, ofs))
-        return self._f.seek(ofs, whence)
+        elif whence == os.SEEK_CUR:
+            ofs += self.tell()
+        ofs = max(0, min(self._file_size, ofs))
+        return self._f.seek(self._offset + ofs) - self._offset
 
 
 def timedelta_as_short_str(delta):
@@ -323,13 +348,98 @@ def size_as_short_str(size: int | float) -> str:
     return f"{size} B"
 
 
-def parallel_map_to(*, fun, iterable, result_callback, n=None) -> bool:
-    iterable_as_list = list(iterable)
-    with Pool(n) as p:
-        for map_in, map_out in zip(iterable_as_list, p.imap(fun, iterable_as_list)):
-            if not result_callback(map_in=map_in, map_out=map_out):
-                return False
-    return True
+@dataclasses.dataclass(frozen=True)
+class ParallelMapStats:
+    # Items submitted but not started yet
+    queued: int
+    # Items being processed
+    running: int
+    workers: int
+
+    @property
+    def utilisation(self) -> float:
+        return self.running / self.workers
+
+
+@dataclasses.dataclass(frozen=True)
+class ParallelMapLane:
+    iterable: Iterable
+    # Number of threads of the lane, by default the number of CPUs
+    n: int | None = None
+    # Items submitted but not completed at most, by default 2 * n
+    queue_size: int | None = None
+
+
+def parallel_map_to(
+    *,
+    fun,
+    iterable,
+    result_callback,
+    n=None,
+    queue_size: int | None = None,
+    stats_callback: Callable[[ParallelMapStats], None] | None = None,
+    stats_interval: float = 10.0,
+) -> bool:
+    """Call fun on the items of iterable in n threads, and result_callback(map_in=..., map_out=...) in the caller thread.
+
+    The results are delivered as they complete, in no particular order. The
+    iterable is consumed lazily, keeping at most queue_size (by default 2 * n)
+    items submitted but not completed. If result_callback returns False, the
+    items not started yet are cancelled and False is returned as soon as the
+    running ones are done.
+
+    If set, stats_callback is called at most every stats_interval seconds with the queue depth and worker utilisation.
+    """
+    return parallel_map_lanes_to(
+        fun=fun,
+        lanes=[ParallelMapLane(iterable=iterable, n=n, queue_size=queue_size)],
+        result_callback=result_callback,
+        stats_callback=stats_callback,
+        stats_interval=stats_interval,
+    )
+
+
+def parallel_map_lanes_to(
+    *,
+    fun,
+    lanes: Sequence[ParallelMapLane],
+    result_callback,
+    stats_callback: Callable[[ParallelMapStats], None] | None = None,
+    stats_interval: float = 10.0,
+) -> bool:
+    """Same as parallel_map_to, but with separate threads for the items of each lane.
+
+    The stats are those of all the lanes combined.
+    """
+    lane_workers = [lane.n or os.cpu_count() or 1 for lane in lanes]
+    lane_items = [iter(lane.iterable) for lane in lanes]
+    lane_max_pending = [lane.queue_size or 2 * workers for lane, workers in zip(lanes, lane_workers)]
+    lane_pending: list[dict[concurrent.futures.Future, Any]] = [{} for _ in lanes]
+    next_stats_time = time.monotonic()
+    executors = [concurrent.futures.ThreadPoolExecutor(max_workers=workers) for workers in lane_workers]
+    try:
+        while True:
+            for executor, items, max_pending, pending in zip(executors, lane_items, lane_max_pending, lane_pending):
+                for item in itertools.islice(items, max_pending - len(pending)):
+                    pending[executor.submit(fun, item)] = item
+            all_pending = {future: pending for pending in lane_pending for future in pending}
+            if not all_pending:
+                return True
+            if stats_callback is not None and time.monotonic() >= next_stats_time:
+                running = sum(1 for future in all_pending if future.running())
+                stats_callback(
+                    ParallelMapStats(queued=len(all_pending) - running, running=running, workers=sum(lane_workers))
+                )
+                next_stats_time = time.monotonic() + stats_interval
+            done, _ = concurrent.futures.wait(all_pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if not result_callback(map_in=all_pending[future].pop(future), map_out=future.result()):
+                    return False
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for executor in executors:
+            executor.shutdown(wait=True)
 
 
 def now():
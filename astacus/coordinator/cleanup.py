@@ -34,7 +34,12 @@ class CleanupOp(SteppedCoordinatorOp):
                 maximum_backups=coalesce(req.retention.maximum_backups, c.config.retention.maximum_backups),
                 keep_days=coalesce(req.retention.keep_days, c.config.retention.keep_days),
             )
-        steps = c.get_plugin().get_cleanup_steps(context=context, retention=retention, explicit_delete=req.explicit_delete)
+        steps = c.get_plugin().get_cleanup_steps(
+            context=context,
+            retention=retention,
+            explicit_delete=req.explicit_delete,
+            rebuild_hexdigest_index=req.rebuild_hexdigest_index,
+        )
         super().__init__(c=c, attempts=1, steps=steps)
 
 
@@ -5,19 +5,21 @@ See LICENSE for details
 from astacus.common import ipc, op, utils
 from astacus.common.magic import LockCall
 from astacus.common.progress import Progress
-from astacus.common.statsd import StatsClient
+from astacus.common.statsd import StatsClient, Tags
 from astacus.common.utils import AsyncSleeper, httpx_request_stream
-from astacus.coordinator.config import CoordinatorNode, PollConfig
-from collections.abc import Callable, Mapping, Sequence
+from astacus.coordinator.config import CoordinatorNode, NodeHttpConfig, PollConfig
+from collections.abc import Awaitable, Callable, Mapping, Sequence
 from enum import Enum
 from typing import Any, cast, TypeAlias, TypeVar
 
 import asyncio
 import copy
 import httpx
+import importlib.util
 import json
 import logging
 import msgspec
+import time
 import urllib.parse
 
 logger = logging.getLogger(__name__)
@@ -42,13 +44,46 @@ class Cluster:
         subresult_url: str | None = None,
         subresult_sleeper: AsyncSleeper | None = None,
         stats: StatsClient | None = None,
+        http_config: NodeHttpConfig | None = None,
+        metadata_ttl: float = 300,
     ):
         self.nodes = nodes
         self.poll_config = PollConfig() if poll_config is None else poll_config
         self.subresult_url = subresult_url
         self.subresult_sleeper = subresult_sleeper
         self.stats = stats
+        self.http_config = NodeHttpConfig() if http_config is None else http_config
         self.progress_handler: Callable[[Progress], None] | None = None
+        self._http_client: httpx.AsyncClient | None = None
+        self.metadata_ttl = metadata_ttl
+        # node url -> (monotonic time when fetched, metadata)
+        self._metadata_cache: dict[str, tuple[float, ipc.MetadataResult]] = {}
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        # Created lazily, as the client has to be created (and used) within the event loop of the operation
+        if self._http_client is None:
+            max_connections = self.http_config.max_connections_per_node * max(len(self.nodes), 1)
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=self.http_config.keepalive_expiry,
+                ),
+                http2=self.http_config.http2 and is_http2_available(),
+            )
+        return self._http_client
+
+    async def aclose(self) -> None:
+        """Close the pooled connections to the nodes."""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    def _http_kwargs(self, url: str) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"client": self._get_http_client()}
+        if self.stats is not None:
+            kwargs["extensions"] = {"trace": ConnectionStatsTracer(stats=self.stats, url=url)}
+        return kwargs
 
     def set_progress_handler(self, progress_handler: Callable[[Progress], None] | None):
         self.progress_handler = progress_handler
@@ -111,12 +146,43 @@ class Cluster:
 
         # Now 'reqs' + 'urls' contains all we need to actually perform
         # requests we want to.
-        aws = [utils.httpx_request(url, caller=caller, data=msgspec.json.encode(req), **kw) for req, url in zip(reqs, urls)]
+        aws = [
+            utils.httpx_request(url, caller=caller, data=msgspec.json.encode(req), **self._http_kwargs(url), **kw)
+            for req, url in zip(reqs, urls)
+        ]
         results = await asyncio.gather(*aws, return_exceptions=True)
 
         logger.info("request_from_nodes %r to %r => %r", reqs, urls, results)
         return results
 
+    async def get_nodes_metadata(self, *, nodes: Sequence[CoordinatorNode] | None = None) -> list[ipc.MetadataResult]:
+        """Return the metadata of the nodes, requesting it only from the nodes
+        which do not have it cached for at most metadata_ttl seconds.
+
+        Nodes that could not be reached have no version and no features,
+        and are asked again on the next call.
+        """
+        nodes = list(self.nodes if nodes is None else nodes)
+        now = time.monotonic()
+        missing_nodes = [
+            node
+            for node in nodes
+            if node.url not in self._metadata_cache or now - self._metadata_cache[node.url][0] >= self.metadata_ttl
+        ]
+        metadata_responses = await self.request_from_nodes(
+            "metadata", caller="get_nodes_metadata", method="get", nodes=missing_nodes, json=False
+        )
+        for node, response in zip(missing_nodes, metadata_responses):
+            self._metadata_cache.pop(node.url, None)
+            if isinstance(response, httpx.Response):
+                self._metadata_cache[node.url] = (now, msgspec.json.decode(response.content, type=ipc.MetadataResult))
+        return [
+            self._metadata_cache[node.url][1]
+            if node.url in self._metadata_cache
+            else ipc.MetadataResult(version="", features=[])
+            for node in nodes
+        ]
+
     async def _request_lock_call_from_nodes(
         self, *, call: LockCall, locker: str, ttl: int = 0, nodes: Sequence[CoordinatorNode]
     ) -> LockResult:
@@ -167,8 +233,28 @@ class Cluster:
 
     async def wait_successful_results(
         self, *, start_results: Sequence[Result | None], result_class: type[NR]
+    ) -> Sequence[NR]:
+        async def _fetch_result(url: str) -> NR | None:
+            return await self._request_node_result(
+                url, result_class, timeout=self.poll_config.result_timeout, endpoint="result"
+            )
+
+        return await self._wait_results(start_results=start_results, fetch_result=_fetch_result)
+
+    async def wait_successful_snapshot_results(
+        self, *, start_results: Sequence[Result | None]
+    ) -> Sequence[ipc.SnapshotResult]:
+        """Like wait_successful_results, but fetch the final snapshot results in pages.
+
+        The nodes must support NodeFeatures.paged_snapshot_results.
+        """
+        return await self._wait_results(start_results=start_results, fetch_result=self._request_paged_snapshot_result)
+
+    async def _wait_results(
+        self, *, start_results: Sequence[Result | None], fetch_result: Callable[[str], Awaitable[NR | None]]
     ) -> Sequence[NR]:
         urls = []
+        progress_urls = []
 
         for i, start_result in enumerate(start_results, 1):
             if not start_result or isinstance(start_result, BaseException):
@@ -178,14 +264,54 @@ class Cluster:
                 raise WaitResultError(f"incorrect start result for #{i}/{len(start_results)}: {start_result!r}")
             parsed_start_result = op.Op.StartResult.parse_obj(start_result)
             urls.append(parsed_start_result.status_url)
+            progress_urls.append(parsed_start_result.progress_url)
         if len(urls) != len(start_results):
             raise WaitResultError(f"incorrect number of results: {len(urls)} vs {len(start_results)}")
         results: list[NR | None] = [None] * len(urls)
+        progresses: list[Progress | None] = [None] * len(urls)
         # Note that we don't have timeout mechanism here as such,
         # however, if re-locking times out, we will bail out. TBD if
         # we need timeout mechanism here anyway.
         failures = {i: 0 for i in range(len(results))}
 
+        def _record_failure(i: int) -> None:
+            failures[i] += 1
+            if failures[i] >= self.poll_config.maximum_failures:
+                raise WaitResultError("too many failures")
+
+        def _record_progress(i: int, progress: Progress) -> None:
+            progresses[i] = progress
+            failures[i] = 0
+            if self.progress_handler is not None:
+                self.progress_handler(Progress.merge(p for p in progresses if p is not None))
+            if progress.finished_failed:
+                raise WaitResultError
+
+        async def _poll_node(i: int) -> None:
+            url, progress_url = urls[i], progress_urls[i]
+            progress = progresses[i]
+            progress_text = f"{progress!r}" if progress is not None else "not started"
+            logger.info("%s node #%d/%d: %s", node_op_from_url(url), i, len(urls), progress_text)
+            # Nodes which provide a progress url are polled only for
+            # the progress, and the full result is fetched once final
+            if progress_url and (progress is None or not progress.final):
+                progress_result = await self._request_node_result(
+                    progress_url, ipc.NodeResult, timeout=self.poll_config.progress_timeout, endpoint="progress"
+                )
+                if progress_result is None:
+                    _record_failure(i)
+                    return
+                _record_progress(i, progress_result.progress)
+                if not progress_result.progress.final:
+                    return
+            result = await fetch_result(url)
+            if result is None:
+                _record_failure(i)
+                return
+            _record_progress(i, result.progress)
+            if result.progress.final:
+                results[i] = result
+
         async for _ in utils.exponential_backoff(
             initial=self.poll_config.delay_start,
             multiplier=self.poll_config.delay_multiplier,
@@ -193,33 +319,14 @@ class Cluster:
             duration=self.poll_config.duration,
             async_sleeper=self.subresult_sleeper,
         ):
-            for i, (url, result) in enumerate(zip(urls, results)):
-                # TBD: This could be done in parallel too
-                if result is not None and result.progress.final:
-                    continue
-                progress_text = f"{result.progress!r}" if result is not None else "not started"
-                logger.info("%s node #%d/%d: %s", node_op_from_url(url), i, len(urls), progress_text)
-                async with httpx_request_stream(
-                    url, caller="Nodes.wait_successful_results", timeout=self.poll_config.result_timeout
-                ) as r:
-                    if r is None:
-                        failures[i] += 1
-                        if failures[i] >= self.poll_config.maximum_failures:
-                            raise WaitResultError("too many failures")
-                        continue
-                    # We got something -> decode the result
-                    assert isinstance(r, httpx.Response)
-                    payload = bytearray()
-                    async for chunk in r.aiter_bytes():
-                        payload.extend(chunk)
-                result = msgspec.json.decode(payload, type=result_class)
-                results[i] = result
-                failures[i] = 0
-                if self.progress_handler is not None:
-                    self.progress_handler(Progress.merge(r.progress for r in results if r is not None))
-                if result.progress.finished_failed:
-                    raise WaitResultError
-            if not any(True for result in results if result is None or not result.progress.final):
+            # Poll the nodes concurrently so that one slow node does not
+            # delay noticing the progress of the others
+            pending = [i for i, result in enumerate(results) if result is None]
+            poll_results = await asyncio.gather(*(_poll_node(i) for i in pending), return_exceptions=True)
+            for poll_result in poll_results:
+                if isinstance(poll_result, BaseException):
+                    raise poll_result
+            if all(result is not None for result in results):
                 break
         else:
             logger.info("wait_successful_results timed out")
@@ -227,11 +334,89 @@ class Cluster:
         # The case is valid because we get there when all results are not None
         return cast(Sequence[NR], results)
 
+    async def _request_node_result(self, url: str, result_class: type[T], *, timeout: float, endpoint: str) -> T | None:
+        start_time = time.monotonic()
+        async with httpx_request_stream(
+            url, caller="Nodes.wait_successful_results", timeout=timeout, **self._http_kwargs(url)
+        ) as r:
+            if r is None:
+                return None
+            # We got something -> decode the result
+            assert isinstance(r, httpx.Response)
+            payload = bytearray()
+            async for chunk in r.aiter_bytes():
+                payload.extend(chunk)
+        if self.stats is not None:
+            tags: Tags = {"node": urllib.parse.urlparse(url).netloc, "endpoint": endpoint}
+            self.stats.timing("astacus_node_poll_duration", time.monotonic() - start_time, tags=tags)
+            self.stats.increase("astacus_node_poll_bytes", inc_value=len(payload), tags=tags)
+        return msgspec.json.decode(payload, type=result_class)
+
+    async def _request_paged_snapshot_result(self, url: str) -> ipc.SnapshotResult | None:
+        # The pages are decoded one by one straight into the final result,
+        # instead of holding the whole encoded result in memory as well
+        result: ipc.SnapshotResult | None = None
+        files: list[ipc.SnapshotFile] = []
+        hashes: list[ipc.SnapshotHash] = []
+        cursor: int | None = 0
+        while cursor is not None:
+            page = await self._request_node_result(
+                f"{url}/page?cursor={cursor}&limit={self.poll_config.result_page_size}",
+                ipc.SnapshotResultPage,
+                timeout=self.poll_config.result_timeout,
+                endpoint="result_page",
+            )
+            if page is None:
+                return None
+            if page.result is not None:
+                result = page.result
+            files.extend(page.files)
+            hashes.extend(page.hashes)
+            cursor = page.next_cursor
+        if result is None:
+            raise WaitResultError(f"first page of {url} is missing the result")
+        if result.state is not None:
+            result.state.files = files
+        if result.hashes is not None:
+            result.hashes = hashes
+        return result
+
 
 class WaitResultError(Exception):
     pass
 
 
+class ConnectionStatsTracer:
+    """httpcore trace callback of a single request, which reports if a
+    pooled connection was reused, and the time spent on new connections."""
+
+    def __init__(self, *, stats: StatsClient, url: str) -> None:
+        self.stats = stats
+        self.tags: Tags = {"node": urllib.parse.urlparse(url).netloc}
+        self.started: dict[str, float] = {}
+        self.connected = False
+
+    async def __call__(self, event_name: str, info: Mapping[str, Any]) -> None:
+        _, _, event = event_name.partition(".")
+        step, _, state = event.rpartition(".")
+        if step in {"connect_tcp", "start_tls"}:
+            if state == "started":
+                self.connected = True
+                self.started[step] = time.monotonic()
+            elif state == "complete":
+                duration = time.monotonic() - self.started.pop(step)
+                self.stats.timing(f"astacus_node_http_{step}_duration", duration, tags=self.tags)
+        elif step == "send_request_headers" and state == "started":
+            self.stats.increase(
+                "astacus_node_http_requests", tags={**self.tags, "connection": "new" if self.connected else "reused"}
+            )
+
+
+def is_http2_available() -> bool:
+    # httpx supports HTTP/2 only with the optional h2 package
+    return importlib.util.find_spec("h2") is not None
+
+
 def node_op_from_url(url: str) -> str:
     parsed_url = urllib.parse.urlparse(url)
     return parsed_url.path.replace("/node/", "")
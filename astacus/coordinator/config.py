@@ -2,7 +2,7 @@
 Copyright (c) 2020 Aiven Ltd
 See LICENSE for details
 """
-from astacus.common import ipc
+from astacus.common import ipc, magic
 from astacus.common.rohmustorage import RohmuConfig
 from astacus.common.statsd import StatsdConfig
 from astacus.common.utils import AstacusModel
@@ -26,9 +26,28 @@ class PollConfig(AstacusModel):
     maximum_failures: int = 5
 
     # Sometimes Astacus blobs can be .. big.
-    # (TBD: This should be paged somehow)
     result_timeout: int = 300
 
+    # Snapshot results are fetched in pages of this many files and hashes
+    # from the nodes which support it
+    result_page_size: int = magic.DEFAULT_SNAPSHOT_RESULT_PAGE_SIZE
+
+    # Progress-only polls are small, so a node which does not answer
+    # them quickly is treated as a failed poll
+    progress_timeout: int = 10
+
+
+class NodeHttpConfig(AstacusModel):
+    # Connections to the nodes are pooled and kept alive for the duration
+    # of an operation; this is the number of connections per node
+    max_connections_per_node: int = 4
+
+    # How long idle connections are kept open (seconds)
+    keepalive_expiry: float = 60.0
+
+    # Use HTTP/2 with https nodes, if the h2 package is installed
+    http2: bool = True
+
 
 class CoordinatorNode(AstacusModel):
     # What is the Astacus url of the node
@@ -58,6 +77,8 @@ class CoordinatorConfig(AstacusModel):
 
     poll: PollConfig = PollConfig()
 
+    node_http: NodeHttpConfig = NodeHttpConfig()
+
     plugin: ipc.Plugin
     plugin_config: dict = {}
 
@@ -71,6 +92,32 @@ class CoordinatorConfig(AstacusModel):
     # insufficient at times.
     default_lock_ttl: int = 600
 
+    # If set, the upload results of this many latest backups are used to
+    # estimate the upload speed of each node, and the uploads of a backup
+    # are assigned to the nodes to minimize the time they take (instead of
+    # only balancing the uploaded bytes)
+    upload_history_backups: int = 0
+
+    # If set, the uploads of a backup are handed to the nodes in batches of
+    # about this many bytes as they finish their previous batches, so that
+    # the data present on several nodes is uploaded by the nodes that are
+    # the fastest at the time; otherwise all uploads are assigned up front
+    upload_batch_size: int | None = None
+
+    # If set, the hexdigests stored in the object storage are listed at most
+    # this often (seconds); in between, backups use the listing stored with
+    # the backup manifests, which backups and cleanups keep up to date
+    hexdigest_listing_max_age: int | None = None
+
+    # If set, cleanups rebuild the hexdigest index and check all the stored
+    # hexdigests against it when it was last rebuilt longer ago than this
+    # (seconds), which deletes the unreferenced objects of failed backups
+    hexdigest_index_max_age: int | None = magic.DEFAULT_HEXDIGEST_INDEX_MAX_AGE
+
+    # How long the metadata (version and features) of the nodes is
+    # cached within an operation before it is requested again
+    node_metadata_ttl: int = 300
+
     # Backup is attempted this many times before giving up.
     #
     # Note that values should be >1, as at least one retry makes
@@ -98,6 +145,18 @@ class CoordinatorConfig(AstacusModel):
     # backup? Probably even one hour (default) is sensible enough
     list_ttl: int = 3600
 
+    # When the object storage has no multi-object delete, how many objects
+    # are deleted concurrently during cleanup
+    delete_parallel: int = 10
+
+    # Maximum number of delete requests per second during cleanup, to stay
+    # below the rate limits of the object storage; None means no limit
+    delete_rate_limit: float | None = None
+
+    # How many backup manifests are downloaded and decoded concurrently,
+    # e.g. when computing the kept backups or the deltas to restore
+    manifest_download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
+
 
 def coordinator_config(request: Request) -> CoordinatorConfig:
     return getattr(request.app.state, APP_KEY)
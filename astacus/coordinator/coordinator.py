@@ -11,7 +11,7 @@ from astacus.common.op import Op
 from astacus.common.progress import Progress
 from astacus.common.rohmustorage import MultiRohmuStorage
 from astacus.common.statsd import StatsClient, Tags
-from astacus.common.storage import JsonStorage, MultiFileStorage, MultiStorage
+from astacus.common.storage import JsonStorage, MultiFileStorage, MultiStorage, ST
 from astacus.common.utils import AsyncSleeper
 from astacus.coordinator.cluster import Cluster, LockResult, WaitResultError
 from astacus.coordinator.config import coordinator_config, CoordinatorConfig, CoordinatorNode
@@ -26,6 +26,7 @@ from urllib.parse import urlunsplit
 
 import asyncio
 import contextlib
+import datetime
 import logging
 import mmap
 import socket
@@ -82,6 +83,19 @@ class Coordinator(op.OpMixin):
             storage_name=storage_name,
             json_storage=self.get_json_storage(storage_name),
             hexdigest_storage=self.get_hexdigest_storage(storage_name),
+            manifest_download_parallel=self.config.manifest_download_parallel,
+            upload_history_backups=self.config.upload_history_backups,
+            upload_batch_size=self.config.upload_batch_size,
+            hexdigest_listing_max_age=(
+                datetime.timedelta(seconds=self.config.hexdigest_listing_max_age)
+                if self.config.hexdigest_listing_max_age is not None
+                else None
+            ),
+            hexdigest_index_max_age=(
+                datetime.timedelta(seconds=self.config.hexdigest_index_max_age)
+                if self.config.hexdigest_index_max_age is not None
+                else None
+            ),
         )
 
     def get_plugin(self) -> CoordinatorPlugin:
@@ -91,7 +105,11 @@ class Coordinator(op.OpMixin):
         return requested_storage if requested_storage else self.json_mstorage.get_default_storage_name()
 
     def get_hexdigest_storage(self, storage_name: str) -> asyncstorage.AsyncHexDigestStorage:
-        return asyncstorage.AsyncHexDigestStorage(self.hexdigest_mstorage.get_storage(storage_name))
+        return asyncstorage.AsyncHexDigestStorage(
+            self.hexdigest_mstorage.get_storage(storage_name),
+            delete_parallel=self.config.delete_parallel,
+            delete_rate_limit=self.config.delete_rate_limit,
+        )
 
     def get_json_storage(self, storage_name: str) -> asyncstorage.AsyncJsonStorage:
         storage = CacheClearingJsonStorage(state=self.state, storage=self.json_mstorage.get_storage(storage_name))
@@ -117,6 +135,10 @@ class CacheClearingJsonStorage(JsonStorage):
         with self.storage.open_json_bytes(name) as json_bytes:
             yield json_bytes
 
+    def download_json(self, name: str, struct_type: type[ST]) -> ST:
+        # The wrapped storage may share decoded jsons
+        return self.storage.download_json(name, struct_type)
+
     def list_jsons(self) -> list[str]:
         return self.storage.list_jsons()
 
@@ -133,6 +155,8 @@ class CoordinatorOp(op.Op):
         self.request_url = c.request_url
         self.nodes = c.config.nodes
         self.poll_config = c.config.poll
+        self.node_http_config = c.config.node_http
+        self.node_metadata_ttl = c.config.node_metadata_ttl
 
     def get_cluster(self) -> Cluster:
         # The only reason this exists is because op_id and stats are added after the op is created
@@ -142,6 +166,8 @@ class CoordinatorOp(op.Op):
             subresult_url=get_subresult_url(self.request_url, self.op_id),
             subresult_sleeper=self.subresult_sleeper,
             stats=self.stats,
+            http_config=self.node_http_config,
+            metadata_ttl=self.node_metadata_ttl,
         )
 
     @cached_property
@@ -174,6 +200,7 @@ class LockedCoordinatorOp(CoordinatorOp):
         if result is not LockResult.ok:
             # Ensure we don't wind up holding partial lock on the cluster
             await cluster.request_unlock(locker=self.locker)
+            await cluster.aclose()
             raise HTTPException(
                 409,
                 {
@@ -191,6 +218,7 @@ class LockedCoordinatorOp(CoordinatorOp):
                     relock_task.cancel()
                 await asyncio.gather(*relock_tasks, return_exceptions=True)
                 await cluster.request_unlock(locker=self.locker)
+                await cluster.aclose()
 
         return run
 
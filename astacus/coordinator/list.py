@@ -6,14 +6,61 @@ See LICENSE for details
 from astacus.common import ipc, magic
 from astacus.common.storage import JsonStorage, MultiStorage
 from collections import defaultdict
-from collections.abc import Iterator, Mapping
+from collections.abc import Iterator, Mapping, Sequence
+from datetime import datetime
 from typing import TypeAlias
 
+import msgspec
+
 CachedStorageListEntries: TypeAlias = Mapping[str, ipc.ListSingleBackup]
 CachedListEntries: TypeAlias = Mapping[str, CachedStorageListEntries]
 
 
-def compute_deduplicated_snapshot_file_stats(manifest: ipc.BackupManifest) -> tuple[int, int]:
+class ListSnapshotFile(msgspec.Struct, kw_only=True):
+    # Subset of SnapshotFile; see it for information
+    file_size: int
+    hexdigest: str = ""
+
+
+class ListState(msgspec.Struct, kw_only=True):
+    # Subset of SnapshotState; see it for information
+    files: Sequence[ListSnapshotFile] = ()
+
+
+class ListStateColumns(msgspec.Struct, kw_only=True):
+    # Subset of SnapshotStateColumns; the other columns are skipped when decoding
+    file_sizes: Sequence[int] = ()
+    hexdigests: Sequence[str] = ()
+
+
+class ListSnapshotResult(msgspec.Struct, kw_only=True):
+    # Subset of SnapshotResult; see it for information
+    state: ListState | None = None
+    state_columns: ListStateColumns | None = None
+    files: int = 0
+    total_size: int = 0
+
+
+class ListManifest(msgspec.Struct, kw_only=True):
+    # Subset of BackupManifest; see it for information
+    start: datetime
+    end: datetime
+    attempt: int
+    snapshot_results: Sequence[ListSnapshotResult]
+    upload_results: Sequence[ipc.SnapshotUploadResult]
+    plugin: ipc.Plugin
+
+
+def _iter_hexdigests_and_sizes(snapshot_result: ipc.SnapshotResult | ListSnapshotResult) -> Iterator[tuple[str, int]]:
+    if snapshot_result.state_columns is not None:
+        yield from zip(snapshot_result.state_columns.hexdigests, snapshot_result.state_columns.file_sizes, strict=True)
+    else:
+        assert snapshot_result.state is not None
+        for snapshot_file in snapshot_result.state.files:
+            yield snapshot_file.hexdigest, snapshot_file.file_size
+
+
+def compute_deduplicated_snapshot_file_stats(manifest: ipc.BackupManifest | ListManifest) -> tuple[int, int]:
     """Compute stats over snapshot files as identified by their hex digest.
 
     There may be duplicate hex digests within nodes for multiple copies of the same data chunks.
@@ -24,12 +71,11 @@ def compute_deduplicated_snapshot_file_stats(manifest: ipc.BackupManifest) -> tu
     hexdigest_max_counts: dict[str, int] = {}
     hexdigest_sizes: dict[str, int] = {}
     for snapshot_result in manifest.snapshot_results:
-        assert snapshot_result.state is not None
         node_hexdigest_counter: defaultdict[str, int] = defaultdict(lambda: 0)
-        for snapshot_file in snapshot_result.state.files:
-            node_hexdigest_counter[snapshot_file.hexdigest] += 1
-            if snapshot_file.hexdigest not in hexdigest_sizes:
-                hexdigest_sizes[snapshot_file.hexdigest] = snapshot_file.file_size
+        for hexdigest, file_size in _iter_hexdigests_and_sizes(snapshot_result):
+            node_hexdigest_counter[hexdigest] += 1
+            if hexdigest not in hexdigest_sizes:
+                hexdigest_sizes[hexdigest] = file_size
         for hexdigest, count in node_hexdigest_counter.items():
             max_count = hexdigest_max_counts.get(hexdigest, 0)
             hexdigest_max_counts[hexdigest] = max(max_count, count)
@@ -49,7 +95,7 @@ def _iter_backups(
         if cached_entry is not None:
             yield cached_entry
             continue
-        manifest = storage.download_json(name, ipc.BackupManifest)
+        manifest = storage.download_json(name, ListManifest)
         files = sum(x.files for x in manifest.snapshot_results)
         total_size = sum(x.total_size for x in manifest.snapshot_results)
         upload_size = sum(x.total_size for x in manifest.upload_results)
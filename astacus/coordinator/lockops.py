@@ -25,6 +25,7 @@ class LockOps(CoordinatorOp):
         if result is not LockResult.ok:
             self.set_status_fail()
             await cluster.request_unlock(locker=self.locker)
+        await cluster.aclose()
 
     async def unlock(self) -> None:
         cluster = self.get_cluster()
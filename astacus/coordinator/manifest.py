@@ -2,9 +2,18 @@
 Copyright (c) 2021 Aiven Ltd
 See LICENSE for details
 """
-from astacus.common import asyncstorage, ipc
+from astacus.common import asyncstorage, exceptions, ipc, magic
+from astacus.common.cachingjsonstorage import CachingJsonStorage
+from astacus.common.limiter import gather_limited, iterate_completed_limited
+from astacus.common.storage import JsonStorage
+from collections.abc import AsyncIterator, Iterable
 from starlette.concurrency import run_in_threadpool
 
+import logging
+import msgspec
+
+logger = logging.getLogger(__name__)
+
 
 async def download_backup_manifest(json_storage: asyncstorage.AsyncJsonStorage, backup_name: str) -> ipc.BackupManifest:
     def download_manifest() -> ipc.BackupManifest:
@@ -22,5 +31,84 @@ async def download_backup_min_manifest(json_storage: asyncstorage.AsyncJsonStora
 
     manifest = await run_in_threadpool(download_min_manifest)
     assert not manifest.filename or manifest.filename == backup_name
-    manifest.filename = backup_name
-    return manifest
+    # The decoded manifest may be shared with other steps
+    return msgspec.structs.replace(manifest, filename=backup_name) if not manifest.filename else manifest
+
+
+async def download_backup_manifests(
+    json_storage: asyncstorage.AsyncJsonStorage, backup_names: Iterable[str], *, parallel: int
+) -> AsyncIterator[ipc.BackupManifest]:
+    """Download the manifests, at most parallel at a time, yielding each one as soon as it is downloaded.
+
+    The manifests can be large: callers should process each one as it comes instead of collecting them.
+    """
+    async for manifest in iterate_completed_limited(
+        parallel, (download_backup_manifest(json_storage, name) for name in backup_names)
+    ):
+        yield manifest
+
+
+async def download_backup_min_manifests(
+    json_storage: asyncstorage.AsyncJsonStorage, backup_names: Iterable[str], *, parallel: int
+) -> list[ipc.ManifestMin]:
+    """Download the minimal manifests, at most parallel at a time, in the order of backup_names."""
+    return await gather_limited(parallel, (download_backup_min_manifest(json_storage, name) for name in backup_names))
+
+
+def get_manifest_hexdigests(manifest: ipc.BackupManifest) -> set[str]:
+    hexdigests: set[str] = set()
+    for result in manifest.snapshot_results:
+        assert result.hashes is not None
+        hexdigests.update(hash_.hexdigest for hash_ in result.hashes)
+    return hexdigests
+
+
+def _uncached_json_storage(json_storage: asyncstorage.AsyncJsonStorage) -> JsonStorage:
+    # The cache assumes that the jsons are immutable, which is not true of the hexdigest index and listing:
+    # other coordinators sharing the storage replace them
+    storage = json_storage.storage
+    return storage.backend_storage if isinstance(storage, CachingJsonStorage) else storage
+
+
+async def download_hexdigest_index(json_storage: asyncstorage.AsyncJsonStorage) -> ipc.HexdigestIndex | None:
+    def download_index() -> ipc.HexdigestIndex | None:
+        try:
+            return _uncached_json_storage(json_storage).download_json(magic.JSON_HEXDIGEST_INDEX, ipc.HexdigestIndex)
+        except exceptions.NotFoundException:
+            return None
+        except msgspec.DecodeError as ex:
+            logger.warning("Ignoring invalid hexdigest index: %s", ex)
+            return None
+
+    return await run_in_threadpool(download_index)
+
+
+async def upload_hexdigest_index(json_storage: asyncstorage.AsyncJsonStorage, index: ipc.HexdigestIndex) -> None:
+    await run_in_threadpool(_uncached_json_storage(json_storage).upload_json, magic.JSON_HEXDIGEST_INDEX, index)
+
+
+async def download_hexdigest_listing(json_storage: asyncstorage.AsyncJsonStorage) -> ipc.HexdigestListing | None:
+    def download_listing() -> ipc.HexdigestListing | None:
+        try:
+            return _uncached_json_storage(json_storage).download_json(magic.JSON_HEXDIGEST_LISTING, ipc.HexdigestListing)
+        except exceptions.NotFoundException:
+            return None
+        except msgspec.DecodeError as ex:
+            logger.warning("Ignoring invalid hexdigest listing: %s", ex)
+            return None
+
+    return await run_in_threadpool(download_listing)
+
+
+async def upload_hexdigest_listing(json_storage: asyncstorage.AsyncJsonStorage, listing: ipc.HexdigestListing) -> None:
+    await run_in_threadpool(_uncached_json_storage(json_storage).upload_json, magic.JSON_HEXDIGEST_LISTING, listing)
+
+
+async def delete_hexdigest_listing(json_storage: asyncstorage.AsyncJsonStorage) -> None:
+    def delete_listing() -> None:
+        try:
+            _uncached_json_storage(json_storage).delete_json(magic.JSON_HEXDIGEST_LISTING)
+        except exceptions.NotFoundException:
+            pass
+
+    await run_in_threadpool(delete_listing)
@@ -10,20 +10,40 @@ from __future__ import annotations
 from astacus.common import exceptions, ipc, magic, utils
 from astacus.common.asyncstorage import AsyncHexDigestStorage, AsyncJsonStorage
 from astacus.common.ipc import Retention
+from astacus.common.progress import Progress
 from astacus.common.snapshot import SnapshotGroup
 from astacus.common.utils import AstacusModel
 from astacus.coordinator.cluster import Cluster, Result
 from astacus.coordinator.config import CoordinatorNode
-from astacus.coordinator.manifest import download_backup_manifest, download_backup_min_manifest
+from astacus.coordinator.manifest import (
+    delete_hexdigest_listing,
+    download_backup_manifest,
+    download_backup_manifests,
+    download_backup_min_manifests,
+    download_hexdigest_index,
+    download_hexdigest_listing,
+    get_manifest_hexdigests,
+    upload_hexdigest_index,
+    upload_hexdigest_listing,
+)
+from astacus.coordinator.upload_assignment import (
+    download_upload_history,
+    estimate_upload_costs,
+    get_sshash_to_node_indexes,
+    SIZE_COST,
+    UploadBatchScheduler,
+    UploadCost,
+)
 from collections import Counter
 from collections.abc import Sequence, Set
 from typing import Any, Counter as TCounter, Generic, TypeVar
 
+import asyncio
 import dataclasses
 import datetime
-import httpx
 import logging
 import msgspec
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +62,12 @@ class CoordinatorPlugin(AstacusModel):
         raise NotImplementedError
 
     def get_cleanup_steps(
-        self, *, context: OperationContext, retention: ipc.Retention, explicit_delete: Sequence[str]
+        self,
+        *,
+        context: OperationContext,
+        retention: ipc.Retention,
+        explicit_delete: Sequence[str],
+        rebuild_hexdigest_index: bool = False,
     ) -> Sequence[Step[Any]]:
         return [
             ListBackupsStep(json_storage=context.json_storage),
@@ -50,11 +75,20 @@ class CoordinatorPlugin(AstacusModel):
                 json_storage=context.json_storage,
                 retention=retention,
                 explicit_delete=explicit_delete,
+                download_parallel=context.manifest_download_parallel,
+            ),
+            UpdateHexdigestIndexStep(
+                json_storage=context.json_storage,
+                rebuild=rebuild_hexdigest_index,
+                max_age=context.hexdigest_index_max_age,
+                download_parallel=context.manifest_download_parallel,
             ),
             DeleteBackupManifestsStep(json_storage=context.json_storage),
             DeleteDanglingHexdigestsStep(
                 json_storage=context.json_storage,
                 hexdigest_storage=context.hexdigest_storage,
+                index_step=UpdateHexdigestIndexStep,
+                download_parallel=context.manifest_download_parallel,
             ),
         ]
 
@@ -64,6 +98,11 @@ class OperationContext:
     storage_name: str
     json_storage: AsyncJsonStorage
     hexdigest_storage: AsyncHexDigestStorage
+    manifest_download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
+    upload_history_backups: int = 0
+    upload_batch_size: int | None = None
+    hexdigest_listing_max_age: datetime.timedelta | None = None
+    hexdigest_index_max_age: datetime.timedelta | None = None
 
 
 class Step(Generic[StepResult_co]):
@@ -111,6 +150,8 @@ class SnapshotStep(Step[Sequence[ipc.SnapshotResult]]):
         start_results = await cluster.request_from_nodes(
             self.snapshot_request, method="post", caller="SnapshotStep", req=req, nodes=self.nodes_to_snapshot
         )
+        if ipc.NodeFeatures.paged_snapshot_results.value in cluster_features:
+            return await cluster.wait_successful_snapshot_results(start_results=start_results)
         return await cluster.wait_successful_results(start_results=start_results, result_class=ipc.SnapshotResult)
 
 
@@ -118,12 +159,43 @@ class SnapshotStep(Step[Sequence[ipc.SnapshotResult]]):
 class ListHexdigestsStep(Step[Set[str]]):
     """
     Fetch the list of all files already present in object storage, identified by their hexdigest.
+
+    The list is fetched only by the first attempt of the operation; later attempts reuse it,
+    as nothing is deleted from the storage while the cluster is locked by the operation. The files
+    uploaded by the failed attempts are skipped by the nodes using their upload checkpoints.
+
+    With `listing_max_age`, the hexdigest listing stored in `json_storage` is used instead of
+    listing the object storage, until the object storage was listed longer than that ago. The
+    listing is kept up to date by `UploadManifestStep` and `DeleteDanglingHexdigestsStep`; it may
+    miss some stored hexdigests of failed backups (those are uploaded again), but never has ones
+    that are not stored, nor misses ones of stored backups.
     """
 
     hexdigest_storage: AsyncHexDigestStorage
+    json_storage: AsyncJsonStorage | None = None
+    listing_max_age: datetime.timedelta | None = None
+    known_hexdigests: Set[str] | None = dataclasses.field(default=None, init=False, repr=False)
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> Set[str]:
-        return set(await self.hexdigest_storage.list_hexdigests())
+        if self.known_hexdigests is None:
+            self.known_hexdigests = await self.get_hexdigests()
+        else:
+            logger.info("Reusing the list of %d hexdigests from the previous attempt", len(self.known_hexdigests))
+        return self.known_hexdigests
+
+    async def get_hexdigests(self) -> set[str]:
+        if self.json_storage is None or self.listing_max_age is None:
+            return set(await self.hexdigest_storage.list_hexdigests())
+        listing = await download_hexdigest_listing(self.json_storage)
+        if listing is not None and utils.now() - listing.listed_at < self.listing_max_age:
+            logger.info("Using the hexdigest listing from %s", listing.listed_at)
+            return set(listing.hexdigests)
+        listed_at = utils.now()
+        hexdigests = set(await self.hexdigest_storage.list_hexdigests())
+        await upload_hexdigest_listing(
+            self.json_storage, ipc.HexdigestListing(listed_at=listed_at, hexdigests=sorted(hexdigests))
+        )
+        return hexdigests
 
 
 @dataclasses.dataclass
@@ -146,12 +218,37 @@ class UploadBlocksStep(Step[Sequence[ipc.SnapshotUploadResult]]):
     validate_file_hashes: bool = True
     upload_request: str = "upload"
     list_hexdigests_step: type[Step[Set[str]]] = ListHexdigestsStep
+    # If set, the upload results of this many latest backups in json_storage are used to
+    # estimate the upload speed of each node, to minimize the time taken by the uploads
+    json_storage: AsyncJsonStorage | None = None
+    upload_history_backups: int = 0
+    # If set, the uploads are handed to the nodes in batches of about this many bytes
+    # as they finish their previous batches, instead of all at once
+    upload_batch_size: int | None = None
+    # Shared by the uploads of all attempts, so that the nodes resume the uploads of the failed attempts
+    checkpoint_id: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex)
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> Sequence[ipc.SnapshotUploadResult]:
+        snapshots = context.get_result(SnapshotStep)
+        if self.upload_batch_size is not None:
+            scheduler = UploadBatchScheduler(
+                hexdigests=context.get_result(self.list_hexdigests_step),
+                snapshots=snapshots,
+                batch_size=self.upload_batch_size,
+            )
+            return await upload_in_batches(
+                cluster,
+                self.storage_name,
+                scheduler,
+                validate_file_hashes=self.validate_file_hashes,
+                upload_request=self.upload_request,
+                checkpoint_id=self.checkpoint_id,
+            )
         node_index_datas = build_node_index_datas(
             hexdigests=context.get_result(self.list_hexdigests_step),
-            snapshots=context.get_result(SnapshotStep),
+            snapshots=snapshots,
             node_indices=list(range(len(cluster.nodes))),
+            costs=await self.get_upload_costs(snapshots),
         )
         return await upload_node_index_datas(
             cluster,
@@ -159,8 +256,17 @@ class UploadBlocksStep(Step[Sequence[ipc.SnapshotUploadResult]]):
             node_index_datas,
             validate_file_hashes=self.validate_file_hashes,
             upload_request=self.upload_request,
+            checkpoint_id=self.checkpoint_id,
         )
 
+    async def get_upload_costs(self, snapshots: Sequence[ipc.SnapshotResult]) -> Sequence[UploadCost] | None:
+        if self.json_storage is None or self.upload_history_backups <= 0:
+            return None
+        upload_history = await download_upload_history(self.json_storage, backups=self.upload_history_backups)
+        costs = estimate_upload_costs(upload_history, [snapshot.hostname for snapshot in snapshots])
+        logger.info("Estimated upload costs: %r", costs)
+        return costs
+
 
 @dataclasses.dataclass
 class SnapshotClearStep(Step[Sequence[ipc.NodeResult]]):
@@ -219,6 +325,9 @@ class UploadManifestStep(Step[None]):
 
     The backup manifest contains the snapshot from the `SnapshotStep` as well as the
     statistics collected by the `UploadBlocksStep` and the plugin manifest.
+
+    When all nodes can read it, the snapshot states are stored with the column oriented
+    encoding, which is smaller and much faster to decode for large snapshots.
     """
 
     json_storage: AsyncJsonStorage
@@ -230,25 +339,57 @@ class UploadManifestStep(Step[None]):
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> None:
         plugin_data = context.get_result(self.plugin_manifest_step) if self.plugin_manifest_step else {}
-        manifest = msgspec.json.encode(
-            ipc.BackupManifest(
-                attempt=context.attempt,
-                start=context.attempt_start,
-                snapshot_results=context.get_result(self.snapshot_step) if self.snapshot_step else [],
-                upload_results=context.get_result(self.upload_step) if self.upload_step else [],
-                plugin=self.plugin,
-                plugin_data=plugin_data,
-            )
+        snapshot_results = context.get_result(self.snapshot_step) if self.snapshot_step else []
+        if snapshot_results and await self._nodes_support_state_columns(cluster):
+            snapshot_results = [to_state_columns(result) for result in snapshot_results]
+        manifest = ipc.BackupManifest(
+            attempt=context.attempt,
+            start=context.attempt_start,
+            snapshot_results=snapshot_results,
+            upload_results=context.get_result(self.upload_step) if self.upload_step else [],
+            plugin=self.plugin,
+            plugin_data=plugin_data,
         )
         backup_name = self._make_backup_name(context)
+        # Before the manifest is stored, as a listing missing the hexdigests of a stored backup would
+        # make the next backups upload them again
+        await self._add_to_hexdigest_listing(backup_name, manifest)
         logger.info("Storing backup manifest %s", backup_name)
-        await self.json_storage.upload_json_bytes(backup_name, manifest)
+        # The hexdigest index is not rewritten for each backup, the next cleanup adds the backups missing from it
+        await self.json_storage.upload_json_bytes(backup_name, msgspec.json.encode(manifest))
+
+    async def _nodes_support_state_columns(self, cluster: Cluster) -> bool:
+        nodes_metadata = await get_nodes_metadata(cluster)
+        return bool(nodes_metadata) and all(
+            ipc.NodeFeatures.snapshot_state_columns.value in n.features for n in nodes_metadata
+        )
+
+    async def _add_to_hexdigest_listing(self, backup_name: str, manifest: ipc.BackupManifest) -> None:
+        listing = await download_hexdigest_listing(self.json_storage)
+        if listing is None:
+            return
+        hexdigests = get_manifest_hexdigests(manifest).difference(listing.hexdigests)
+        if not hexdigests:
+            return
+        listing.hexdigests = sorted(hexdigests.union(listing.hexdigests))
+        try:
+            await upload_hexdigest_listing(self.json_storage, listing)
+        except Exception as ex:  # pylint: disable=broad-except
+            # Without a listing, the next backups list the storage; if this fails too, the manifest is not stored
+            logger.warning("Failed to add backup %s to the hexdigest listing, deleting it: %r", backup_name, ex)
+            await delete_hexdigest_listing(self.json_storage)
 
     def _make_backup_name(self, context: StepsContext) -> str:
         iso = context.attempt_start.isoformat(timespec="seconds")
         return f"{self.backup_prefix}{iso}"
 
 
+def to_state_columns(result: ipc.SnapshotResult) -> ipc.SnapshotResult:
+    if result.state is None:
+        return result
+    return msgspec.structs.replace(result, state=None, state_columns=ipc.SnapshotStateColumns.from_state(result.state))
+
+
 @dataclasses.dataclass
 class BackupNameStep(Step[str]):
     """
@@ -263,7 +404,7 @@ class BackupNameStep(Step[str]):
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> str:
         if not self.requested_name:
-            return sorted(await self.json_storage.list_jsons())[-1]
+            return sorted(b for b in await self.json_storage.list_jsons() if b.startswith(magic.JSON_BACKUP_PREFIX))[-1]
         if self.requested_name.startswith(magic.JSON_BACKUP_PREFIX):
             return self.requested_name
         return f"{magic.JSON_BACKUP_PREFIX}{self.requested_name}"
@@ -316,6 +457,8 @@ class RestoreStep(Step[Sequence[ipc.NodeResult]]):
 
     storage_name: str
     partial_restore_nodes: Sequence[ipc.PartialRestoreRequestNode] | None = None
+    # Only for plugins whose files are never modified in place
+    hardlink_duplicates: bool = False
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> Sequence[ipc.NodeResult]:
         # AZ distribution should in theory be forced to match, but in
@@ -338,21 +481,23 @@ class RestoreStep(Step[Sequence[ipc.NodeResult]]):
         for node, backup_index in zip(cluster.nodes, node_to_backup_index):
             if backup_index is not None:
                 # Restore whatever was backed up
-                snapshot_result = snapshot_results[backup_index]
-                assert snapshot_result.state is not None
+                root_globs = snapshot_results[backup_index].get_root_globs()
+                assert root_globs is not None
                 node_request: ipc.NodeRequest = ipc.SnapshotDownloadRequest(
                     storage=self.storage_name,
                     backup_name=backup_name,
                     snapshot_index=backup_index,
-                    root_globs=snapshot_result.state.root_globs,
+                    root_globs=root_globs,
+                    hardlink_duplicates=self.hardlink_duplicates,
                 )
                 op = "download"
             elif self.partial_restore_nodes:
                 # If partial restore, do not clear other nodes
                 continue
             else:
-                assert snapshot_results[0].state is not None
-                node_request = ipc.SnapshotClearRequest(root_globs=snapshot_results[0].state.root_globs)
+                root_globs = snapshot_results[0].get_root_globs()
+                assert root_globs is not None
+                node_request = ipc.SnapshotClearRequest(root_globs=root_globs)
                 op = "clear"
             start_result = await cluster.request_from_nodes(
                 op, caller="RestoreSnapshotStep", method="post", req=node_request, nodes=[node]
@@ -397,6 +542,7 @@ class DeltaManifestsStep(Step[Sequence[ipc.BackupManifest]]):
     """
 
     json_storage: AsyncJsonStorage
+    download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> Sequence[ipc.BackupManifest]:
         backup_manifest = context.get_result(BackupManifestStep)
@@ -406,11 +552,11 @@ class DeltaManifestsStep(Step[Sequence[ipc.BackupManifest]]):
         # in that scenario it makes sense to rely on backup start (because a delta might
         # finish uploading while the base is still being uploaded).
         delta_names = sorted(d for d in await self.json_storage.list_jsons() if d.startswith(magic.JSON_DELTA_PREFIX))
-        matching_delta_manifests = []
-        for delta_name in delta_names:
-            delta_manifest = await download_backup_manifest(self.json_storage, delta_name)
-            if delta_manifest.start >= backup_manifest.start:
-                matching_delta_manifests.append(delta_manifest)
+        matching_delta_manifests = [
+            m
+            async for m in download_backup_manifests(self.json_storage, delta_names, parallel=self.download_parallel)
+            if m.start >= backup_manifest.start
+        ]
         return sorted(matching_delta_manifests, key=lambda m: m.start)
 
 
@@ -481,14 +627,14 @@ class RestoreDeltasStep(Step[None]):
         reqs: list[ipc.NodeRequest] = []
         for backup_index in node_to_backup_index:
             if backup_index is not None:
-                snapshot_result = delta_manifest.snapshot_results[backup_index]
-                assert snapshot_result.state is not None
+                root_globs = delta_manifest.snapshot_results[backup_index].get_root_globs()
+                assert root_globs is not None
                 reqs.append(
                     ipc.SnapshotDownloadRequest(
                         storage=self.storage_name,
                         backup_name=delta_name,
                         snapshot_index=backup_index,
-                        root_globs=snapshot_result.state.root_globs,
+                        root_globs=root_globs,
                     )
                 )
         start_results = await cluster.request_from_nodes(
@@ -526,9 +672,9 @@ class RestoreDeltasStep(Step[None]):
         reqs: list[ipc.NodeRequest] = []
         for backup_index in node_to_backup_index:
             if backup_index is not None:
-                snapshot_result = delta_manifest.snapshot_results[backup_index]
-                assert snapshot_result.state is not None
-                reqs.append(ipc.SnapshotClearRequest(root_globs=snapshot_result.state.root_globs))
+                root_globs = delta_manifest.snapshot_results[backup_index].get_root_globs()
+                assert root_globs is not None
+                reqs.append(ipc.SnapshotClearRequest(root_globs=root_globs))
         start_results = await cluster.request_from_nodes(
             "delta/clear",
             method="post",
@@ -582,6 +728,7 @@ class ComputeKeptBackupsStep(Step[Sequence[ipc.ManifestMin]]):
     retention: Retention
     explicit_delete: Sequence[str]
     retain_deltas: bool = False
+    download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> Sequence[ipc.ManifestMin]:
         kept_manifests = await self.compute_kept_basebackups(context)
@@ -592,10 +739,9 @@ class ComputeKeptBackupsStep(Step[Sequence[ipc.ManifestMin]]):
     async def compute_kept_basebackups(self, context: StepsContext) -> list[ipc.ManifestMin]:
         all_backup_names = context.get_result(ListBackupsStep)
         kept_backup_names = all_backup_names.difference(set(self.explicit_delete))
-        manifests = []
-        for backup_name in kept_backup_names:
-            manifests.append(await download_backup_min_manifest(self.json_storage, backup_name))
-
+        manifests = await download_backup_min_manifests(
+            self.json_storage, kept_backup_names, parallel=self.download_parallel
+        )
         return _prune_manifests(manifests, self.retention)
 
     async def compute_kept_deltas(
@@ -605,13 +751,99 @@ class ComputeKeptBackupsStep(Step[Sequence[ipc.ManifestMin]]):
             return []
         all_delta_names = context.get_result(ListDeltaBackupsStep)
         oldest_kept_backup = min(kept_backups, key=lambda b: b.start)
-        kept_deltas: list[ipc.ManifestMin] = []
-        for delta_name in all_delta_names:
-            delta_manifest = await download_backup_min_manifest(self.json_storage, delta_name)
-            if delta_manifest.end < oldest_kept_backup.end:
-                continue
-            kept_deltas.append(delta_manifest)
-        return kept_deltas
+        delta_manifests = await download_backup_min_manifests(
+            self.json_storage, all_delta_names, parallel=self.download_parallel
+        )
+        return [m for m in delta_manifests if m.end >= oldest_kept_backup.end]
+
+
+@dataclasses.dataclass
+class HexdigestIndexUpdate:
+    index: ipc.HexdigestIndex
+    # None when the index was rebuilt: every stored hexdigest missing from the index is unreferenced
+    unreferenced_hexdigests: set[str] | None
+
+
+@dataclasses.dataclass
+class UpdateHexdigestIndexStep(Step[HexdigestIndexUpdate]):
+    """
+    Update the hexdigest index to count the references of the kept backups only, and return
+    the hexdigests that are no longer referenced.
+
+    Only the manifests of backups added to or removed from the index are downloaded, the
+    step must run before `DeleteBackupManifestsStep` to still find the removed ones.
+
+    The index is rebuilt from all kept manifests if it is missing, if a removed manifest is
+    gone or if `rebuild` is set, as a consistency check. It is also rebuilt when it was last
+    rebuilt longer than `max_age` ago: the stored hexdigests are then all checked against it,
+    which deletes the ones that no backup refers to, such as those uploaded by failed backups.
+    """
+
+    json_storage: AsyncJsonStorage
+    rebuild: bool = False
+    max_age: datetime.timedelta | None = None
+    download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
+
+    async def run_step(self, cluster: Cluster, context: StepsContext) -> HexdigestIndexUpdate:
+        kept_backups = {b.filename for b in context.get_result(ComputeKeptBackupsStep)}
+        index = await download_hexdigest_index(self.json_storage)
+        update = None
+        if index is not None and not self.rebuild and not self.is_expired(index):
+            update = await self.update_index(index, kept_backups)
+        if update is None:
+            rebuilt_index = await self.rebuild_index(kept_backups)
+            if index is not None and index.references != rebuilt_index.references:
+                logger.warning("hexdigest index was inconsistent with the kept backup manifests")
+            update = HexdigestIndexUpdate(index=rebuilt_index, unreferenced_hexdigests=None)
+        await upload_hexdigest_index(self.json_storage, update.index)
+        return update
+
+    async def update_index(self, index: ipc.HexdigestIndex, kept_backups: set[str]) -> HexdigestIndexUpdate | None:
+        indexed_backups = set(index.manifests)
+        references = Counter(index.references)
+        added_backups = sorted(kept_backups - indexed_backups)
+        logger.info("adding backups %r to the hexdigest index", added_backups)
+        async for manifest in download_backup_manifests(self.json_storage, added_backups, parallel=self.download_parallel):
+            references.update(get_manifest_hexdigests(manifest))
+        removed_backups = sorted(indexed_backups - kept_backups)
+        logger.info("removing backups %r from the hexdigest index", removed_backups)
+        unreferenced_hexdigests = set()
+        try:
+            async for manifest in download_backup_manifests(
+                self.json_storage, removed_backups, parallel=self.download_parallel
+            ):
+                for hexdigest in get_manifest_hexdigests(manifest):
+                    references[hexdigest] -= 1
+                    if references[hexdigest] <= 0:
+                        del references[hexdigest]
+                        unreferenced_hexdigests.add(hexdigest)
+        except exceptions.NotFoundException:
+            logger.warning("removed backup manifest not found, rebuilding the hexdigest index")
+            return None
+        return HexdigestIndexUpdate(
+            index=ipc.HexdigestIndex(
+                manifests=sorted(kept_backups), references=dict(references), rebuilt_at=index.rebuilt_at
+            ),
+            unreferenced_hexdigests=unreferenced_hexdigests,
+        )
+
+    def is_expired(self, index: ipc.HexdigestIndex) -> bool:
+        if self.max_age is None:
+            return False
+        if index.rebuilt_at is None or utils.now() - index.rebuilt_at >= self.max_age:
+            logger.info("hexdigest index was last rebuilt at %s, rebuilding it", index.rebuilt_at)
+            return True
+        return False
+
+    async def rebuild_index(self, kept_backups: set[str]) -> ipc.HexdigestIndex:
+        logger.info("rebuilding the hexdigest index from %d backup manifests", len(kept_backups))
+        rebuilt_at = utils.now()
+        references: TCounter[str] = Counter()
+        async for manifest in download_backup_manifests(
+            self.json_storage, sorted(kept_backups), parallel=self.download_parallel
+        ):
+            references.update(get_manifest_hexdigests(manifest))
+        return ipc.HexdigestIndex(manifests=sorted(kept_backups), references=dict(references), rebuilt_at=rebuilt_at)
 
 
 @dataclasses.dataclass
@@ -645,29 +877,57 @@ class DeleteBackupAndDeltaManifestsStep(DeleteBackupManifestsStep):
 class DeleteDanglingHexdigestsStep(Step[None]):
     """
     Delete all hexdigests that are not referenced by backup manifests.
+
+    With an `index_step`, only the hexdigests it found newly unreferenced are deleted, unless
+    the index was rebuilt: then all stored hexdigests are listed and checked against the index.
+    Without, all stored hexdigests are checked against all kept backup manifests.
+
+    If there is a hexdigest listing (see `ListHexdigestsStep`), the deleted hexdigests are
+    removed from it before they are deleted, and it is refreshed when the storage was listed.
     """
 
     hexdigest_storage: AsyncHexDigestStorage
     json_storage: AsyncJsonStorage
+    index_step: type[Step[HexdigestIndexUpdate]] | None = None
+    download_parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
 
     async def run_step(self, cluster: Cluster, context: StepsContext) -> None:
-        kept_manifests = context.get_result(ComputeKeptBackupsStep)
-        logger.info("listing extra hexdigests")
-        extra_hexdigests = set(await self.hexdigest_storage.list_hexdigests())
-        for manifest_min in kept_manifests:
-            manifest = await download_backup_manifest(self.json_storage, manifest_min.filename)
-            for result in manifest.snapshot_results:
-                assert result.hashes is not None
-                for hash_ in result.hashes:
-                    extra_hexdigests.discard(hash_.hexdigest)
+        index_update = context.get_result(self.index_step) if self.index_step is not None else None
+        listing = await download_hexdigest_listing(self.json_storage)
+        if index_update is not None and index_update.unreferenced_hexdigests is not None:
+            extra_hexdigests = index_update.unreferenced_hexdigests
+            if listing is not None and extra_hexdigests.isdisjoint(listing.hexdigests):
+                listing = None
+            elif listing is not None:
+                listing.hexdigests = sorted(set(listing.hexdigests).difference(extra_hexdigests))
+        else:
+            logger.info("listing extra hexdigests")
+            listed_at = utils.now()
+            stored_hexdigests = set(await self.hexdigest_storage.list_hexdigests())
+            extra_hexdigests = set(stored_hexdigests)
+            if index_update is not None:
+                extra_hexdigests.difference_update(index_update.index.references)
+            else:
+                kept_backups = [m.filename for m in context.get_result(ComputeKeptBackupsStep)]
+                async for manifest in download_backup_manifests(
+                    self.json_storage, kept_backups, parallel=self.download_parallel
+                ):
+                    extra_hexdigests.difference_update(get_manifest_hexdigests(manifest))
+            if listing is not None:
+                # Refreshed while at it, as the storage was listed anyway
+                listing = ipc.HexdigestListing(listed_at=listed_at, hexdigests=sorted(stored_hexdigests - extra_hexdigests))
+        # The hexdigests must be gone from the listing before they are gone from the storage
+        if listing is not None:
+            await upload_hexdigest_listing(self.json_storage, listing)
         logger.info("deleting %d hexdigests from object storage", len(extra_hexdigests))
-        for i, hexdigest in enumerate(extra_hexdigests, 1):
-            # Due to rate limiting, it might be better to not do this in parallel
-            await self.hexdigest_storage.delete_hexdigest(hexdigest)
+
+        def _progress(i: int) -> None:
             if i % 100 == 0 and cluster.stats is not None:
                 cluster.stats.gauge("astacus_cleanup_hexdigest_progress", i)
                 cluster.stats.gauge("astacus_cleanup_hexdigest_progress_percent", 100.0 * i / len(extra_hexdigests))
 
+        await self.hexdigest_storage.delete_hexdigests(sorted(extra_hexdigests), progress_callback=_progress)
+
 
 def get_node_to_backup_index(
     *,
@@ -783,50 +1043,73 @@ class NodeIndexData(msgspec.Struct, kw_only=True):
 
 
 def build_node_index_datas(
-    *, hexdigests: Set[str], snapshots: Sequence[ipc.SnapshotResult], node_indices: Sequence[int]
+    *,
+    hexdigests: Set[str],
+    snapshots: Sequence[ipc.SnapshotResult],
+    node_indices: Sequence[int],
+    costs: Sequence[UploadCost] | None = None,
 ) -> Sequence[NodeIndexData]:
-    assert len(snapshots) == len(node_indices)
-    sshash_to_node_indexes: dict[ipc.SnapshotHash, list[int]] = {}
-    for i, snapshot_result in enumerate(snapshots):
-        for snapshot_hash in snapshot_result.hashes or []:
-            sshash_to_node_indexes.setdefault(snapshot_hash, []).append(i)
+    """Assign each hexdigest to be uploaded by one of the nodes having it.
 
+    The uploads are assigned to the node expected to finish them first,
+    according to the upload cost of each node; without costs, the uploaded
+    bytes are balanced across the nodes.
+    """
+    assert len(snapshots) == len(node_indices)
+    if costs is None:
+        costs = [SIZE_COST] * len(snapshots)
+    assert len(costs) == len(snapshots)
     node_index_datas = [NodeIndexData(node_index=node_index) for node_index in node_indices]
+    expected_seconds = [0.0] * len(node_index_datas)
 
     # This is not really optimal algorithm, but probably good enough.
 
     # Allocate the things based on first off, how often they show
-    # up (the least common first), and then reverse size order, to least loaded node.
-    def _sshash_to_node_indexes_key(item):
-        (sshash, indexes) = item
-        return len(indexes), -sshash.size
-
-    todo = sorted(sshash_to_node_indexes.items(), key=_sshash_to_node_indexes_key)
-    for snapshot_hash, node_indexes in todo:
-        if snapshot_hash.hexdigest in hexdigests:
-            continue
-        _, node_index = min((node_index_datas[node_index].total_size, node_index) for node_index in node_indexes)
+    # up (the least common first), and then reverse size order, to the
+    # node which would be done with it first.
+    for snapshot_hash, node_indexes in get_sshash_to_node_indexes(hexdigests=hexdigests, snapshots=snapshots):
+        _, node_index = min(
+            (expected_seconds[node_index] + costs[node_index].estimate(size=snapshot_hash.size), node_index)
+            for node_index in node_indexes
+        )
+        expected_seconds[node_index] += costs[node_index].estimate(size=snapshot_hash.size)
         node_index_datas[node_index].append_sshash(snapshot_hash)
     return [data for data in node_index_datas if data.sshashes]
 
 
+def create_upload_request(
+    node_metadata: ipc.MetadataResult,
+    sshashes: list[ipc.SnapshotHash],
+    storage_name: str,
+    validate_file_hashes: bool,
+    checkpoint_id: str = "",
+) -> ipc.NodeRequest:
+    if checkpoint_id and ipc.NodeFeatures.upload_checkpoints.value in node_metadata.features:
+        return ipc.SnapshotUploadRequestV20261018(
+            hashes=sshashes, storage=storage_name, validate_file_hashes=validate_file_hashes, checkpoint_id=checkpoint_id
+        )
+    if ipc.NodeFeatures.validate_file_hashes.value in node_metadata.features:
+        return ipc.SnapshotUploadRequestV20221129(
+            hashes=sshashes, storage=storage_name, validate_file_hashes=validate_file_hashes
+        )
+    return ipc.SnapshotUploadRequest(hashes=sshashes, storage=storage_name)
+
+
 async def upload_node_index_datas(
     cluster: Cluster,
     storage_name: str,
     node_index_datas: Sequence[NodeIndexData],
     validate_file_hashes: bool,
     upload_request: str,
+    checkpoint_id: str = "",
 ):
     logger.info("upload_node_index_datas")
     start_results: list[Result | None] = []
     nodes_metadata = await get_nodes_metadata(cluster)
     for data in node_index_datas:
-        if ipc.NodeFeatures.validate_file_hashes.value in nodes_metadata[data.node_index].features:
-            req: ipc.NodeRequest = ipc.SnapshotUploadRequestV20221129(
-                hashes=data.sshashes, storage=storage_name, validate_file_hashes=validate_file_hashes
-            )
-        else:
-            req = ipc.SnapshotUploadRequest(hashes=data.sshashes, storage=storage_name)
+        req = create_upload_request(
+            nodes_metadata[data.node_index], data.sshashes, storage_name, validate_file_hashes, checkpoint_id
+        )
         start_result = await cluster.request_from_nodes(
             upload_request, caller="upload_node_index_datas", method="post", req=req, nodes=[cluster.nodes[data.node_index]]
         )
@@ -836,15 +1119,68 @@ async def upload_node_index_datas(
     return await cluster.wait_successful_results(start_results=start_results, result_class=ipc.SnapshotUploadResult)
 
 
+async def upload_in_batches(
+    cluster: Cluster,
+    storage_name: str,
+    scheduler: UploadBatchScheduler,
+    validate_file_hashes: bool,
+    upload_request: str,
+    checkpoint_id: str = "",
+) -> Sequence[ipc.SnapshotUploadResult]:
+    """Upload the batches handed out by the scheduler, each node uploading one batch at a time."""
+    logger.info("upload_in_batches")
+    nodes_metadata = await get_nodes_metadata(cluster)
+    node_results: list[list[ipc.SnapshotUploadResult]] = [[] for _ in cluster.nodes]
+    # The progress of the concurrent waits on the nodes is not meaningful
+    # as such, so the progress of the whole step is reported per batch instead
+    progress_handler = cluster.progress_handler
+    cluster.set_progress_handler(None)
+
+    def _report_progress() -> None:
+        if progress_handler is not None:
+            progress = Progress.merge(result.progress for results in node_results for result in results)
+            progress_handler(Progress(handled=progress.handled, failed=progress.failed, total=scheduler.total))
+
+    async def _upload_on_node(node_index: int) -> None:
+        while batch := scheduler.next_batch(node_index):
+            req = create_upload_request(nodes_metadata[node_index], batch, storage_name, validate_file_hashes, checkpoint_id)
+            start_results = await cluster.request_from_nodes(
+                upload_request, caller="upload_in_batches", method="post", req=req, nodes=[cluster.nodes[node_index]]
+            )
+            if len(start_results) != 1:
+                raise StepFailedError("upload failed")
+            results = await cluster.wait_successful_results(
+                start_results=start_results, result_class=ipc.SnapshotUploadResult
+            )
+            node_results[node_index].extend(results)
+            _report_progress()
+
+    tasks = [asyncio.create_task(_upload_on_node(node_index)) for node_index in range(len(cluster.nodes))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        cluster.set_progress_handler(progress_handler)
+    return [merge_upload_results(results) for results in node_results if results]
+
+
+def merge_upload_results(results: Sequence[ipc.SnapshotUploadResult]) -> ipc.SnapshotUploadResult:
+    starts = [result.start for result in results]
+    ends = [result.end for result in results]
+    return ipc.SnapshotUploadResult(
+        hostname=results[0].hostname,
+        az=results[0].az,
+        progress=Progress.merge(result.progress for result in results),
+        total_size=sum(result.total_size for result in results),
+        total_stored_size=sum(result.total_stored_size for result in results),
+        start=None if None in starts else min(start for start in starts if start is not None),
+        end=None if None in ends else max(end for end in ends if end is not None),
+    )
+
+
 async def get_nodes_metadata(
     cluster: Cluster, *, nodes: Sequence[CoordinatorNode] | None = None
 ) -> list[ipc.MetadataResult]:
-    metadata_responses: Sequence[httpx.Response | None] = await cluster.request_from_nodes(
-        "metadata", caller="get_nodes_metadata", method="get", nodes=nodes, json=False
-    )
-    return [
-        ipc.MetadataResult(version="", features=[])
-        if response is None
-        else msgspec.json.decode(response.content, type=ipc.MetadataResult)
-        for response in metadata_responses
-    ]
+    return await cluster.get_nodes_metadata(nodes=nodes)
@@ -90,8 +90,17 @@ class CassandraPlugin(CoordinatorPlugin):
             CassandraSubOpStep(op=ipc.CassandraSubOp.take_snapshot),
             backup_steps.AssertSchemaUnchanged(),
             base.SnapshotStep(snapshot_groups=snapshot_groups()),
-            base.ListHexdigestsStep(hexdigest_storage=context.hexdigest_storage),
-            base.UploadBlocksStep(storage_name=context.storage_name),
+            base.ListHexdigestsStep(
+                hexdigest_storage=context.hexdigest_storage,
+                json_storage=context.json_storage,
+                listing_max_age=context.hexdigest_listing_max_age,
+            ),
+            base.UploadBlocksStep(
+                storage_name=context.storage_name,
+                json_storage=context.json_storage,
+                upload_history_backups=context.upload_history_backups,
+                upload_batch_size=context.upload_batch_size,
+            ),
             CassandraSubOpStep(op=ipc.CassandraSubOp.remove_snapshot),
             base.SnapshotReleaseStep(),
             base.UploadManifestStep(
@@ -159,9 +168,14 @@ class CassandraPlugin(CoordinatorPlugin):
         )
 
         return [
-            base.RestoreStep(storage_name=context.storage_name, partial_restore_nodes=req.partial_restore_nodes),
+            base.RestoreStep(
+                storage_name=context.storage_name,
+                partial_restore_nodes=req.partial_restore_nodes,
+                # SSTables are immutable
+                hardlink_duplicates=True,
+            ),
             CassandraRestoreSubOpStep(op=ipc.CassandraSubOp.restore_sstables, req=restore_sstables_req),
-            base.DeltaManifestsStep(json_storage=context.json_storage),
+            base.DeltaManifestsStep(json_storage=context.json_storage, download_parallel=context.manifest_download_parallel),
             restore_steps.RestoreCassandraDeltasStep(
                 json_storage=context.json_storage,
                 storage_name=context.storage_name,
@@ -201,7 +215,12 @@ class CassandraPlugin(CoordinatorPlugin):
             # because once we've created our own system_schema keyspace and written data to it,
             # we've started a new sequence of sstables that might clash with the sequence from the node
             # we took the backup from (e.g. the old node had nb-1, the new node has nb-1, unclear how to proceed).
-            base.RestoreStep(storage_name=context.storage_name, partial_restore_nodes=req.partial_restore_nodes),
+            base.RestoreStep(
+                storage_name=context.storage_name,
+                partial_restore_nodes=req.partial_restore_nodes,
+                # SSTables are immutable
+                hardlink_duplicates=True,
+            ),
             CassandraRestoreSubOpStep(op=ipc.CassandraSubOp.restore_sstables, req=restore_sstables_req),
             # restart cassandra and do the final actions with data available
             # not configuring tokens here, because we've already bootstrapped the ring when restoring schema
@@ -211,7 +230,12 @@ class CassandraPlugin(CoordinatorPlugin):
         ]
 
     def get_cleanup_steps(
-        self, *, context: OperationContext, retention: ipc.Retention, explicit_delete: Sequence[str]
+        self,
+        *,
+        context: OperationContext,
+        retention: ipc.Retention,
+        explicit_delete: Sequence[str],
+        rebuild_hexdigest_index: bool = False,
     ) -> Sequence[Step[Any]]:
         return [
             base.ListBackupsStep(json_storage=context.json_storage),
@@ -221,10 +245,19 @@ class CassandraPlugin(CoordinatorPlugin):
                 retention=retention,
                 explicit_delete=explicit_delete,
                 retain_deltas=True,
+                download_parallel=context.manifest_download_parallel,
+            ),
+            base.UpdateHexdigestIndexStep(
+                json_storage=context.json_storage,
+                rebuild=rebuild_hexdigest_index,
+                max_age=context.hexdigest_index_max_age,
+                download_parallel=context.manifest_download_parallel,
             ),
             base.DeleteBackupAndDeltaManifestsStep(json_storage=context.json_storage),
             base.DeleteDanglingHexdigestsStep(
                 json_storage=context.json_storage,
                 hexdigest_storage=context.hexdigest_storage,
+                index_step=base.UpdateHexdigestIndexStep,
+                download_parallel=context.manifest_download_parallel,
             ),
         ]
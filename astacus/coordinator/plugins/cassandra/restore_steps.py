@@ -121,6 +121,8 @@ class UploadFinalDeltaStep(Step[Sequence[ipc.BackupManifest]]):
         start_results = await cluster.request_from_nodes(
             "delta/snapshot", method="post", caller="UploadFinalDeltaStep", req=req, nodes=[node]
         )
+        if ipc.NodeFeatures.paged_snapshot_results.value in node_features:
+            return await cluster.wait_successful_snapshot_results(start_results=start_results)
         return await cluster.wait_successful_results(start_results=start_results, result_class=ipc.SnapshotResult)
 
     async def upload_delta(
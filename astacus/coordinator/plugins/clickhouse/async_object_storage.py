@@ -3,10 +3,14 @@ Copyright (c) 2023 Aiven Ltd
 See LICENSE for details
 """
 from abc import ABC, abstractmethod
-from astacus.common.rohmustorage import RohmuStorageConfig
-from collections.abc import Iterator, Mapping, Sequence
+from astacus.common import magic
+from astacus.common.asyncstorage import delete_in_batches
+from astacus.common.limiter import iterate_completed_limited
+from astacus.common.rohmustorage import RohmuStorageConfig, transfer_supports_bulk_delete
+from collections.abc import AsyncIterator, Iterator, Mapping, Sequence
 from rohmu import BaseTransfer
 from rohmu.errors import FileNotFoundFromStorageError
+from rohmu.object_storage.base import KEY_TYPE_OBJECT, KEY_TYPE_PREFIX
 from starlette.concurrency import run_in_threadpool
 from typing import Any, Self
 
@@ -35,10 +39,19 @@ class AsyncObjectStorage(ABC):
     async def list_items(self) -> list[ObjectStorageItem]:
         ...
 
+    async def iter_items(self) -> AsyncIterator[ObjectStorageItem]:
+        """Yield the same items as list_items, possibly before all of them are listed."""
+        for item in await self.list_items():
+            yield item
+
     @abstractmethod
     async def delete_item(self, key: str) -> None:
         ...
 
+    async def delete_items(self, keys: Sequence[str]) -> None:
+        for key in keys:
+            await self.delete_item(key)
+
     @abstractmethod
     async def copy_items_from(self, source: "AsyncObjectStorage", keys: Sequence[str]) -> None:
         ...
@@ -49,15 +62,48 @@ class ThreadSafeRohmuStorage:
         self.config = config
         self._storage = rohmu.get_transfer_from_model(config)
         self._storage_lock = threading.Lock()
+        self._thread_transfers = threading.local()
 
     def list_iter(self, key: str, *, with_metadata: bool = True, deep: bool = False) -> Iterator[Mapping[str, Any]]:
         with self._storage_lock:
             return self._storage.list_iter(key, with_metadata=with_metadata, deep=deep)
 
+    def list_objects_and_prefixes(self, key: str) -> tuple[list[Mapping[str, Any]], list[str]]:
+        """List the objects directly under key, and the prefixes ("directories") of the deeper ones."""
+        objects: list[Mapping[str, Any]] = []
+        prefixes: list[str] = []
+        with self._storage_lock:
+            for item in self._storage.iter_key(key, with_metadata=False):
+                if item.type == KEY_TYPE_OBJECT:
+                    assert isinstance(item.value, dict)
+                    objects.append(item.value)
+                elif item.type == KEY_TYPE_PREFIX:
+                    assert isinstance(item.value, str)
+                    prefixes.append(item.value)
+        return objects, prefixes
+
+    def list_path_concurrently(self, key: str, *, deep: bool = False) -> list[dict[str, Any]]:
+        # With the transfer of the calling thread, which is not shared by the threads listing other paths
+        return self._get_thread_transfer().list_path(key, with_metadata=False, deep=deep)
+
+    def _get_thread_transfer(self) -> BaseTransfer[Any]:
+        transfer = getattr(self._thread_transfers, "transfer", None)
+        if transfer is None:
+            transfer = rohmu.get_transfer_from_model(self.config)
+            self._thread_transfers.transfer = transfer
+        return transfer
+
     def delete_key(self, key: str) -> None:
         with self._storage_lock:
             self._storage.delete_key(key)
 
+    def delete_keys(self, keys: Sequence[str]) -> None:
+        with self._storage_lock:
+            self._storage.delete_keys(keys)
+
+    def supports_bulk_delete(self) -> bool:
+        return transfer_supports_bulk_delete(self._storage)
+
     def copy_items_from(self, source: "ThreadSafeRohmuStorage", keys: Sequence[str]) -> None:
         # In theory this could deadlock if some other place was locking the same two storages
         # in the reverse order at the same time. Within the context of backups and restore,
@@ -76,17 +122,37 @@ class ThreadSafeRohmuStorage:
 @dataclasses.dataclass(frozen=True)
 class RohmuAsyncObjectStorage(AsyncObjectStorage):
     storage: ThreadSafeRohmuStorage
+    # How many of the top level prefixes are listed concurrently
+    list_parallel: int = magic.DEFAULT_LIST_PARALLEL
 
     def get_config(self) -> RohmuStorageConfig:
         return self.storage.config
 
     async def list_items(self) -> list[ObjectStorageItem]:
-        items = await run_in_threadpool(self.storage.list_iter, key="", with_metadata=True, deep=True)
-        return [ObjectStorageItem(key=item["name"], last_modified=item["last_modified"]) for item in items]
+        return [item async for item in self.iter_items()]
+
+    async def iter_items(self) -> AsyncIterator[ObjectStorageItem]:
+        # The objects of each top level prefix are listed concurrently, and yielded as each prefix is done
+        objects, prefixes = await run_in_threadpool(self.storage.list_objects_and_prefixes, "")
+        for item in objects:
+            yield ObjectStorageItem(key=item["name"], last_modified=item["last_modified"])
+        async for prefix_objects in iterate_completed_limited(
+            self.list_parallel,
+            (run_in_threadpool(self.storage.list_path_concurrently, prefix, deep=True) for prefix in prefixes),
+        ):
+            for item in prefix_objects:
+                yield ObjectStorageItem(key=item["name"], last_modified=item["last_modified"])
 
     async def delete_item(self, key: str) -> None:
         await run_in_threadpool(self.storage.delete_key, key)
 
+    async def delete_items(self, keys: Sequence[str]) -> None:
+        if not self.storage.supports_bulk_delete():
+            # Access to the storage is serialized anyway, deleting concurrently would not help
+            await super().delete_items(keys)
+            return
+        await delete_in_batches(keys, delete_batch=lambda batch: run_in_threadpool(self.storage.delete_keys, batch))
+
     async def copy_items_from(self, source: "AsyncObjectStorage", keys: Sequence[str]) -> None:
         if not isinstance(source, RohmuAsyncObjectStorage):
             raise NotImplementedError("Copying items is only supported from another RohmuAsyncObjectStorage")
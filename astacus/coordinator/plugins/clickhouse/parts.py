@@ -67,8 +67,9 @@ def list_parts_to_attach(
     Returns a list of table identifiers and part names to attach from the snapshot.
     """
     parts_to_attach: set[tuple[str, bytes]] = set()
-    assert snapshot_result.state is not None
-    for snapshot_file in snapshot_result.state.files:
+    state = snapshot_result.get_state()
+    assert state is not None
+    for snapshot_file in state.files:
         parsed_path = disks.parse_part_file_path(snapshot_file.relative_path)
         table = tables_by_uuid.get(parsed_path.table_uuid)
         if table is not None:
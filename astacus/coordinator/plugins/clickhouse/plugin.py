@@ -49,6 +49,7 @@ from astacus.coordinator.plugins.base import (
     RestoreStep,
     SnapshotStep,
     Step,
+    UpdateHexdigestIndexStep,
     UploadBlocksStep,
     UploadManifestStep,
 )
@@ -124,8 +125,18 @@ class ClickHousePlugin(CoordinatorPlugin):
             SnapshotStep(
                 snapshot_groups=disks.get_snapshot_groups(self.freeze_name),
             ),
-            ListHexdigestsStep(hexdigest_storage=context.hexdigest_storage),
-            UploadBlocksStep(storage_name=context.storage_name, validate_file_hashes=False),
+            ListHexdigestsStep(
+                hexdigest_storage=context.hexdigest_storage,
+                json_storage=context.json_storage,
+                listing_max_age=context.hexdigest_listing_max_age,
+            ),
+            UploadBlocksStep(
+                storage_name=context.storage_name,
+                validate_file_hashes=False,
+                json_storage=context.json_storage,
+                upload_history_backups=context.upload_history_backups,
+                upload_batch_size=context.upload_batch_size,
+            ),
             # Cleanup frozen parts
             UnfreezeTablesStep(
                 clients=clickhouse_clients, freeze_name=self.freeze_name, freeze_unfreeze_timeout=self.unfreeze_timeout
@@ -179,7 +190,12 @@ class ClickHousePlugin(CoordinatorPlugin):
                 sync_timeout=self.sync_databases_timeout,
             ),
             MapNodesStep(partial_restore_nodes=req.partial_restore_nodes),
-            RestoreStep(storage_name=context.storage_name, partial_restore_nodes=req.partial_restore_nodes),
+            RestoreStep(
+                storage_name=context.storage_name,
+                partial_restore_nodes=req.partial_restore_nodes,
+                # Parts are immutable
+                hardlink_duplicates=True,
+            ),
             RestoreObjectStorageFilesStep(source_disks=source_disks, target_disks=disks),
             AttachMergeTreePartsStep(
                 clients=clients,
@@ -208,7 +224,12 @@ class ClickHousePlugin(CoordinatorPlugin):
         ]
 
     def get_cleanup_steps(
-        self, *, context: OperationContext, retention: Retention, explicit_delete: Sequence[str]
+        self,
+        *,
+        context: OperationContext,
+        retention: Retention,
+        explicit_delete: Sequence[str],
+        rebuild_hexdigest_index: bool = False,
     ) -> Sequence[Step[Any]]:
         disks = Disks.from_disk_configs(self.disks)
         return [
@@ -217,11 +238,20 @@ class ClickHousePlugin(CoordinatorPlugin):
                 json_storage=context.json_storage,
                 retention=retention,
                 explicit_delete=explicit_delete,
+                download_parallel=context.manifest_download_parallel,
+            ),
+            UpdateHexdigestIndexStep(
+                json_storage=context.json_storage,
+                rebuild=rebuild_hexdigest_index,
+                max_age=context.hexdigest_index_max_age,
+                download_parallel=context.manifest_download_parallel,
             ),
             DeleteBackupManifestsStep(json_storage=context.json_storage),
             DeleteDanglingHexdigestsStep(
                 json_storage=context.json_storage,
                 hexdigest_storage=context.hexdigest_storage,
+                index_step=UpdateHexdigestIndexStep,
+                download_parallel=context.manifest_download_parallel,
             ),
             DeleteDanglingObjectStorageFilesStep(disks=disks, json_storage=context.json_storage),
         ]
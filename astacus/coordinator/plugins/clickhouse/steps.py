@@ -810,24 +810,21 @@ class DeleteDanglingObjectStorageFilesStep(Step[None]):
                 raise StepFailedError(f"Could not find object storage disk named {disk_name!r}")
             keys_to_remove = []
             logger.info("found %d object storage files to keep in disk %r", len(disk_kept_paths), disk_name)
-            disk_object_storage_items = await disk_object_storage.list_items()
-            for item in disk_object_storage_items:
+            disk_available_paths = set()
+            async for item in disk_object_storage.iter_items():
+                disk_available_paths.add(item.key)
                 # We don't know if objects newer than the latest backup should be kept or not,
                 # so we leave them for now. We'll delete them if necessary once there is a newer
                 # backup to tell us if they are still used or not.
                 if item.last_modified < newest_backup_start_time and item.key not in disk_kept_paths:
                     logger.debug("dangling object storage file in disk %r : %r", disk_name, item.key)
                     keys_to_remove.append(item.key)
-            disk_available_paths = [item.key for item in disk_object_storage_items]
             for disk_kept_path in disk_kept_paths:
                 if disk_kept_path not in disk_available_paths:
                     # Make sure the non-deleted files are actually in object storage
                     raise StepFailedError(f"missing object storage file in disk {disk_name!r}: {disk_kept_path!r}")
             logger.info("found %d object storage files to remove in disk %r", len(keys_to_remove), disk_name)
-            for key_to_remove in keys_to_remove:
-                # We should really have a batch delete operation there, but it's missing from rohmu
-                logger.debug("deleting object storage file in disk %r : %r", disk_name, key_to_remove)
-                await disk_object_storage.delete_item(key_to_remove)
+            await disk_object_storage.delete_items(keys_to_remove)
 
 
 @dataclasses.dataclass
@@ -37,12 +37,26 @@ from typing import Any
 class FilesPlugin(CoordinatorPlugin):
     # list of globs, e.g. ["**/*.dat"] we want to back up from root
     root_globs: Sequence[str]
+    # If set, files larger than this are backed up in chunks of this size,
+    # so that only the changed chunks of modified files are uploaded again
+    chunk_size: int | None = None
 
     def get_backup_steps(self, *, context: OperationContext) -> Sequence[Step[Any]]:
         return [
-            SnapshotStep(snapshot_groups=[SnapshotGroup(root_glob) for root_glob in self.root_globs]),
-            ListHexdigestsStep(hexdigest_storage=context.hexdigest_storage),
-            UploadBlocksStep(storage_name=context.storage_name),
+            SnapshotStep(
+                snapshot_groups=[SnapshotGroup(root_glob, chunk_size=self.chunk_size) for root_glob in self.root_globs]
+            ),
+            ListHexdigestsStep(
+                hexdigest_storage=context.hexdigest_storage,
+                json_storage=context.json_storage,
+                listing_max_age=context.hexdigest_listing_max_age,
+            ),
+            UploadBlocksStep(
+                storage_name=context.storage_name,
+                json_storage=context.json_storage,
+                upload_history_backups=context.upload_history_backups,
+                upload_batch_size=context.upload_batch_size,
+            ),
             UploadManifestStep(json_storage=context.json_storage, plugin=Plugin.files),
         ]
 
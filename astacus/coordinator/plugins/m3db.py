@@ -51,6 +51,9 @@ class M3DBPlugin(CoordinatorPlugin):
     etcd_url: str
     environment: str
     placement_nodes: Sequence[m3placement.M3PlacementNode]
+    # If set, fileset files larger than this are backed up in chunks of this
+    # size, so that only the changed chunks are uploaded again
+    chunk_size: int | None = None
 
     def get_backup_steps(self, *, context: OperationContext) -> Sequence[Step[Any]]:
         etcd_client = ETCDClient(self.etcd_url)
@@ -58,9 +61,18 @@ class M3DBPlugin(CoordinatorPlugin):
         return [
             InitStep(placement_nodes=self.placement_nodes),
             RetrieveEtcdStep(etcd_client=etcd_client, etcd_prefixes=etcd_prefixes),
-            SnapshotStep(snapshot_groups=[SnapshotGroup(root_glob="**/*.db")]),
-            ListHexdigestsStep(hexdigest_storage=context.hexdigest_storage),
-            UploadBlocksStep(storage_name=context.storage_name),
+            SnapshotStep(snapshot_groups=[SnapshotGroup(root_glob="**/*.db", chunk_size=self.chunk_size)]),
+            ListHexdigestsStep(
+                hexdigest_storage=context.hexdigest_storage,
+                json_storage=context.json_storage,
+                listing_max_age=context.hexdigest_listing_max_age,
+            ),
+            UploadBlocksStep(
+                storage_name=context.storage_name,
+                json_storage=context.json_storage,
+                upload_history_backups=context.upload_history_backups,
+                upload_batch_size=context.upload_batch_size,
+            ),
             RetrieveEtcdAgainStep(etcd_client=etcd_client, etcd_prefixes=etcd_prefixes),
             PrepareM3ManifestStep(placement_nodes=self.placement_nodes),
             # upload backup manifest only after we've retrieved again etcd
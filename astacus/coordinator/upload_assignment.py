@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+
+Estimation of how long uploads take on each node, used to assign the
+uploads of a backup to the nodes.
+
+The expected upload time of a node is modelled as a per-byte cost (the
+bandwidth) plus a per-file cost (the overhead of each object), fitted
+from the upload results stored in the manifests of the previous backups.
+
+"""
+from astacus.common import asyncstorage, ipc, magic
+from astacus.common.limiter import gather_limited
+from collections.abc import Iterable, Sequence, Set
+from starlette.concurrency import run_in_threadpool
+
+import msgspec
+
+
+class UploadCost(msgspec.Struct, frozen=True, kw_only=True):
+    seconds_per_byte: float
+    seconds_per_file: float = 0.0
+
+    def estimate(self, *, size: int, files: int = 1) -> float:
+        return self.seconds_per_byte * size + self.seconds_per_file * files
+
+
+# Without any history, the uploaded bytes are balanced across the nodes
+SIZE_COST = UploadCost(seconds_per_byte=1.0)
+
+
+class UploadSample(msgspec.Struct, frozen=True, kw_only=True):
+    size: int
+    files: int
+    seconds: float
+
+
+class UploadHistoryManifest(msgspec.Struct, kw_only=True):
+    # Subset of BackupManifest
+    upload_results: Sequence[ipc.SnapshotUploadResult]
+
+
+def get_upload_sample(result: ipc.SnapshotUploadResult) -> UploadSample | None:
+    if result.start is None or result.end is None or not result.progress.finished_successfully:
+        return None
+    seconds = (result.end - result.start).total_seconds()
+    if seconds <= 0 or not result.progress.total:
+        return None
+    return UploadSample(size=result.total_size, files=result.progress.total, seconds=seconds)
+
+
+def fit_upload_cost(samples: Sequence[UploadSample]) -> UploadCost | None:
+    """Least squares fit of seconds = seconds_per_byte * size + seconds_per_file * files.
+
+    If the samples do not tell the two costs apart (or the fit would make
+    one of them negative), all of the time is attributed to the bytes.
+    """
+    if not samples:
+        return None
+    sbb = sum(float(s.size) * s.size for s in samples)
+    sff = sum(float(s.files) * s.files for s in samples)
+    sbf = sum(float(s.size) * s.files for s in samples)
+    sbt = sum(s.size * s.seconds for s in samples)
+    sft = sum(s.files * s.seconds for s in samples)
+    det = sbb * sff - sbf * sbf
+    # The relative determinant is 0 when size and files are proportional in all samples
+    if sbb > 0 and sff > 0 and det > 1e-6 * sbb * sff:
+        seconds_per_byte = (sbt * sff - sft * sbf) / det
+        seconds_per_file = (sft * sbb - sbt * sbf) / det
+        if seconds_per_byte >= 0 and seconds_per_file >= 0:
+            return UploadCost(seconds_per_byte=seconds_per_byte, seconds_per_file=seconds_per_file)
+    if sbb > 0:
+        return UploadCost(seconds_per_byte=sbt / sbb)
+    return UploadCost(seconds_per_byte=0.0, seconds_per_file=sft / sff)
+
+
+def estimate_upload_costs(
+    upload_results: Iterable[ipc.SnapshotUploadResult], hostnames: Sequence[str]
+) -> list[UploadCost] | None:
+    """Estimate the upload cost of each of the hostnames from previous upload results.
+
+    Nodes without history of their own get the cost fitted over all nodes.
+    Returns None if there is no usable history at all.
+    """
+    samples_by_hostname: dict[str, list[UploadSample]] = {}
+    for result in upload_results:
+        sample = get_upload_sample(result)
+        if sample is not None:
+            samples_by_hostname.setdefault(result.hostname, []).append(sample)
+    cluster_cost = fit_upload_cost([sample for samples in samples_by_hostname.values() for sample in samples])
+    if cluster_cost is None:
+        return None
+    return [fit_upload_cost(samples_by_hostname.get(hostname, [])) or cluster_cost for hostname in hostnames]
+
+
+async def download_upload_history(
+    json_storage: asyncstorage.AsyncJsonStorage, *, backups: int, parallel: int = magic.DEFAULT_MANIFEST_DOWNLOAD_PARALLEL
+) -> list[ipc.SnapshotUploadResult]:
+    """Return the upload results of (at most) the latest backups."""
+    backup_names = sorted(name for name in await json_storage.list_jsons() if name.startswith(magic.JSON_BACKUP_PREFIX))
+
+    async def _download(backup_name: str) -> UploadHistoryManifest:
+        return await run_in_threadpool(json_storage.storage.download_json, backup_name, UploadHistoryManifest)
+
+    latest_backup_names = backup_names[-backups:] if backups > 0 else []
+    manifests = await gather_limited(parallel, (_download(name) for name in latest_backup_names))
+    return [result for manifest in manifests for result in manifest.upload_results]
+
+
+def get_sshash_to_node_indexes(
+    *, hexdigests: Set[str], snapshots: Sequence[ipc.SnapshotResult]
+) -> list[tuple[ipc.SnapshotHash, list[int]]]:
+    """Return the hashes not in hexdigests with the indexes of the snapshots having them.
+
+    The hashes present in the fewest snapshots come first, and otherwise the largest first.
+    """
+    sshash_to_node_indexes: dict[ipc.SnapshotHash, list[int]] = {}
+    for i, snapshot_result in enumerate(snapshots):
+        for snapshot_hash in snapshot_result.hashes or []:
+            sshash_to_node_indexes.setdefault(snapshot_hash, []).append(i)
+    return sorted(
+        ((sshash, indexes) for sshash, indexes in sshash_to_node_indexes.items() if sshash.hexdigest not in hexdigests),
+        key=lambda item: (len(item[1]), -item[0].size),
+    )
+
+
+class UploadBatchScheduler:
+    """Hand out the uploads to the nodes in batches, as the nodes finish their previous batches.
+
+    Each node gets first the hashes present on the fewest other nodes.
+    The hashes present on several nodes are not bound to any node until
+    one of them gets to them, so the nodes that finish their own work
+    early take over the shared work of the slower nodes.
+    """
+
+    def __init__(self, *, hexdigests: Set[str], snapshots: Sequence[ipc.SnapshotResult], batch_size: int) -> None:
+        self.batch_size = batch_size
+        self.todo_by_node: list[list[ipc.SnapshotHash]] = [[] for _ in snapshots]
+        self.total = 0
+        for sshash, node_indexes in get_sshash_to_node_indexes(hexdigests=hexdigests, snapshots=snapshots):
+            self.total += 1
+            for node_index in node_indexes:
+                self.todo_by_node[node_index].append(sshash)
+        self.positions = [0] * len(snapshots)
+        self.assigned: set[ipc.SnapshotHash] = set()
+
+    def next_batch(self, node_index: int) -> list[ipc.SnapshotHash]:
+        """Return the next hashes to upload (of about batch_size bytes) by the node, or empty list if done."""
+        todo = self.todo_by_node[node_index]
+        batch: list[ipc.SnapshotHash] = []
+        batch_size = 0
+        while self.positions[node_index] < len(todo) and (not batch or batch_size < self.batch_size):
+            sshash = todo[self.positions[node_index]]
+            self.positions[node_index] += 1
+            if sshash in self.assigned:
+                continue
+            self.assigned.add(sshash)
+            batch.append(sshash)
+            batch_size += sshash.size
+        return batch
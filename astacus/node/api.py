@@ -7,7 +7,7 @@ from .download import DownloadOp
 from .node import Node
 from .snapshot_op import ReleaseOp, SnapshotOp, UploadOp
 from .state import node_state, NodeState
-from astacus.common import ipc
+from astacus.common import ipc, magic
 from astacus.common.magic import StrEnum
 from astacus.common.msgspec_glue import register_msgspec_glue, StructResponse
 from astacus.common.snapshot import SnapshotGroup
@@ -57,6 +57,18 @@ def metadata() -> StructResponse:
     )
 
 
+@router.get("/{op_path:path}/{op_id}/progress")
+def op_progress(*, op_id: int, n: Node = Depends()) -> StructResponse:
+    """Progress of any node op, without the op-specific result payload.
+
+    Polling this instead of the status url avoids re-encoding the full
+    result (e.g. the whole snapshot state) on every poll; the full result
+    is only worth fetching once the progress is final.
+    """
+    op, _ = n.get_op_and_op_info(op_id=op_id)
+    return StructResponse(op.progress_result())
+
+
 @router.post("/lock")
 def lock(locker: str, ttl: int, state: NodeState = Depends(node_state)):
     with state.mutate_lock:
@@ -112,6 +124,14 @@ def snapshot_result(*, op_id: int, n: Node = Depends()) -> StructResponse:
     return StructResponse(op.result)
 
 
+@router.get("/snapshot/{op_id}/page")
+def snapshot_result_page(
+    *, op_id: int, cursor: int = 0, limit: int = magic.DEFAULT_SNAPSHOT_RESULT_PAGE_SIZE, n: Node = Depends()
+) -> StructResponse:
+    op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.snapshot)
+    return build_snapshot_result_page(op.result, cursor=cursor, limit=limit)
+
+
 @router.post("/delta/snapshot")
 def delta_snapshot(
     groups: Annotated[Sequence[ipc.SnapshotRequestGroup], Body()],
@@ -134,19 +154,29 @@ def delta_snapshot_result(*, op_id: int, n: Node = Depends()) -> StructResponse:
     return StructResponse(op.result)
 
 
+@router.get("/delta/snapshot/{op_id}/page")
+def delta_snapshot_result_page(
+    *, op_id: int, cursor: int = 0, limit: int = magic.DEFAULT_SNAPSHOT_RESULT_PAGE_SIZE, n: Node = Depends()
+) -> StructResponse:
+    op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.snapshot)
+    return build_snapshot_result_page(op.result, cursor=cursor, limit=limit)
+
+
 @router.post("/upload")
 def upload(
     hashes: Annotated[Sequence[ipc.SnapshotHash], Body()],
     storage: Annotated[str, Body()],
     validate_file_hashes: Annotated[bool, Body()] = True,
+    checkpoint_id: Annotated[str, Body()] = "",
     result_url: Annotated[str, Body()] = "",
     n: Node = Depends(),
 ):
-    req = ipc.SnapshotUploadRequestV20221129(
+    req = ipc.SnapshotUploadRequestV20261018(
         result_url=result_url,
         hashes=hashes,
         storage=storage,
         validate_file_hashes=validate_file_hashes,
+        checkpoint_id=checkpoint_id,
     )
     if not n.state.is_locked:
         raise HTTPException(status_code=409, detail="Not locked")
@@ -165,14 +195,16 @@ def delta_upload(
     hashes: Annotated[Sequence[ipc.SnapshotHash], Body()],
     storage: Annotated[str, Body()],
     validate_file_hashes: Annotated[bool, Body()] = True,
+    checkpoint_id: Annotated[str, Body()] = "",
     result_url: Annotated[str, Body()] = "",
     n: Node = Depends(),
 ):
-    req = ipc.SnapshotUploadRequestV20221129(
+    req = ipc.SnapshotUploadRequestV20261018(
         result_url=result_url,
         hashes=hashes,
         storage=storage,
         validate_file_hashes=validate_file_hashes,
+        checkpoint_id=checkpoint_id,
     )
     if not n.state.is_locked:
         raise HTTPException(status_code=409, detail="Not locked")
@@ -216,6 +248,7 @@ def download(
     backup_name: Annotated[str, Body()],
     snapshot_index: Annotated[int, Body()],
     root_globs: Annotated[Sequence[str], Body()],
+    hardlink_duplicates: Annotated[bool, Body()] = False,
     result_url: Annotated[str, Body()] = "",
     n: Node = Depends(),
 ):
@@ -225,6 +258,7 @@ def download(
         backup_name=backup_name,
         snapshot_index=snapshot_index,
         root_globs=root_globs,
+        hardlink_duplicates=hardlink_duplicates,
     )
     if not n.state.is_locked:
         raise HTTPException(status_code=409, detail="Not locked")
@@ -244,6 +278,7 @@ def delta_download(
     backup_name: Annotated[str, Body()],
     snapshot_index: Annotated[int, Body()],
     root_globs: Annotated[Sequence[str], Body()],
+    hardlink_duplicates: Annotated[bool, Body()] = False,
     result_url: Annotated[str, Body()] = "",
     n: Node = Depends(),
 ):
@@ -253,6 +288,7 @@ def delta_download(
         backup_name=backup_name,
         snapshot_index=snapshot_index,
         root_globs=root_globs,
+        hardlink_duplicates=hardlink_duplicates,
     )
     if not n.state.is_locked:
         raise HTTPException(status_code=409, detail="Not locked")
@@ -379,6 +415,14 @@ def cassandra_result(*, subop: ipc.CassandraSubOp, op_id: int, n: Node = Depends
     return StructResponse(op.result)
 
 
+def build_snapshot_result_page(result: ipc.SnapshotResult, *, cursor: int, limit: int) -> StructResponse:
+    if cursor < 0 or limit < 1:
+        raise HTTPException(status_code=422, detail="Invalid cursor or limit")
+    if not result.progress.final:
+        raise HTTPException(status_code=409, detail="Snapshot is not finished")
+    return StructResponse(result.get_page(cursor=cursor, limit=limit))
+
+
 SnapshotReq: TypeAlias = ipc.SnapshotRequestV2 | ipc.SnapshotDownloadRequest | ipc.SnapshotClearRequest
 
 
@@ -393,6 +437,7 @@ def groups_from_snapshot_req(req: SnapshotReq) -> Sequence[SnapshotGroup]:
                 root_glob=group.root_glob,
                 excluded_names=group.excluded_names,
                 embedded_file_size_max=group.embedded_file_size_max,
+                chunk_size=group.chunk_size,
             )
             for group in req.groups
             if not any(existing_group.root_glob == group.root_glob for existing_group in groups)
@@ -2,11 +2,13 @@
 Copyright (c) 2020 Aiven Ltd
 See LICENSE for details
 """
+from astacus.common import magic
 from astacus.common.cassandra.config import CassandraClientConfiguration
 from astacus.common.magic import StrEnum
 from astacus.common.rohmustorage import RohmuConfig
 from astacus.common.statsd import StatsdConfig
 from astacus.common.utils import AstacusModel
+from astacus.node.snapshotter import HashEngine
 from collections.abc import Sequence
 from fastapi import Request
 from pathlib import Path
@@ -18,7 +20,15 @@ APP_KEY = "node_config"
 class NodeParallel(AstacusModel):
     # Optional parallelization of operations
     downloads: int = 1
+    # If set, objects of at least large_download_size bytes are downloaded by
+    # this many threads of their own, and the 'downloads' threads only get the
+    # smaller objects: the few bandwidth bound large downloads then do not hold
+    # up the many latency bound small ones (nor the other way around)
+    large_downloads: int = 0
+    large_download_size: int = magic.DEFAULT_LARGE_DOWNLOAD_SIZE
     hashes: int = 1
+    # How the 'hashes' parallel hashing workers are run
+    hash_engine: HashEngine = HashEngine.threads
     uploads: int = 1
 
 
@@ -67,6 +77,10 @@ class NodeConfig(AstacusModel):
     delta_root_link: Path | None = None
     db_path: Path
 
+    # Reuse the snapshot databases in db_path across restarts (if they are
+    # still valid), so that files which have not changed are not hashed again.
+    persistent_snapshot_db: bool = False
+
     # These can be either globally or locally set
     object_storage: RohmuConfig | None = None
     statsd: StatsdConfig | None = None
@@ -10,29 +10,104 @@ API of this module with proper parameters.
 
 """
 from .node import NodeOp
+from .snapshot import SnapshotDiff
 from .snapshotter import Snapshotter
-from astacus.common import ipc, utils
+from astacus.common import ipc, magic, utils
 from astacus.common.progress import Progress
 from astacus.common.rohmustorage import RohmuStorage
+from astacus.common.statsd import parallel_map_stats_reporter, StatsClient
 from astacus.common.storage import JsonStorage, Storage, ThreadLocalStorage
 from astacus.common.utils import get_umask
-from collections.abc import Callable, Sequence
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from pathlib import Path
+from typing import Final
 
 import base64
+import collections
+import dataclasses
+import fcntl
 import getpass
 import logging
 import msgspec
 import os
 import shutil
+import stat
 import subprocess
 
 logger = logging.getLogger(__name__)
 
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE: Final[int] = 0x40049409
+
+
+def link_or_copy_file(src: Path, dst: Path, *, hardlink: bool = False) -> str:
+    """Create dst with the same content as src, sharing the data with src when possible.
+
+    Tries in order a hardlink (only if allowed, as later writes to either
+    file would change both), a reflink, copy_file_range (which some
+    filesystems turn into a reflink or a server side copy) and a byte copy.
+    Returns the method that succeeded.
+    """
+    if hardlink:
+        dst.unlink(missing_ok=True)
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as ex:
+            logger.debug("Hardlinking %s to %s failed: %r", src, dst, ex)
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+        try:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if not copied:
+                    break
+                remaining -= copied
+            else:
+                return "copy_file_range"
+        except OSError:
+            pass
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+        return "copy"
+
+
+@dataclasses.dataclass
+class DownloadGroup:
+    # Files with the same content, missing from the destination
+    files: list[ipc.SnapshotFile]
+    # File with the same content already on the node, copied instead of downloading the content
+    local_source: ipc.SnapshotFile | None = None
+
+    @property
+    def download_size(self) -> int:
+        return 0 if self.local_source is not None else self.files[0].file_size
+
+    @property
+    def progress_size(self) -> int:
+        return self.download_size + len(self.files)
+
 
 class Downloader(ThreadLocalStorage):
     def __init__(
-        self, *, dst: Path, snapshotter: Snapshotter, parallel: int, storage: Storage, copy_dst_owner: bool = False
+        self,
+        *,
+        dst: Path,
+        snapshotter: Snapshotter,
+        parallel: int,
+        storage: Storage,
+        copy_dst_owner: bool = False,
+        stats: StatsClient | None = None,
+        large_parallel: int = 0,
+        large_size: int = magic.DEFAULT_LARGE_DOWNLOAD_SIZE,
+        hardlink_duplicates: bool = False,
     ) -> None:
         super().__init__(storage=storage)
         self.dst = dst
@@ -40,20 +115,23 @@ class Downloader(ThreadLocalStorage):
         self.snapshot = snapshotter.snapshot
         self.parallel = parallel
         self.copy_dst_owner = copy_dst_owner
-
-    def _snapshotfile_already_exists(self, snapshotfile: ipc.SnapshotFile) -> bool:
-        existing_snapshotfile = self.snapshot.get_file(snapshotfile.relative_path)
-        return existing_snapshotfile is not None and existing_snapshotfile.equals_excluding_mtime(snapshotfile)
+        self.stats = stats
+        # If set, objects of at least large_size bytes are downloaded by large_parallel threads of their own
+        self.large_parallel = large_parallel
+        self.large_size = large_size
+        # Files with the same content are hardlinked instead of copied; only for files that are never modified
+        self.hardlink_duplicates = hardlink_duplicates
 
     def _download_snapshotfile(self, snapshotfile: ipc.SnapshotFile) -> None:
-        if self._snapshotfile_already_exists(snapshotfile):
-            return
-
         relative_path = snapshotfile.relative_path
         download_path = self.dst / relative_path
         download_path.parent.mkdir(parents=True, exist_ok=True)
         with utils.open_path_with_atomic_rename(download_path) as f:
-            if snapshotfile.hexdigest:
+            if snapshotfile.chunks:
+                # Chunked files are reassembled by appending the chunks in order
+                for chunk in snapshotfile.chunks:
+                    self.local_storage.download_hexdigest_to_file(chunk.hexdigest, f)
+            elif snapshotfile.hexdigest:
                 self.local_storage.download_hexdigest_to_file(snapshotfile.hexdigest, f)
             else:
                 assert snapshotfile.content_b64 is not None
@@ -61,23 +139,62 @@ class Downloader(ThreadLocalStorage):
         os.chmod(download_path, 0o660 & ~get_umask())
         os.utime(download_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
 
-    def _download_snapshotfiles_from_storage(self, snapshotfiles: Sequence[ipc.SnapshotFile]) -> None:
-        self._download_snapshotfile(snapshotfiles[0])
-
-        # We don't report progress for these, as local copying
-        # should be ~instant
-        for snapshotfile in snapshotfiles[1:]:
-            self._copy_snapshotfile(snapshotfiles[0], snapshotfile)
+    def _download_group(self, group: DownloadGroup) -> list[str]:
+        """Download the content of the group once (unless already local), and copy it to the other files.
 
-    def _copy_snapshotfile(self, snapshotfile_src: ipc.SnapshotFile, snapshotfile: ipc.SnapshotFile) -> None:
-        if self._snapshotfile_already_exists(snapshotfile):
-            return
+        Returns the methods used for the copies (see link_or_copy_file).
+        """
+        files = group.files
+        if group.local_source is None:
+            self._download_snapshotfile(files[0])
+            source, files = files[0], files[1:]
+        else:
+            source = group.local_source
+        return [self._copy_snapshotfile(source, snapshotfile) for snapshotfile in files]
 
+    def _copy_snapshotfile(self, snapshotfile_src: ipc.SnapshotFile, snapshotfile: ipc.SnapshotFile) -> str:
         src_path = self.dst / snapshotfile_src.relative_path
         dst_path = self.dst / snapshotfile.relative_path
         dst_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(src_path, dst_path)
-        os.utime(dst_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
+        mode = 0o660 & ~get_umask()
+        # A hardlink shares the mode and mtime of its source, which may be a local file with other ones than
+        # the snapshot file: only link when they already are what the snapshot file needs
+        src_stat = src_path.stat()
+        hardlink = (
+            self.hardlink_duplicates
+            and stat.S_IMODE(src_stat.st_mode) == mode
+            and src_stat.st_mtime_ns == snapshotfile.mtime_ns
+        )
+        method = link_or_copy_file(src_path, dst_path, hardlink=hardlink)
+        if method != "hardlink":
+            os.chmod(dst_path, mode)
+            os.utime(dst_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
+        return method
+
+    def _get_download_groups(self, files: Sequence[ipc.SnapshotFile], diff: SnapshotDiff) -> list[DownloadGroup]:
+        """Group the files missing from the destination by their content."""
+        groups: dict[str, DownloadGroup] = {}
+        for snapshotfile in _iter_missing_files(files, diff.get_present_indexes()):
+            if snapshotfile.hexdigest:
+                groups.setdefault(snapshotfile.hexdigest, DownloadGroup(files=[])).files.append(snapshotfile)
+        # Files already on the node with the same content (at any path) are copied instead of downloaded
+        for local_source in diff.get_local_sources():
+            group = groups.get(local_source.hexdigest)
+            if group is not None and group.files[0].file_size == local_source.file_size:
+                group.local_source = local_source
+        return sorted(groups.values(), key=lambda group: -group.download_size)
+
+    def _get_download_lanes(self, groups: Sequence[DownloadGroup]) -> list[utils.ParallelMapLane]:
+        if self.large_parallel <= 0:
+            return [utils.ParallelMapLane(iterable=groups, n=self.parallel)]
+        return [
+            utils.ParallelMapLane(
+                iterable=[group for group in groups if group.download_size >= self.large_size], n=self.large_parallel
+            ),
+            utils.ParallelMapLane(
+                iterable=[group for group in groups if group.download_size < self.large_size], n=self.parallel
+            ),
+        ]
 
     def download_from_storage(
         self,
@@ -86,43 +203,43 @@ class Downloader(ThreadLocalStorage):
         snapshotstate: ipc.SnapshotState,
         still_running_callback: Callable[[], bool] = lambda: True,
     ) -> None:
-        hexdigest_to_snapshotfiles: dict[str, list[ipc.SnapshotFile]] = {}
-        valid_relative_path_set = set()
-        for snapshotfile in snapshotstate.files:
-            valid_relative_path_set.add(snapshotfile.relative_path)
-            if snapshotfile.hexdigest:
-                hexdigest_to_snapshotfiles.setdefault(snapshotfile.hexdigest, []).append(snapshotfile)
-
+        files = snapshotstate.files
         self.snapshotter.perform_snapshot(progress=Progress())
         # TBD: Error checking, what to do if we're told to restore to existing directory?
-        progress.start(sum(1 + snapshotfile.file_size for snapshotfile in snapshotstate.files))
-        for snapshotfile in snapshotstate.files:
-            if not snapshotfile.hexdigest:
+        with self.snapshot.diff(files) as diff:
+            embedded_files = [file for file in _iter_missing_files(files, diff.get_present_indexes()) if not file.hexdigest]
+            groups = self._get_download_groups(files, diff)
+            # The progress counts the downloaded bytes and the restored files; the local
+            # copies of files with the same content are just one more file, and the files
+            # already in the destination are not counted at all.
+            progress.start(sum(1 + file.file_size for file in embedded_files) + sum(group.progress_size for group in groups))
+            for snapshotfile in embedded_files:
                 self._download_snapshotfile(snapshotfile)
                 progress.download_success(snapshotfile.file_size + 1)
-        all_snapshotfiles = hexdigest_to_snapshotfiles.values()
-
-        def _cb(*, map_in: Sequence[ipc.SnapshotFile], map_out: Sequence[ipc.SnapshotFile]) -> bool:
-            snapshotfiles = map_in
-            progress.download_success((snapshotfiles[0].file_size + 1) * len(snapshotfiles))
-            return still_running_callback()
-
-        sorted_all_snapshotfiles = sorted(all_snapshotfiles, key=lambda files: -files[0].file_size)
-
-        if not utils.parallel_map_to(
-            fun=self._download_snapshotfiles_from_storage,
-            iterable=sorted_all_snapshotfiles,
-            result_callback=_cb,
-            n=self.parallel,
-        ):
-            progress.add_fail()
-            progress.done()
-            return
-
-        # Delete files that were not supposed to exist
-        for relative_path in set(self.snapshot.get_all_paths()).difference(valid_relative_path_set):
-            absolute_path = self.dst / relative_path
-            absolute_path.unlink(missing_ok=True)
+
+            copy_methods: collections.Counter[str] = collections.Counter()
+
+            def _cb(*, map_in: DownloadGroup, map_out: Sequence[str]) -> bool:
+                copy_methods.update(map_out)
+                progress.download_success(map_in.progress_size)
+                return still_running_callback()
+
+            if not utils.parallel_map_lanes_to(
+                fun=self._download_group,
+                lanes=self._get_download_lanes(groups),
+                result_callback=_cb,
+                stats_callback=parallel_map_stats_reporter(self.stats, tags={"op": "download"}) if self.stats else None,
+            ):
+                progress.add_fail()
+                progress.done()
+                return
+            if copy_methods:
+                logger.info("Restored files with the same content as another file by: %r", dict(copy_methods))
+
+            # Delete files that were not supposed to exist
+            for relative_path in diff.get_extra_paths():
+                absolute_path = self.dst / relative_path
+                absolute_path.unlink(missing_ok=True)
 
         if self.copy_dst_owner:
             # Adjust owner of created files and folders to be like the owner of dst
@@ -154,6 +271,15 @@ class Downloader(ThreadLocalStorage):
         progress.done()
 
 
+def _iter_missing_files(files: Sequence[ipc.SnapshotFile], present_indexes: Iterable[int]) -> Iterator[ipc.SnapshotFile]:
+    """Return the files whose index is not in present_indexes (which are in ascending order)."""
+    start = 0
+    for index in present_indexes:
+        yield from files[start:index]
+        start = index + 1
+    yield from files[start:]
+
+
 class DownloadOp(NodeOp[ipc.SnapshotDownloadRequest, ipc.NodeResult]):
     snapshotter: Snapshotter | None = None
 
@@ -174,7 +300,7 @@ class DownloadOp(NodeOp[ipc.SnapshotDownloadRequest, ipc.NodeResult]):
         assert self.snapshotter is not None
         # Actual 'restore from backup'
         snapshot = download_snapshot(self.storage, self.req.backup_name, self.req.snapshot_index)
-        snapshotstate = snapshot.state
+        snapshotstate = snapshot.get_state()
         assert snapshotstate is not None
 
         # 'snapshotter' is global; ensure we have sole access to it
@@ -186,6 +312,10 @@ class DownloadOp(NodeOp[ipc.SnapshotDownloadRequest, ipc.NodeResult]):
                 storage=self.storage,
                 parallel=self.config.parallel.downloads,
                 copy_dst_owner=self.config.copy_root_owner,
+                stats=self.stats,
+                large_parallel=self.config.parallel.large_downloads,
+                large_size=self.config.parallel.large_download_size,
+                hardlink_duplicates=self.req.hardlink_duplicates,
             )
             downloader.download_from_storage(
                 snapshotstate=snapshotstate,
@@ -58,15 +58,17 @@ class NodeOp(op.Op, Generic[Request, Result]):
             logger.debug("send_result omitted - not running")
             return
         # We used to send the entire  json-encoded result but not use it, wasting a lot of memory for nothing
-        status = msgspec.json.encode(
-            ipc.NodeResult(
-                hostname=self.result.hostname,
-                az=self.result.az,
-                progress=self.result.progress,
-            )
-        )
+        status = msgspec.json.encode(self.progress_result())
         utils.http_request(self.req.result_url, method="put", caller="NodeOp.send_result", data=status)
 
+    def progress_result(self) -> ipc.NodeResult:
+        """Return the result without the (potentially huge) op-specific payload."""
+        return ipc.NodeResult(
+            hostname=self.result.hostname,
+            az=self.result.az,
+            progress=self.result.progress,
+        )
+
     def set_status(self, status: op.Op.Status, *, from_status: op.Op.Status | None = None) -> bool:
         if not super().set_status(status, from_status=from_status):
             # Status didn't change, do nothing
@@ -91,6 +93,8 @@ class Node(op.OpMixin):
     state: NodeState
     """ Convenience dependency which contains sub-dependencies most API endpoints need """
 
+    serves_progress = True
+
     def __init__(
         self,
         *,
@@ -119,7 +123,9 @@ class Node(op.OpMixin):
 
         def _create_snapshot() -> Snapshot:
             snapshotter_db_name = f"{key}.db"
-            return SQLiteSnapshot(root_link, self.config.db_path / snapshotter_db_name)
+            return SQLiteSnapshot(
+                root_link, self.config.db_path / snapshotter_db_name, persistent=self.config.persistent_snapshot_db
+            )
 
         return utils.get_or_create_state(state=self.app_state, key=key, factory=_create_snapshot)
 
@@ -131,5 +137,12 @@ class Node(op.OpMixin):
 
     def _get_snapshotter_for_snapshot(self, snapshot: Snapshot, groups: Sequence[SnapshotGroup]) -> Snapshotter:
         if isinstance(snapshot, SQLiteSnapshot):
-            return SQLiteSnapshotter(groups, self.config.root, snapshot.dst, snapshot, self.config.parallel.hashes)
+            return SQLiteSnapshotter(
+                groups,
+                self.config.root,
+                snapshot.dst,
+                snapshot,
+                self.config.parallel.hashes,
+                hash_engine=self.config.parallel.hash_engine,
+            )
         raise NotImplementedError(f"Unknown snapshot type {type(snapshot)}")
@@ -7,12 +7,48 @@ See LICENSE for details
 
 from abc import ABC, abstractmethod
 from astacus.common.ipc import SnapshotFile, SnapshotHash
+from astacus.common.utils import SizeLimitedFile
+from contextlib import AbstractContextManager
 from pathlib import Path
 from typing import Iterable
 
+import dataclasses
 import threading
 
 
+@dataclasses.dataclass(frozen=True)
+class SnapshotChunk:
+    """A part of a chunked snapshot file, stored as its own object."""
+
+    relative_path: str
+    offset: int
+    size: int
+    hexdigest: str
+
+    def open_for_reading(self, root_path: Path) -> SizeLimitedFile:
+        return SizeLimitedFile(path=root_path / self.relative_path, file_size=self.size, offset=self.offset)
+
+
+class SnapshotDiff(ABC):
+    """Comparison of a snapshot with the files of a target state, see Snapshot.diff."""
+
+    @abstractmethod
+    def get_present_indexes(self) -> Iterable[int]:
+        """Return the indexes (in ascending order) of the target files which are in the snapshot with the same content."""
+
+    @abstractmethod
+    def get_extra_paths(self) -> Iterable[str]:
+        """Return the paths in the snapshot which are not among the target files."""
+
+    @abstractmethod
+    def get_local_sources(self) -> Iterable[SnapshotFile]:
+        """Return a file of the snapshot for each content of the missing target files that is available locally.
+
+        The files are never at the path of a missing target file, so their
+        content stays available while the target files are restored.
+        """
+
+
 class Snapshot(ABC):
     def __init__(self, dst: Path) -> None:
         self.lock = threading.Lock()
@@ -30,6 +66,10 @@ class Snapshot(ABC):
     def get_files_for_digest(self, hexdigest: str) -> Iterable[SnapshotFile]:
         ...
 
+    @abstractmethod
+    def get_chunks_for_digest(self, hexdigest: str) -> Iterable[SnapshotChunk]:
+        ...
+
     @abstractmethod
     def get_all_files(self) -> Iterable[SnapshotFile]:
         ...
@@ -43,3 +83,7 @@ class Snapshot(ABC):
 
     def get_total_size(self) -> int:
         return sum(file.file_size for file in self.get_all_files())
+
+    @abstractmethod
+    def diff(self, files: Iterable[SnapshotFile]) -> AbstractContextManager[SnapshotDiff]:
+        """Compare the snapshot with the target files, without keeping either in memory."""
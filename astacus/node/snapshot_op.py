@@ -15,6 +15,7 @@ from .snapshotter import Snapshotter
 from .uploader import Uploader
 from astacus.common import ipc, utils
 from astacus.common.rohmustorage import RohmuStorage
+from astacus.common.upload_checkpoint import UploadCheckpoint
 from astacus.node.snapshot import Snapshot
 
 import logging
@@ -40,24 +41,32 @@ class SnapshotOp(NodeOp[ipc.SnapshotRequestV2, ipc.SnapshotResult]):
             self.check_op_id()
             self.snapshotter.perform_snapshot(progress=self.result.progress)
             self.result.state = self.snapshotter.get_snapshot_state()
-            self.result.hashes = [
-                ipc.SnapshotHash(hexdigest=ssfile.hexdigest, size=ssfile.file_size)
-                for ssfile in self.result.state.files
-                if ssfile.hexdigest
-            ]
+            self.result.hashes = [hash for ssfile in self.result.state.files for hash in ssfile.stored_hashes()]
             self.result.files = len(self.result.state.files)
             self.result.total_size = sum(ssfile.file_size for ssfile in self.result.state.files)
             self.result.end = utils.now()
             self.result.progress.done()
 
 
-class UploadOp(NodeOp[ipc.SnapshotUploadRequestV20221129, ipc.SnapshotUploadResult]):
+class UploadOp(NodeOp[ipc.SnapshotUploadRequestV20261018, ipc.SnapshotUploadResult]):
     snapshot: Snapshot | None = None
 
     @property
     def storage(self) -> RohmuStorage:
         assert self.config.object_storage is not None
-        return RohmuStorage(self.config.object_storage, storage=self.req.storage)
+        return RohmuStorage(self.config.object_storage, storage=self.req.storage, stats=self.stats)
+
+    def open_checkpoint(self, storage: RohmuStorage) -> UploadCheckpoint | None:
+        if not self.req.checkpoint_id:
+            return None
+        checkpoint = UploadCheckpoint(self.config.db_path / "upload_checkpoint.db", storage=storage.storage_name)
+        for stale_upload in checkpoint.start_session(self.req.checkpoint_id):
+            logger.info("Aborting upload of %r from a previous session", stale_upload.upload.key)
+            assert self.config.object_storage is not None
+            RohmuStorage(
+                self.config.object_storage, storage=stale_upload.storage, upload_checkpoint=checkpoint
+            ).abort_multipart_upload(stale_upload.upload)
+        return checkpoint
 
     def create_result(self) -> ipc.SnapshotUploadResult:
         return ipc.SnapshotUploadResult()
@@ -69,19 +78,27 @@ class UploadOp(NodeOp[ipc.SnapshotUploadRequestV20221129, ipc.SnapshotUploadResu
 
     def upload(self) -> None:
         assert self.snapshot is not None
-        uploader = Uploader(storage=self.storage)
         # 'snapshotter' is global; ensure we have sole access to it
         with self.snapshot.lock:
             self.check_op_id()
-            self.result.total_size, self.result.total_stored_size = uploader.write_hashes_to_storage(
-                snapshot=self.snapshot,
-                hashes=self.req.hashes,
-                parallel=self.config.parallel.uploads,
-                progress=self.result.progress,
-                still_running_callback=self.still_running_callback,
-                validate_file_hashes=self.req.validate_file_hashes,
-            )
-            self.result.progress.done()
+            storage = self.storage
+            checkpoint = storage.upload_checkpoint = self.open_checkpoint(storage)
+            uploader = Uploader(storage=storage, checkpoint=checkpoint, stats=self.stats)
+            try:
+                self.result.start = utils.now()
+                self.result.total_size, self.result.total_stored_size = uploader.write_hashes_to_storage(
+                    snapshot=self.snapshot,
+                    hashes=self.req.hashes,
+                    parallel=self.config.parallel.uploads,
+                    progress=self.result.progress,
+                    still_running_callback=self.still_running_callback,
+                    validate_file_hashes=self.req.validate_file_hashes,
+                )
+                self.result.end = utils.now()
+                self.result.progress.done()
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
 
 
 class ReleaseOp(NodeOp[ipc.SnapshotReleaseRequest, ipc.NodeResult]):
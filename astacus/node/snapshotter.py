@@ -6,12 +6,14 @@ See LICENSE for details
 """
 
 from abc import ABC, abstractmethod
-from astacus.common.ipc import SnapshotFile, SnapshotState
+from astacus.common.ipc import SnapshotFile, SnapshotHash, SnapshotState
+from astacus.common.magic import StrEnum
 from astacus.common.progress import Progress
 from astacus.common.snapshot import SnapshotGroup
 from astacus.node.snapshot import Snapshot
 from astacus.node.snapshot_groups import CompiledGroups
-from collections.abc import Iterable, Sequence
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from multiprocessing import dummy
 from pathlib import Path
 from threading import Lock
@@ -19,18 +21,38 @@ from typing import Generic, TypeVar
 
 import base64
 import hashlib
+import multiprocessing
 import os
+import threading
 
 T = TypeVar("T", bound=Snapshot)
 
 
+class HashEngine(StrEnum):
+    # Hash files in a pool of threads within the node process
+    threads = "threads"
+    # Hash files in a pool of worker processes, using large read buffers;
+    # not limited by the GIL of the node process
+    processes = "processes"
+
+
 class Snapshotter(ABC, Generic[T]):
-    def __init__(self, groups: Sequence[SnapshotGroup], src: Path, dst: Path, snapshot: T, parallel: int) -> None:
+    def __init__(
+        self,
+        groups: Sequence[SnapshotGroup],
+        src: Path,
+        dst: Path,
+        snapshot: T,
+        parallel: int,
+        *,
+        hash_engine: HashEngine = HashEngine.threads,
+    ) -> None:
         self.snapshot = snapshot
         self._src = src
         self._dst = dst
         self._groups = CompiledGroups.compile(groups)
         self._parallel = parallel
+        self._hash_engine = hash_engine
         self._dst.mkdir(parents=True, exist_ok=True)
 
     @property
@@ -54,21 +76,68 @@ class Snapshotter(ABC, Generic[T]):
         return SnapshotFile(relative_path=relative_path, mtime_ns=st.st_mtime_ns, file_size=st.st_size)
 
     def _compute_digests(self, files: Iterable[SnapshotFile]) -> Iterable[SnapshotFile]:
+        if self._hash_engine == HashEngine.processes:
+            yield from self._compute_digests_in_processes(files)
+            return
+
         def _cb(snapshotfile: SnapshotFile) -> SnapshotFile:
             # src may or may not be present; dst is present as it is in snapshot
             with snapshotfile.open_for_reading(self._dst) as f:
-                embedded_file_size_max = self._embedded_file_size_max_for_file(snapshotfile)
-                if embedded_file_size_max is None or snapshotfile.file_size <= embedded_file_size_max:
+                if self._should_embed(snapshotfile):
                     if snapshotfile.content_b64 is None:
                         snapshotfile.content_b64 = base64.b64encode(f.read()).decode()
-                else:
-                    if snapshotfile.hexdigest == "":
+                elif snapshotfile.hexdigest == "":
+                    chunk_size = self._chunk_size_for_file(snapshotfile)
+                    if chunk_size is None:
                         snapshotfile.hexdigest = hash_hexdigest_readable(f)
+                    else:
+                        path = self._dst / snapshotfile.relative_path
+                        snapshotfile.hexdigest, snapshotfile.chunks = hash_hexdigest_and_chunks_path(
+                            path, snapshotfile.file_size, chunk_size
+                        )
             return snapshotfile
 
         with dummy.Pool(self._parallel) as p:
             yield from p.imap_unordered(_cb, files)
 
+    def _compute_digests_in_processes(self, files: Iterable[SnapshotFile]) -> Iterator[SnapshotFile]:
+        # Embedded files are small, so they are read directly; only the
+        # hashing of the rest is sent to the worker processes. fork is not
+        # safe in the (threaded) node process, so the workers are spawned.
+        max_pending = 4 * self._parallel
+        pending: dict[Future[tuple[str, list[SnapshotHash]]], SnapshotFile] = {}
+
+        def _completed(*, block: bool) -> Iterator[SnapshotFile]:
+            done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                snapshotfile = pending.pop(future)
+                snapshotfile.hexdigest, chunks = future.result()
+                if chunks:
+                    snapshotfile.chunks = chunks
+                yield snapshotfile
+
+        with ProcessPoolExecutor(self._parallel, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for snapshotfile in files:
+                if self._should_embed(snapshotfile):
+                    if snapshotfile.content_b64 is None:
+                        with snapshotfile.open_for_reading(self._dst) as f:
+                            snapshotfile.content_b64 = base64.b64encode(f.read()).decode()
+                    yield snapshotfile
+                elif snapshotfile.hexdigest != "":
+                    yield snapshotfile
+                else:
+                    path = self._dst / snapshotfile.relative_path
+                    chunk_size = self._chunk_size_for_file(snapshotfile)
+                    future = executor.submit(hash_hexdigest_and_chunks_path, path, snapshotfile.file_size, chunk_size)
+                    pending[future] = snapshotfile
+                    yield from _completed(block=len(pending) >= max_pending)
+            while pending:
+                yield from _completed(block=True)
+
+    def _should_embed(self, file: SnapshotFile) -> bool:
+        embedded_file_size_max = self._embedded_file_size_max_for_file(file)
+        return embedded_file_size_max is None or file.file_size <= embedded_file_size_max
+
     def _embedded_file_size_max_for_file(self, file: SnapshotFile) -> int | None:
         groups = self._groups.get_matching(file.relative_path)
         assert groups
@@ -78,6 +147,18 @@ class Snapshotter(ABC, Generic[T]):
                 raise ValueError("All SnapshotGroups containing a common file must have the same embedded_file_size_max")
         return head.embedded_file_size_max
 
+    def _chunk_size_for_file(self, file: SnapshotFile) -> int | None:
+        """Return the chunk size the file is split into, or None if it is stored whole."""
+        groups = self._groups.get_matching(file.relative_path)
+        assert groups
+        head, *tail = groups
+        for group in tail:
+            if not group.chunk_size == head.chunk_size:
+                raise ValueError("All SnapshotGroups containing a common file must have the same chunk_size")
+        if head.chunk_size is None or file.file_size <= head.chunk_size or self._should_embed(file):
+            return None
+        return head.chunk_size
+
     def _maybe_link(self, relpath: str) -> None:
         """Links the src to the dst if we are not in same root mode.
         If dst exists, it is unlinked first.
@@ -105,3 +186,88 @@ def hash_hexdigest_readable(f, *, read_buffer: int = 1_000_000) -> str:
             break
         h.update(data)
     return h.hexdigest()
+
+
+class HashingReader:
+    """Wrap a readable file, hashing everything read through it."""
+
+    def __init__(self, f) -> None:
+        self._f = f
+        self._hash = _hash()
+
+    def read(self, n: int | None = None) -> bytes:
+        data = self._f.read(n)
+        self._hash.update(data)
+        return data
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+# hashlib releases the GIL while hashing large enough chunks, and bigger
+# reads mean fewer syscalls; the buffer is reused within each thread.
+HASH_READ_BUFFER_SIZE = 4 * 1024 * 1024
+_hash_buffers = threading.local()
+
+
+def _get_hash_buffer(read_buffer: int) -> memoryview:
+    buffer = getattr(_hash_buffers, "buffer", None)
+    if buffer is None or len(buffer) != read_buffer:
+        buffer = _hash_buffers.buffer = bytearray(read_buffer)
+    return memoryview(buffer)
+
+
+def hash_hexdigest_path(path: Path, file_size: int, *, read_buffer: int = HASH_READ_BUFFER_SIZE) -> str:
+    """Hash the first file_size bytes of the file at path (the same digest as hash_hexdigest_readable)."""
+    view = _get_hash_buffer(read_buffer)
+    h = _hash()
+    left = file_size
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while left > 0:
+            n = f.readinto(view[: min(left, read_buffer)])
+            if not n:
+                break
+            h.update(view[:n])
+            left -= n
+    return h.hexdigest()
+
+
+def hash_hexdigest_and_chunks_path(
+    path: Path, file_size: int, chunk_size: int | None, *, read_buffer: int = HASH_READ_BUFFER_SIZE
+) -> tuple[str, list[SnapshotHash]]:
+    """Hash the first file_size bytes of the file at path, and each of their consecutive chunk_size sized chunks.
+
+    The file is read only once; if chunk_size is None, only the digest of the whole file is computed.
+    """
+    if chunk_size is None:
+        return hash_hexdigest_path(path, file_size, read_buffer=read_buffer), []
+    view = _get_hash_buffer(read_buffer)
+    h = _hash()
+    chunks: list[SnapshotHash] = []
+    left = file_size
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while left > 0:
+            chunk_hash = _hash()
+            chunk_left = min(left, chunk_size)
+            while chunk_left > 0:
+                n = f.readinto(view[: min(chunk_left, read_buffer)])
+                if not n:
+                    break
+                h.update(view[:n])
+                chunk_hash.update(view[:n])
+                chunk_left -= n
+            chunk_length = min(left, chunk_size) - chunk_left
+            if chunk_length:
+                chunks.append(SnapshotHash(hexdigest=chunk_hash.hexdigest(), size=chunk_length))
+            if chunk_left:
+                # The file was truncated while hashing
+                break
+            left -= chunk_length
+    return h.hexdigest(), chunks
@@ -7,10 +7,12 @@ See LICENSE for details
 from astacus.common import magic
 from astacus.common.ipc import SnapshotFile, SnapshotHash
 from astacus.common.progress import Progress
-from astacus.node.snapshot import Snapshot
+from astacus.node.snapshot import Snapshot, SnapshotChunk, SnapshotDiff
 from astacus.node.snapshotter import Snapshotter
-from contextlib import closing
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
 from functools import cached_property
+from itertools import groupby
 from pathlib import Path
 from typing import Iterable
 from typing_extensions import override
@@ -22,10 +24,19 @@ import sqlite3
 logger = logging.getLogger(__name__)
 
 
+# Bump this whenever the schema of the snapshot database changes; persistent
+# databases with a different version are discarded and rebuilt.
+SNAPSHOT_DB_VERSION = 2
+
+
 class SQLiteSnapshot(Snapshot):
-    def __init__(self, dst: Path, db: Path) -> None:
+    def __init__(self, dst: Path, db: Path, *, persistent: bool = False) -> None:
         super().__init__(dst)
         self.db = db
+        # If persistent, an existing database is reused (if it is valid) instead
+        # of being recreated, so that unchanged files are not hashed again after
+        # restart.
+        self.persistent = persistent
 
     def __len__(self) -> int:
         return self._con.execute("select count(*) from snapshot_files;").fetchone()[0]
@@ -33,24 +44,58 @@ class SQLiteSnapshot(Snapshot):
     def get_file(self, relative_path: str) -> SnapshotFile | None:
         cur = self._con.execute("select * from snapshot_files where relative_path = ?;", (relative_path,))
         row = cur.fetchone()
-        return row_to_snapshotfile(row) if row else None
+        if not row:
+            return None
+        file = row_to_snapshotfile(row)
+        chunks = [
+            SnapshotHash(hexdigest=hexdigest, size=size)
+            for hexdigest, size in self._con.execute(
+                "select hexdigest, size from snapshot_chunks where relative_path = ? order by offset;", (relative_path,)
+            )
+        ]
+        if chunks:
+            file.chunks = chunks
+        return file
 
     def get_files_for_digest(self, hexdigest: str) -> Iterable[SnapshotFile]:
-        return map(
-            row_to_snapshotfile,
+        return rows_to_snapshotfiles(
             self._con.execute(
                 """
-                select *
-                from snapshot_files
+                select f.*, c.hexdigest, c.size
+                from snapshot_files f
+                left join snapshot_chunks c using (relative_path)
+                where f.hexdigest = ?
+                order by f.relative_path, c.offset;
+                """,
+                (hexdigest,),
+            )
+        )
+
+    def get_chunks_for_digest(self, hexdigest: str) -> Iterable[SnapshotChunk]:
+        return (
+            SnapshotChunk(relative_path=relative_path, offset=offset, size=size, hexdigest=hexdigest)
+            for relative_path, offset, size in self._con.execute(
+                """
+                select relative_path, offset, size
+                from snapshot_chunks
                 where hexdigest = ?
-                order by relative_path;
+                order by relative_path, offset;
                 """,
                 (hexdigest,),
-            ),
+            )
         )
 
     def get_all_files(self) -> Iterable[SnapshotFile]:
-        return map(row_to_snapshotfile, self._con.execute("select * from snapshot_files order by relative_path;"))
+        return rows_to_snapshotfiles(
+            self._con.execute(
+                """
+                select f.*, c.hexdigest, c.size
+                from snapshot_files f
+                left join snapshot_chunks c using (relative_path)
+                order by f.relative_path, c.offset;
+                """
+            )
+        )
 
     @override
     def get_all_paths(self) -> Iterable[str]:
@@ -63,12 +108,47 @@ class SQLiteSnapshot(Snapshot):
     def get_connection(self) -> sqlite3.Connection:
         return self._con
 
+    @override
+    @contextmanager
+    def diff(self, files: Iterable[SnapshotFile]) -> Iterator[SnapshotDiff]:
+        with self._con:
+            self._con.execute("begin")
+            with closing(self._con.cursor()) as cur:
+                cur.execute(
+                    """
+                    create temporary table target_files (
+                        idx integer primary key,
+                        relative_path text not null,
+                        file_size integer not null,
+                        hexdigest text not null,
+                        content_b64 text
+                    );
+                    """
+                )
+                cur.executemany(
+                    "insert into target_files values (?, ?, ?, ?, ?);",
+                    (
+                        (idx, file.relative_path, file.file_size, file.hexdigest, file.content_b64)
+                        for idx, file in enumerate(files)
+                    ),
+                )
+                cur.execute("create index target_files_relative_path on target_files(relative_path);")
+        try:
+            yield SQLiteSnapshotDiff(self._con)
+        finally:
+            self._con.execute("drop table target_files;")
+
     def get_all_digests(self) -> Iterable[SnapshotHash]:
+        # Chunked files are stored only as their chunks
         for hexdigest, file_size in self._con.execute(
             """
             select hexdigest, file_size
             from snapshot_files
             where hexdigest != ''
+            and relative_path not in (select relative_path from snapshot_chunks)
+            union all
+            select hexdigest, size
+            from snapshot_chunks
             order by hexdigest;
             """
         ):
@@ -77,15 +157,24 @@ class SQLiteSnapshot(Snapshot):
     @cached_property
     def _con(self) -> sqlite3.Connection:
         if self.db.exists():
+            if self.persistent:
+                con = self._open_existing_db()
+                if con is not None:
+                    return con
             # We could probably use an old db again since everything should be
-            # in a transaction, but there is little benefit so let's be safe and
+            # in a transaction, but unless explicitly asked to, let's be safe and
             # just recreate it.
-            self.db.unlink()
+            self._unlink_db()
         else:
             self.db.parent.mkdir(parents=True, exist_ok=True)
         con = sqlite3.connect(self.db, isolation_level=None, check_same_thread=False)
+        if self.persistent:
+            # WAL + synchronous=normal keeps the database consistent on crash,
+            # at worst losing the most recent (uncommitted to disk) transaction.
+            con.execute("pragma journal_mode=wal;")
+            con.execute("pragma synchronous=normal;")
         con.executescript(
-            """
+            f"""
             begin;
             create table snapshot_files (
                 relative_path text not null,
@@ -96,11 +185,126 @@ class SQLiteSnapshot(Snapshot):
                 primary key (relative_path)
             );
             create index snapshot_files_hexdigest on snapshot_files(hexdigest);
+            create table snapshot_chunks (
+                relative_path text not null,
+                offset integer not null,
+                size integer not null,
+                hexdigest text not null,
+                primary key (relative_path, offset)
+            );
+            create index snapshot_chunks_hexdigest on snapshot_chunks(hexdigest);
+            create table snapshot_info (
+                dst text not null
+            );
+            pragma user_version = {SNAPSHOT_DB_VERSION};
             commit;
             """
         )
+        con.execute("insert into snapshot_info (dst) values (?);", (str(self.dst),))
         return con
 
+    def _open_existing_db(self) -> sqlite3.Connection | None:
+        """Open the existing database if it is compatible and consistent, otherwise return None."""
+        try:
+            con = sqlite3.connect(self.db, isolation_level=None, check_same_thread=False)
+        except sqlite3.Error as ex:
+            logger.warning("Unable to open snapshot db %s, rebuilding it: %r", self.db, ex)
+            return None
+        try:
+            problem = self._check_existing_db(con)
+        except sqlite3.Error as ex:
+            problem = repr(ex)
+        if problem is not None:
+            logger.warning("Not reusing snapshot db %s, rebuilding it: %s", self.db, problem)
+            con.close()
+            return None
+        con.execute("pragma synchronous=normal;")
+        logger.info("Reusing snapshot db %s", self.db)
+        return con
+
+    def _check_existing_db(self, con: sqlite3.Connection) -> str | None:
+        (user_version,) = con.execute("pragma user_version;").fetchone()
+        if user_version != SNAPSHOT_DB_VERSION:
+            return f"schema version {user_version} != {SNAPSHOT_DB_VERSION}"
+        dsts = [row[0] for row in con.execute("select dst from snapshot_info;")]
+        if dsts != [str(self.dst)]:
+            return f"snapshot root {dsts!r} != {str(self.dst)!r}"
+        (journal_mode,) = con.execute("pragma journal_mode;").fetchone()
+        if journal_mode != "wal":
+            return f"journal mode {journal_mode!r} != 'wal'"
+        integrity_check = [row[0] for row in con.execute("pragma integrity_check;")]
+        if integrity_check != ["ok"]:
+            return f"integrity check failed: {integrity_check!r}"
+        return None
+
+    def _unlink_db(self) -> None:
+        self.db.unlink()
+        # Leftovers of a WAL mode database must not be applied to the new one
+        for suffix in ("-wal", "-shm"):
+            self.db.with_name(self.db.name + suffix).unlink(missing_ok=True)
+
+
+class SQLiteSnapshotDiff(SnapshotDiff):
+    def __init__(self, con: sqlite3.Connection) -> None:
+        self._con = con
+
+    @override
+    def get_present_indexes(self) -> Iterable[int]:
+        return (
+            row[0]
+            for row in self._con.execute(
+                """
+                select t.idx
+                from target_files t
+                join snapshot_files f using (relative_path)
+                where f.file_size = t.file_size
+                and f.hexdigest = t.hexdigest
+                and f.content_b64 is t.content_b64
+                order by t.idx;
+                """
+            )
+        )
+
+    @override
+    def get_extra_paths(self) -> Iterable[str]:
+        return (
+            row[0]
+            for row in self._con.execute(
+                """
+                select relative_path
+                from snapshot_files
+                where relative_path not in (select relative_path from target_files);
+                """
+            )
+        )
+
+    @override
+    def get_local_sources(self) -> Iterable[SnapshotFile]:
+        # The bare columns of the aggregate query come from the row with the min relative_path
+        return (
+            row_to_snapshotfile(row[1:])
+            for row in self._con.execute(
+                """
+                with missing_files as (
+                    select t.relative_path, t.file_size, t.hexdigest
+                    from target_files t
+                    left join snapshot_files f
+                    on f.relative_path = t.relative_path
+                    and f.file_size = t.file_size
+                    and f.hexdigest = t.hexdigest
+                    and f.content_b64 is t.content_b64
+                    where f.relative_path is null
+                )
+                select min(f.relative_path), f.relative_path, f.file_size, f.mtime_ns, f.hexdigest, f.content_b64
+                from snapshot_files f
+                where f.hexdigest != ''
+                and (f.hexdigest, f.file_size) in (select hexdigest, file_size from missing_files)
+                and f.relative_path not in (select relative_path from missing_files)
+                group by f.hexdigest;
+                """
+            )
+        )
+
 
 class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
     def perform_snapshot(self, *, progress: Progress) -> None:
@@ -127,7 +331,7 @@ class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
                 if not (dir_path / f).is_symlink() and self._groups.any_match(rel_path):
                     yield rel_path
 
-    def _compare_current_snapshot(self, files: Iterable[str]) -> Iterable[tuple[str, SnapshotFile | None]]:
+    def _compare_current_snapshot(self, files: Iterable[str]) -> Iterable[tuple[str, SnapshotFile | None, int | None]]:
         with closing(self._con.cursor()) as cur:
             cur.execute(
                 """
@@ -161,6 +365,13 @@ class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
                 for (relative_path,) in cur:
                     assert isinstance(relative_path, str)
                     (self._dst / relative_path).unlink(missing_ok=True)
+            cur.execute(
+                """
+                delete from snapshot_chunks
+                where relative_path
+                not in (select relative_path from current_files);
+                """
+            )
             cur.execute(
                 """
                 insert into new_files
@@ -182,24 +393,30 @@ class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
                 """
             )
             cur.execute("drop table current_files;")
+            # The size of the first chunk is the chunk size the file was split with
             cur.execute(
                 """
-                select relative_path, file_size, mtime_ns, hexdigest, content_b64
-                from new_files;
+                select n.relative_path, n.file_size, n.mtime_ns, n.hexdigest, n.content_b64, c.size
+                from new_files n
+                left join snapshot_chunks c on c.relative_path = n.relative_path and c.offset = 0;
                 """
             )
             for row in cur:
                 if row[1] is None:
-                    yield row[0], None
+                    yield row[0], None, None
                 else:
-                    yield row[0], row_to_snapshotfile(row)
+                    yield row[0], row_to_snapshotfile(row), row[5]
 
-    def _compare_with_src(self, files: Iterable[tuple[str, SnapshotFile | None]]) -> Iterable[SnapshotFile]:
+    def _compare_with_src(self, files: Iterable[tuple[str, SnapshotFile | None, int | None]]) -> Iterable[SnapshotFile]:
         logger.info("Checking metadata for files in %s", self._dst)
-        for relpath, existing in files:
+        for relpath, existing, existing_chunk_size in files:
             try:
                 new = self._file_in_src(relpath)
-                if existing is None or not existing.underlying_file_is_the_same(new):
+                if (
+                    existing is None
+                    or not existing.underlying_file_is_the_same(new)
+                    or existing_chunk_size != self._chunk_size_for_file(new)
+                ):
                     self._maybe_link(relpath)
                     yield new
             except FileNotFoundError:
@@ -207,15 +424,23 @@ class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
 
     def _upsert_files(self, files: Iterable[SnapshotFile]) -> None:
         logger.info("Upserting files in snapshot db")
-        self._con.executemany(
-            """
-            insert or replace
-            into snapshot_files
-                (relative_path, file_size, mtime_ns, hexdigest, content_b64)
-            values (?, ?, ?, ?, ?);
-            """,
-            ((str(f.relative_path), f.file_size, f.mtime_ns, f.hexdigest, f.content_b64) for f in files),
-        )
+        with closing(self._con.cursor()) as cur:
+            for f in files:
+                cur.execute(
+                    """
+                    insert or replace
+                    into snapshot_files
+                        (relative_path, file_size, mtime_ns, hexdigest, content_b64)
+                    values (?, ?, ?, ?, ?);
+                    """,
+                    snapshotfile_to_row(f),
+                )
+                cur.execute("delete from snapshot_chunks where relative_path = ?;", (f.relative_path,))
+                if f.chunks:
+                    cur.executemany(
+                        "insert into snapshot_chunks (relative_path, offset, size, hexdigest) values (?, ?, ?, ?);",
+                        snapshotfile_to_chunk_rows(f),
+                    )
 
     def release(self, hexdigests: Iterable[str], *, progress: Progress) -> None:
         with self._con:
@@ -236,6 +461,10 @@ class SQLiteSnapshotter(Snapshotter[SQLiteSnapshot]):
                     """
                         select relative_path
                         from snapshot_files
+                        where hexdigest in (select hexdigest from hexdigests)
+                        union
+                        select relative_path
+                        from snapshot_chunks
                         where hexdigest in (select hexdigest from hexdigests);
                         """
                 )
@@ -257,5 +486,22 @@ def row_to_snapshotfile(row: tuple) -> SnapshotFile:
     return SnapshotFile(relative_path=row[0], file_size=row[1], mtime_ns=row[2], hexdigest=row[3], content_b64=row[4])
 
 
+def rows_to_snapshotfiles(rows: Iterable[tuple]) -> Iterable[SnapshotFile]:
+    """Group the rows of snapshot_files left joined with (hexdigest, size) of snapshot_chunks into files."""
+    for _, file_rows in groupby(rows, key=lambda row: row[0]):
+        first, *rest = file_rows
+        file = row_to_snapshotfile(first)
+        if first[5] is not None:
+            file.chunks = [SnapshotHash(hexdigest=row[5], size=row[6]) for row in (first, *rest)]
+        yield file
+
+
 def snapshotfile_to_row(file: SnapshotFile) -> tuple[str, int, int, str, str | None]:
     return (file.relative_path, file.file_size, file.mtime_ns, file.hexdigest, file.content_b64)
+
+
+def snapshotfile_to_chunk_rows(file: SnapshotFile) -> Iterable[tuple[str, int, int, str]]:
+    offset = 0
+    for chunk in file.chunks:
+        yield (file.relative_path, offset, chunk.size, chunk.hexdigest)
+        offset += chunk.size
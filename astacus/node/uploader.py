@@ -5,20 +5,32 @@ See LICENSE for details
 
 """
 
-from .snapshotter import hash_hexdigest_readable
+from .snapshotter import HashingReader
 from astacus.common import exceptions, utils
 from astacus.common.ipc import SnapshotFile, SnapshotHash
 from astacus.common.progress import Progress
-from astacus.common.storage import ThreadLocalStorage
+from astacus.common.statsd import parallel_map_stats_reporter, StatsClient
+from astacus.common.storage import Storage, ThreadLocalStorage
+from astacus.common.upload_checkpoint import UploadCheckpoint
 from astacus.node.snapshot import Snapshot
 from collections.abc import Sequence
+from pathlib import Path
 
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
 
 class Uploader(ThreadLocalStorage):
+    def __init__(
+        self, *, storage: Storage, checkpoint: UploadCheckpoint | None = None, stats: StatsClient | None = None
+    ) -> None:
+        super().__init__(storage=storage)
+        # If set, hexdigests uploaded by an earlier attempt of the same session are not uploaded again
+        self.checkpoint = checkpoint
+        self.stats = stats
+
     def write_hashes_to_storage(
         self,
         *,
@@ -29,34 +41,49 @@ class Uploader(ThreadLocalStorage):
         still_running_callback=lambda: True,
         validate_file_hashes: bool = True,
     ):
-        todo = [
-            (hexdigest, list(snapshot.get_files_for_digest(hexdigest)))
-            for hexdigest in set(hash.hexdigest for hash in hashes)
-        ]
-        todo.sort(key=lambda hexdigest_and_files: -hexdigest_and_files[1][0].file_size)
+        hash_sizes = {hash.hexdigest: hash.size for hash in hashes}
+        todo = sorted(hash_sizes, key=lambda hexdigest: -hash_sizes[hexdigest])
         progress.start(len(todo))
         sizes = {"total": 0, "stored": 0}
 
-        def _upload_hexdigest_in_thread(work: tuple[str, list[SnapshotFile]]):
-            hexdigest, files = work
+        def _upload_hexdigest_in_thread(hexdigest: str):
             storage = self.local_storage
 
             assert hexdigest
-            files = list(snapshot.get_files_for_digest(hexdigest))
-            for snapshotfile in files:
-                path = snapshot.dst / snapshotfile.relative_path
+            if self.checkpoint is not None:
+                checkpointed_result = self.checkpoint.get_uploaded(hexdigest)
+                if checkpointed_result is not None:
+                    return progress.upload_success, checkpointed_result.size, checkpointed_result.stored_size
+            # A failed validation deletes the uploaded object, which must not be one that other backups
+            # already refer to: existing objects are not uploaded again
+            if validate_file_hashes and storage.hexdigest_exists(hexdigest):
+                logger.info("%s is already in the storage", hexdigest)
+                return progress.upload_success, 0, 0
+            # Whole files with the hexdigest are preferred; chunks of chunked files are read from their offset
+            sources = [
+                (file.relative_path, file.file_size, file.open_for_reading, file)
+                for file in snapshot.get_files_for_digest(hexdigest)
+            ] + [
+                (chunk.relative_path, chunk.size, chunk.open_for_reading, snapshot.get_file(chunk.relative_path))
+                for chunk in snapshot.get_chunks_for_digest(hexdigest)
+            ]
+            for relative_path, file_size, open_for_reading, snapshot_file in sources:
+                path = snapshot.dst / relative_path
                 if not path.is_file():
                     logger.warning("%s disappeared post-snapshot", path)
                     continue
-                if validate_file_hashes:
-                    with snapshotfile.open_for_reading(snapshot.dst) as f:
-                        current_hexdigest = hash_hexdigest_readable(f)
-                    if current_hexdigest != snapshotfile.hexdigest:
-                        logger.info("Hash of %s changed before upload", snapshotfile.relative_path)
-                        continue
+                # When validating, the file is hashed as it is uploaded, instead of reading
+                # it separately before and after the upload
+                identity_before = _file_identity(path)
+                if validate_file_hashes and not _matches_snapshot_file(identity_before, snapshot_file):
+                    logger.info("%s was modified after the snapshot", relative_path)
+                    continue
                 try:
-                    with snapshotfile.open_for_reading(snapshot.dst) as f:
-                        upload_result = storage.upload_hexdigest_from_file(hexdigest, f, file_size=snapshotfile.file_size)
+                    with open_for_reading(snapshot.dst) as f:
+                        reader = HashingReader(f)
+                        upload_result = storage.upload_hexdigest_from_file(
+                            hexdigest, reader if validate_file_hashes else f, file_size=file_size
+                        )
                 except exceptions.TransientException as ex:
                     # Do not pollute logs with transient exceptions
                     logger.info("Transient exception uploading %r: %r", path, ex)
@@ -66,12 +93,16 @@ class Uploader(ThreadLocalStorage):
                     logger.exception("Exception uploading %r", path)
                     return progress.upload_failure, 0, 0
                 if validate_file_hashes:
-                    with snapshotfile.open_for_reading(snapshot.dst) as f:
-                        current_hexdigest = hash_hexdigest_readable(f)
-                    if current_hexdigest != snapshotfile.hexdigest:
-                        logger.info("Hash of %s changed after upload", snapshotfile.relative_path)
-                        storage.delete_hexdigest(hexdigest)
+                    if reader.hexdigest() != hexdigest:
+                        logger.info("Hash of %s changed before or during upload", relative_path)
+                        _delete_invalid_upload(storage, hexdigest)
+                        continue
+                    if _file_identity(path) != identity_before:
+                        logger.info("%s was modified during upload", relative_path)
+                        _delete_invalid_upload(storage, hexdigest)
                         continue
+                if self.checkpoint is not None:
+                    self.checkpoint.set_uploaded(hexdigest, upload_result)
                 return progress.upload_success, upload_result.size, upload_result.stored_size
 
             # We didn't find single file with the matching hexdigest.
@@ -86,6 +117,37 @@ class Uploader(ThreadLocalStorage):
             progress_callback(map_in)  # hexdigest
             return still_running_callback()
 
-        if not utils.parallel_map_to(fun=_upload_hexdigest_in_thread, iterable=todo, result_callback=_result_cb, n=parallel):
+        if not utils.parallel_map_to(
+            fun=_upload_hexdigest_in_thread,
+            iterable=todo,
+            result_callback=_result_cb,
+            n=parallel,
+            stats_callback=parallel_map_stats_reporter(self.stats, tags={"op": "upload"}) if self.stats else None,
+        ):
             progress.add_fail()
         return sizes["total"], sizes["stored"]
+
+
+def _file_identity(path: Path) -> tuple[int, int, int] | None:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _matches_snapshot_file(identity: tuple[int, int, int] | None, snapshot_file: SnapshotFile | None) -> bool:
+    if identity is None:
+        return False
+    if snapshot_file is None:
+        return True
+    _, size, mtime_ns = identity
+    return (size, mtime_ns) == (snapshot_file.file_size, snapshot_file.mtime_ns)
+
+
+def _delete_invalid_upload(storage: Storage, hexdigest: str) -> None:
+    # The object was created by this upload and is not referred to by any backup, it is only garbage if this fails
+    try:
+        storage.delete_hexdigest(hexdigest)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Exception deleting the invalid upload of %r", hexdigest)
@@ -0,0 +1,73 @@
+"""
+Copyright (c) 2024 Aiven Ltd
+See LICENSE for details
+
+Micro-benchmark of the snapshotter hash engines.
+
+Creates a set of files, snapshots them with each hash engine and reports
+the hashing throughput, in total and per worker. Files are read through
+the page cache after the first round, so this measures the hashing
+pipeline rather than the disk; point --directory to the filesystem of
+interest and use files larger than memory to include the disk too.
+
+Usage: python benchmarks/hash_engines.py [--files 8] [--file-size-mb 256] [--parallel 1 2 4]
+
+"""
+from astacus.common.progress import Progress
+from astacus.common.snapshot import SnapshotGroup
+from astacus.node.snapshotter import HashEngine
+from astacus.node.sqlite_snapshot import SQLiteSnapshot, SQLiteSnapshotter
+from pathlib import Path
+
+import argparse
+import os
+import tempfile
+import time
+
+CHUNK = 1024 * 1024
+
+
+def create_files(root: Path, *, files: int, file_size: int) -> None:
+    for i in range(files):
+        with (root / f"file{i}").open("wb") as f:
+            for _ in range(file_size // CHUNK):
+                f.write(os.urandom(CHUNK))
+
+
+def run_once(root: Path, db: Path, *, hash_engine: HashEngine, parallel: int) -> float:
+    db.unlink(missing_ok=True)
+    groups = [SnapshotGroup(root_glob="file*", embedded_file_size_max=0)]
+    snapshot = SQLiteSnapshot(root, db)
+    snapshotter = SQLiteSnapshotter(groups, root, root, snapshot, parallel, hash_engine=hash_engine)
+    start = time.monotonic()
+    snapshotter.perform_snapshot(progress=Progress())
+    elapsed = time.monotonic() - start
+    snapshot.get_connection().close()
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", type=Path, default=None, help="Where to create the test files")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--file-size-mb", type=int, default=256)
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.directory) as tempdir:
+        root = Path(tempdir) / "root"
+        root.mkdir()
+        db = Path(tempdir) / "snapshot.db"
+        create_files(root, files=args.files, file_size=args.file_size_mb * CHUNK)
+        total_mb = args.files * args.file_size_mb * CHUNK / 1e6
+        print(f"{args.files} files, {total_mb:.0f} MB in total")
+        print(f"{'engine':<10} {'parallel':>8} {'MB/s':>10} {'MB/s/core':>10}")
+        for hash_engine in HashEngine:
+            for parallel in args.parallel:
+                elapsed = min(run_once(root, db, hash_engine=hash_engine, parallel=parallel) for _ in range(args.rounds))
+                mb_per_s = total_mb / elapsed
+                print(f"{hash_engine.value:<10} {parallel:>8} {mb_per_s:>10.1f} {mb_per_s / parallel:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
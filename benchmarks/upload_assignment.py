@@ -0,0 +1,128 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+
+Simulation of the upload assignment of backups across nodes.
+
+For each backup manifest (in order), the uploads of its snapshot are
+assigned to the nodes both by balancing the bytes only, and by the upload
+costs estimated from the previous manifests. The expected upload time of
+the slowest node (the makespan of UploadBlocksStep) is then computed with
+the costs the nodes actually achieved in that backup.
+
+Without manifests, a synthetic cluster with nodes of different speeds and
+replicated data is simulated instead.
+
+Usage: python benchmarks/upload_assignment.py [backup-manifest.json ...]
+
+"""
+from astacus.common import ipc
+from astacus.common.progress import Progress
+from astacus.common.utils import now
+from astacus.coordinator.plugins.base import build_node_index_datas, NodeIndexData
+from astacus.coordinator.upload_assignment import estimate_upload_costs, UploadCost
+from collections.abc import Sequence
+from pathlib import Path
+
+import argparse
+import datetime
+import msgspec
+import random
+
+
+def makespan(assignment: Sequence[NodeIndexData], costs: Sequence[UploadCost]) -> float:
+    return max(
+        (
+            costs[data.node_index].estimate(size=data.total_size, files=len(data.sshashes))
+            for data in assignment
+            if data.sshashes
+        ),
+        default=0.0,
+    )
+
+
+def simulate(
+    *,
+    snapshots: Sequence[ipc.SnapshotResult],
+    uploaded: set[str],
+    estimated_costs: Sequence[UploadCost] | None,
+    actual_costs: Sequence[UploadCost],
+) -> tuple[float, float]:
+    node_indices = list(range(len(snapshots)))
+    by_size = build_node_index_datas(hexdigests=uploaded, snapshots=snapshots, node_indices=node_indices)
+    by_cost = build_node_index_datas(
+        hexdigests=uploaded, snapshots=snapshots, node_indices=node_indices, costs=estimated_costs
+    )
+    return makespan(by_size, actual_costs), makespan(by_cost, actual_costs)
+
+
+def simulate_manifests(paths: Sequence[Path]) -> None:
+    history: list[ipc.SnapshotUploadResult] = []
+    uploaded: set[str] = set()
+    print(f"{'manifest':<50} {'by size (s)':>12} {'by cost (s)':>12}")
+    for path in paths:
+        manifest = msgspec.json.decode(path.read_bytes(), type=ipc.BackupManifest)
+        hostnames = [result.hostname for result in manifest.snapshot_results]
+        actual_costs = estimate_upload_costs(manifest.upload_results, hostnames)
+        if actual_costs is not None:
+            estimated_costs = estimate_upload_costs(history, hostnames)
+            by_size, by_cost = simulate(
+                snapshots=manifest.snapshot_results,
+                uploaded=uploaded,
+                estimated_costs=estimated_costs,
+                actual_costs=actual_costs,
+            )
+            print(f"{path.name:<50} {by_size:>12.1f} {by_cost:>12.1f}")
+        history.extend(manifest.upload_results)
+        uploaded.update(h.hexdigest for result in manifest.snapshot_results for h in result.hashes or [])
+
+
+def simulate_synthetic(*, nodes: int, hashes: int, replicas: int, seed: int) -> None:
+    rng = random.Random(seed)
+    costs = [
+        UploadCost(seconds_per_byte=rng.uniform(1, 4) / 100e6, seconds_per_file=rng.uniform(0.005, 0.05))
+        for _ in range(nodes)
+    ]
+    node_hashes: list[list[ipc.SnapshotHash]] = [[] for _ in range(nodes)]
+    for i in range(hashes):
+        snapshot_hash = ipc.SnapshotHash(hexdigest=f"hash{i}", size=int(rng.lognormvariate(14, 2.5)))
+        for node in rng.sample(range(nodes), replicas):
+            node_hashes[node].append(snapshot_hash)
+    snapshots = [ipc.SnapshotResult(hostname=f"node{i}", hashes=h) for i, h in enumerate(node_hashes)]
+    # Previous backups took the time the costs predict (with some noise)
+    history = [
+        ipc.SnapshotUploadResult(
+            hostname=f"node{node}",
+            total_size=size,
+            progress=Progress(handled=files, total=files, final=True),
+            start=now(),
+        )
+        for node in range(nodes)
+        for size, files in [(rng.randint(1, 100) * 10**9, rng.randint(100, 100_000)) for _ in range(3)]
+    ]
+    for result in history:
+        seconds = costs[int(result.hostname[4:])].estimate(size=result.total_size, files=result.progress.total)
+        assert result.start is not None
+        result.end = result.start + datetime.timedelta(seconds=seconds * rng.uniform(0.9, 1.1))
+    estimated_costs = estimate_upload_costs(history, [snapshot.hostname for snapshot in snapshots])
+    by_size, by_cost = simulate(snapshots=snapshots, uploaded=set(), estimated_costs=estimated_costs, actual_costs=costs)
+    print(f"{nodes} nodes, {hashes} hashes with {replicas} replicas")
+    print(f"by size: {by_size:.1f} s, by cost: {by_cost:.1f} s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifests", type=Path, nargs="*", help="Backup manifests, oldest first")
+    parser.add_argument("--nodes", type=int, default=6)
+    parser.add_argument("--hashes", type=int, default=100_000)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.manifests:
+        simulate_manifests(args.manifests)
+    else:
+        simulate_synthetic(nodes=args.nodes, hashes=args.hashes, replicas=args.replicas, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
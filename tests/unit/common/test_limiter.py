@@ -3,11 +3,12 @@ Copyright (c) 2021 Aiven Ltd
 See LICENSE for details
 """
 
-from astacus.common.limiter import gather_limited, Limiter
+from astacus.common.limiter import gather_limited, iterate_completed_limited, Limiter, RateLimiter
 from collections.abc import Sequence
 
 import asyncio
 import pytest
+import time
 
 
 @pytest.mark.parametrize(
@@ -60,3 +61,45 @@ async def test_gather_limited(limit: int, expected_trace: Sequence[str]) -> None
         ],
     )
     assert trace == expected_trace
+
+
+async def test_gather_limited_returns_results_in_order() -> None:
+    async def delayed(value: int) -> int:
+        await asyncio.sleep(0.01 * (3 - value))
+        return value
+
+    assert await gather_limited(2, [delayed(1), delayed(2), delayed(3)]) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("limit,expected_results", [(1, [1, 2, 3]), (2, [2, 1, 3]), (3, [3, 2, 1])])
+async def test_iterate_completed_limited_yields_in_completion_order(limit: int, expected_results: Sequence[int]) -> None:
+    async def delayed(value: int) -> int:
+        # With a limit of 2, the third one completes 10ms after the first one
+        await asyncio.sleep({1: 0.06, 2: 0.04, 3: 0.03}[value])
+        return value
+
+    results = [result async for result in iterate_completed_limited(limit, [delayed(1), delayed(2), delayed(3)])]
+    assert results == expected_results
+
+
+async def test_iterate_completed_limited_takes_awaitables_as_earlier_ones_complete() -> None:
+    started: list[int] = []
+
+    async def delayed(value: int) -> int:
+        started.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async for result in iterate_completed_limited(2, (delayed(value) for value in range(5))):
+        # The next awaitable is taken from the generator only after this one was yielded
+        assert len(started) <= result + 2
+    assert started == [0, 1, 2, 3, 4]
+
+
+async def test_rate_limiter_spreads_calls() -> None:
+    rate_limiter = RateLimiter(100)
+    start = time.monotonic()
+    for _ in range(11):
+        await rate_limiter.wait()
+    # The first call does not wait, the next ten wait 10ms each
+    assert time.monotonic() - start >= 0.1
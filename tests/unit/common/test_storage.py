@@ -8,19 +8,30 @@ TBD: Test with something else than local files?
 
 """
 
-from astacus.common import exceptions
+from astacus.common import exceptions, magic
+from astacus.common.asyncstorage import AsyncHexDigestStorage, delete_concurrently
 from astacus.common.cachingjsonstorage import CachingJsonStorage
-from astacus.common.rohmustorage import RohmuConfig, RohmuStorage
-from astacus.common.storage import FileStorage, Json, JsonStorage
+from astacus.common.rohmustorage import MIN_MULTIPART_UPLOAD_PART_SIZE, RohmuConfig, RohmuStorage
+from astacus.common.storage import FileStorage, Json, JsonStorage, StorageUploadResult
+from astacus.common.upload_checkpoint import UploadCheckpoint
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AbstractContextManager, nullcontext as does_not_raise
 from pathlib import Path
 from pytest_mock import MockerFixture
 from rohmu.object_storage import google
+from rohmu.object_storage.base import TransferWithConcurrentUploadSupport
 from tests.utils import create_rohmu_config
+from typing import cast
 from unittest.mock import Mock, patch
 
+import asyncio
 import json
+import math
+import msgspec
+import os
+import pydantic
 import pytest
+import tempfile
 
 TEST_HEXDIGEST = "deadbeef"
 TEXT_HEXDIGEST_DATA = b"data" * 15
@@ -52,6 +63,8 @@ def _test_hexdigeststorage(storage: FileStorage) -> None:
     with pytest.raises(exceptions.NotFoundException):
         storage.download_hexdigest_bytes(TEST_HEXDIGEST + "x")
     assert storage.list_hexdigests() == [TEST_HEXDIGEST]
+    assert storage.hexdigest_exists(TEST_HEXDIGEST)
+    assert not storage.hexdigest_exists(TEST_HEXDIGEST + "x")
     storage.delete_hexdigest(TEST_HEXDIGEST)
     with pytest.raises(exceptions.NotFoundException):
         storage.delete_hexdigest(TEST_HEXDIGEST + "x")
@@ -114,6 +127,43 @@ def test_caching_storage(tmp_path: Path, mocker: MockerFixture) -> None:
     assert not mocklist.called
 
 
+class FrozenJsonStruct(msgspec.Struct, frozen=True):
+    value: int
+
+
+class JsonStruct(msgspec.Struct):
+    value: int
+
+
+def test_caching_storage_shares_decoded_frozen_jsons(tmp_path: Path, mocker: MockerFixture) -> None:
+    storage = create_storage(tmpdir=tmp_path, engine="cache")
+    storage.upload_json(TEST_JSON, FrozenJsonStruct(value=1))
+    open_cached = mocker.spy(storage.cache_storage, "open_json_bytes")
+    decoded = storage.download_json(TEST_JSON, FrozenJsonStruct)
+    assert storage.download_json(TEST_JSON, FrozenJsonStruct) is decoded
+    assert open_cached.call_count == 1
+    # Mutable ones are decoded for each caller
+    assert storage.download_json(TEST_JSON, JsonStruct) is not storage.download_json(TEST_JSON, JsonStruct)
+    storage.upload_json(TEST_JSON, FrozenJsonStruct(value=2))
+    assert storage.download_json(TEST_JSON, FrozenJsonStruct) == FrozenJsonStruct(value=2)
+
+
+def test_rohmu_storage_downloads_jsons_with_a_transfer_per_thread(tmp_path: Path, mocker: MockerFixture) -> None:
+    storage = create_storage(tmpdir=tmp_path, engine="rohmu")
+    storage.upload_json(TEST_JSON, TEST_JSON_DATA)
+    get_contents = mocker.spy(storage.storage, "get_contents_to_fileobj")
+
+    def _download() -> Json:
+        with storage.open_json_bytes(TEST_JSON) as json_bytes:
+            return json.loads(bytes(json_bytes))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(lambda _: _download(), range(2))) == [TEST_JSON_DATA] * 2
+    assert get_contents.call_count == 0
+    assert _download() == TEST_JSON_DATA
+    assert get_contents.call_count == 1
+
+
 @patch("rohmu.object_storage.google.get_credentials")
 @patch.object(google.GoogleTransfer, "_init_google_client")
 def test_proxy_storage(mock_google_client: Mock, mock_get_credentials: Mock) -> None:
@@ -151,3 +201,227 @@ def test_proxy_storage(mock_google_client: Mock, mock_get_credentials: Mock) ->
     assert rs.storage.proxy_info["type"] == "socks5"
     assert rs.storage.proxy_info["host"] == "localhost"
     assert rs.storage.proxy_info["port"] == 1080
+
+
+@pytest.mark.parametrize("file_size", [0, 10, 5000, 12345])
+def test_rohmu_storage_multipart_upload(tmp_path: Path, mocker: MockerFixture, file_size: int) -> None:
+    config = create_rohmu_config(tmp_path, compression=False)
+    config.multipart_upload_threshold = 0
+    config.multipart_upload_part_size = 1000
+    stats = Mock()
+    storage = RohmuStorage(config=config, stats=stats)
+    upload_part = mocker.spy(storage.storage, "upload_concurrent_chunk")
+    store_file_object = mocker.spy(storage.storage, "store_file_object")
+    data = os.urandom(file_size)
+    result = storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    assert result.size == file_size
+    assert upload_part.call_count == max(1, math.ceil(result.stored_size / 1000))
+    # The local storage assembles the parts with store_file_object
+    assert store_file_object.call_count == 1
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    stages = {call.kwargs["tags"]["stage"] for call in stats.increase.call_args_list}
+    assert stages == {"encode", "transfer"}
+    assert (
+        sum(call.kwargs["inc_value"] for call in stats.increase.call_args_list if call.kwargs["tags"]["stage"] == "transfer")
+        == result.stored_size
+    )
+
+
+def test_rohmu_config_rejects_too_small_multipart_upload_part_size(tmp_path: Path) -> None:
+    config = create_rohmu_config(tmp_path).dict()
+    assert RohmuConfig.parse_obj({**config, "multipart_upload_part_size": MIN_MULTIPART_UPLOAD_PART_SIZE})
+    with pytest.raises(pydantic.ValidationError, match="multipart_upload_part_size"):
+        RohmuConfig.parse_obj({**config, "multipart_upload_part_size": MIN_MULTIPART_UPLOAD_PART_SIZE - 1})
+
+
+def test_rohmu_storage_multipart_upload_resumes_from_checkpoint(tmp_path: Path, mocker: MockerFixture) -> None:
+    config = create_rohmu_config(tmp_path, compression=True, encryption=False)
+    config.multipart_upload_threshold = 0
+    config.multipart_upload_part_size = 1000
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage=config.default_storage)
+    assert not checkpoint.start_session("session")
+    storage = RohmuStorage(config=config, upload_checkpoint=checkpoint)
+    data = os.urandom(5000)
+    original_upload_part = cast(TransferWithConcurrentUploadSupport, storage.storage).upload_concurrent_chunk
+    upload_part = mocker.patch.object(storage.storage, "upload_concurrent_chunk", autospec=True)
+
+    def _upload_two_parts(upload, part_number, fd):
+        if part_number > 2:
+            raise exceptions.TransientException("interrupted")
+        original_upload_part(upload, part_number, fd)
+
+    upload_part.side_effect = _upload_two_parts
+    with pytest.raises(exceptions.RohmuException):
+        storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    saved = checkpoint.get_multipart_upload(f"data/{TEST_HEXDIGEST}")
+    assert saved is not None
+    assert sorted(saved.upload.chunks_to_etags) == [1, 2]
+
+    upload_part.side_effect = original_upload_part
+    result = storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    assert [call.args[1] for call in upload_part.call_args_list[3:]] == list(
+        range(3, math.ceil(result.stored_size / 1000) + 1)
+    )
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    assert checkpoint.get_multipart_upload(f"data/{TEST_HEXDIGEST}") is None
+
+
+@pytest.mark.parametrize("stale_parts", [["1", "2"], ["1"]], ids=["aborted upload", "missing part"])
+def test_rohmu_storage_multipart_upload_restarts_stale_upload(
+    tmp_path: Path, mocker: MockerFixture, stale_parts: list[str]
+) -> None:
+    config = create_rohmu_config(tmp_path, compression=True, encryption=False)
+    config.multipart_upload_threshold = 0
+    config.multipart_upload_part_size = 1000
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage=config.default_storage)
+    assert not checkpoint.start_session("session")
+    storage = RohmuStorage(config=config, upload_checkpoint=checkpoint)
+    data = os.urandom(5000)
+    original_upload_part = cast(TransferWithConcurrentUploadSupport, storage.storage).upload_concurrent_chunk
+    upload_part = mocker.patch.object(storage.storage, "upload_concurrent_chunk", autospec=True)
+
+    def _upload_two_parts(upload, part_number, fd):
+        if part_number > 2:
+            raise exceptions.TransientException("interrupted")
+        original_upload_part(upload, part_number, fd)
+
+    upload_part.side_effect = _upload_two_parts
+    with pytest.raises(exceptions.RohmuException):
+        storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    # The object storage drops the parts of the interrupted upload
+    (chunks_dir,) = {path.parent for path in tmp_path.rglob("2") if path.is_file()}
+    for part in stale_parts:
+        (chunks_dir / part).unlink()
+    if len(stale_parts) == 2:
+        chunks_dir.rmdir()
+
+    upload_part.side_effect = original_upload_part
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    assert checkpoint.get_multipart_upload(f"data/{TEST_HEXDIGEST}") is None
+
+
+def test_upload_checkpoint_is_discarded_by_new_session(tmp_path: Path) -> None:
+    config = create_rohmu_config(tmp_path)
+    storage = RohmuStorage(config=config)
+    upload = cast(TransferWithConcurrentUploadSupport, storage.storage).create_concurrent_upload("data/partial")
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage="storage")
+    checkpoint.start_session("old")
+    checkpoint.set_uploaded("uploaded", StorageUploadResult(size=10, stored_size=5))
+    checkpoint.set_multipart_upload(upload, part_size=1000)
+    # Continuing the session keeps the checkpoint, also across reopening it
+    checkpoint.close()
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage="storage")
+    assert not checkpoint.start_session("old")
+    assert checkpoint.get_uploaded("uploaded") == StorageUploadResult(size=10, stored_size=5)
+    assert UploadCheckpoint(tmp_path / "checkpoint.db", storage="other").get_uploaded("uploaded") is None
+    stale_uploads = checkpoint.start_session("new")
+    assert [(stale.storage, stale.upload, stale.part_size) for stale in stale_uploads] == [("storage", upload, 1000)]
+    assert checkpoint.get_uploaded("uploaded") is None
+    assert checkpoint.get_multipart_upload("data/partial") is None
+
+
+def test_rohmu_storage_upload_below_multipart_threshold(tmp_path: Path, mocker: MockerFixture) -> None:
+    config = create_rohmu_config(tmp_path)
+    config.multipart_upload_threshold = 1000
+    storage = RohmuStorage(config=config)
+    create_upload = mocker.spy(storage.storage, "create_concurrent_upload")
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, b"x" * 999)
+    assert not create_upload.called
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == b"x" * 999
+
+
+@pytest.mark.parametrize("compression,encryption", [(True, True), (True, False), (False, True)])
+@pytest.mark.parametrize("data", [TEXT_HEXDIGEST_DATA, os.urandom(3_000_000) + b"x" * 3_000_000], ids=["small", "large"])
+def test_rohmu_storage_download_makes_a_single_request(
+    tmp_path: Path, mocker: MockerFixture, compression: bool, encryption: bool, data: bytes
+) -> None:
+    storage = RohmuStorage(config=create_rohmu_config(tmp_path, compression=compression, encryption=encryption))
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    stored_data, metadata = storage.storage.get_contents_to_string(f"data/{TEST_HEXDIGEST}")
+
+    # Like the remote transfers: the metadata comes with the content of the GET
+    def _get_contents_to_fileobj(key: str, fileobj_to_store_to, *, progress_callback=None) -> dict:
+        assert key == f"data/{TEST_HEXDIGEST}"
+        fileobj_to_store_to.write(stored_data)
+        return metadata
+
+    mocker.patch.object(storage.storage, "get_contents_to_fileobj", _get_contents_to_fileobj)
+    get_metadata = mocker.patch.object(storage.storage, "get_metadata_for_key")
+    get_file_size = mocker.patch.object(storage.storage, "get_file_size")
+    temporary_file = mocker.spy(tempfile, "TemporaryFile")
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    assert not get_metadata.called
+    assert not get_file_size.called
+    # Small objects are not written to disk
+    assert temporary_file.called == (len(stored_data) > magic.DOWNLOAD_SPOOL_SIZE)
+
+
+def test_rohmu_storage_lists_hexdigests_by_prefix(tmp_path: Path, mocker: MockerFixture) -> None:
+    storage = RohmuStorage(config=create_rohmu_config(tmp_path))
+    hexdigests = [f"{digit}{i}" for digit in "0123456789abcdef" for i in range(3)]
+    mocker.patch("astacus.common.rohmustorage.storage_config_supports_prefix_listing", return_value=True)
+    list_key_prefix = mocker.patch.object(
+        storage,
+        "_list_key_prefix",
+        side_effect=lambda key_prefix: [h for h in hexdigests if f"data/{h}".startswith(key_prefix)],
+    )
+    assert sorted(storage.list_hexdigests()) == hexdigests
+    assert sorted(call.args[0] for call in list_key_prefix.call_args_list) == [
+        f"data/{digit}" for digit in "0123456789abcdef"
+    ]
+
+
+def test_rohmu_storage_hexdigest_exists(tmp_path: Path) -> None:
+    storage = RohmuStorage(config=create_rohmu_config(tmp_path))
+    assert not storage.hexdigest_exists(TEST_HEXDIGEST)
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, TEXT_HEXDIGEST_DATA)
+    assert storage.hexdigest_exists(TEST_HEXDIGEST)
+
+
+def test_rohmu_storage_delete_hexdigests_ignores_missing(tmp_path: Path) -> None:
+    storage = RohmuStorage(config=create_rohmu_config(tmp_path))
+    # The local storage has no native multi-object delete
+    assert not storage.supports_bulk_delete
+    for hexdigest in ["a", "b", "c"]:
+        storage.upload_hexdigest_bytes(hexdigest, TEXT_HEXDIGEST_DATA)
+    storage.delete_hexdigests(["a", "c", "missing"])
+    assert storage.list_hexdigests() == ["b"]
+
+
+@pytest.mark.parametrize("supports_bulk_delete", [True, False])
+async def test_async_hexdigest_storage_delete_hexdigests(
+    tmp_path: Path, mocker: MockerFixture, supports_bulk_delete: bool
+) -> None:
+    storage = FileStorage(tmp_path)
+    hexdigests = [f"{i:04x}" for i in range(2500)]
+    for hexdigest in hexdigests:
+        storage.upload_hexdigest_bytes(hexdigest, b"x")
+    mocker.patch.object(storage, "supports_bulk_delete", supports_bulk_delete)
+    delete_hexdigests = mocker.spy(storage, "delete_hexdigests")
+    progress = Mock()
+    await AsyncHexDigestStorage(storage, delete_parallel=4).delete_hexdigests(
+        hexdigests + ["missing"], progress_callback=progress
+    )
+    assert storage.list_hexdigests() == []
+    assert progress.call_args.args == (2501,)
+    assert delete_hexdigests.call_count == (3 if supports_bulk_delete else 0)
+
+
+async def test_delete_concurrently_limits_deletes_in_flight() -> None:
+    in_flight = 0
+    max_in_flight = 0
+    deleted: list[str] = []
+
+    async def delete_one(key: str) -> None:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.001)
+        deleted.append(key)
+        in_flight -= 1
+
+    keys = [str(i) for i in range(50)]
+    await delete_concurrently(keys, delete_one=delete_one, parallel=3)
+    assert sorted(deleted) == sorted(keys)
+    assert max_in_flight == 3
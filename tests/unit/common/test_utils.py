@@ -7,7 +7,7 @@ Test astacus.common.utils
 """
 
 from astacus.common import utils
-from astacus.common.utils import AsyncSleeper, build_netloc, parse_umask
+from astacus.common.utils import AsyncSleeper, build_netloc, ParallelMapLane, ParallelMapStats, parse_umask
 from datetime import timedelta
 from pathlib import Path
 from pytest_mock import MockerFixture
@@ -16,6 +16,7 @@ import asyncio
 import logging
 import pytest
 import tempfile
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -148,6 +149,25 @@ def test_sizelimitedfile() -> None:
         assert lf.read() == b"bar"
 
 
+def test_sizelimitedfile_with_offset() -> None:
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b"foobarbaz")
+        f.flush()
+        with utils.SizeLimitedFile(path=f.name, file_size=3, offset=3) as lf:
+            assert lf.tell() == 0
+            assert lf.read() == b"bar"
+            assert lf.tell() == 3
+            assert lf.seek(0) == 0
+            assert lf.read(2) == b"ba"
+            assert lf.seek(-1, 1) == 1
+            assert lf.read() == b"ar"
+            assert lf.seek(0, 2) == 3
+            assert not lf.read()
+            # Positions outside the view are clamped to it
+            assert lf.seek(-10, 1) == 0
+            assert lf.seek(10) == 3
+
+
 def test_open_path_with_atomic_rename(tmp_path: Path) -> None:
     # default is bytes
     f1_path = tmp_path / "f1"
@@ -195,6 +215,94 @@ State:  R (running)
     assert parse_umask(proc_status) == 0o022
 
 
+def test_parallel_map_to_delivers_results_as_completed() -> None:
+    slow_release = threading.Event()
+    results: list[int] = []
+
+    def _fun(item: int) -> int:
+        if item == 0:
+            assert slow_release.wait(timeout=10)
+        return item * 2
+
+    def _result_callback(*, map_in: int, map_out: int) -> bool:
+        results.append(map_out)
+        if len(results) == 9:
+            # Everything but the first (slow) item completed without waiting for it
+            slow_release.set()
+        return True
+
+    assert utils.parallel_map_to(fun=_fun, iterable=range(10), result_callback=_result_callback, n=2)
+    assert sorted(results[:9]) == [item * 2 for item in range(1, 10)]
+    assert results[9] == 0
+
+
+def test_parallel_map_to_consumes_iterable_lazily_and_cancels() -> None:
+    consumed: list[int] = []
+
+    def _items():
+        for item in range(1000):
+            consumed.append(item)
+            yield item
+
+    def _result_callback(*, map_in: int, map_out: int) -> bool:
+        return map_in != 5
+
+    assert not utils.parallel_map_to(fun=lambda item: item, iterable=_items(), result_callback=_result_callback, n=2)
+    # At most queue_size (2 * n) items are submitted ahead of the results
+    assert len(consumed) <= 10
+
+
+def test_parallel_map_to_reports_stats() -> None:
+    reported: list[ParallelMapStats] = []
+    assert utils.parallel_map_to(
+        fun=lambda item: item,
+        iterable=range(10),
+        result_callback=lambda *, map_in, map_out: True,
+        n=4,
+        queue_size=6,
+        stats_callback=reported.append,
+        stats_interval=0.0,
+    )
+    assert reported
+    assert all(stats.workers == 4 and stats.queued + stats.running <= 6 for stats in reported)
+    assert all(0.0 <= stats.utilisation <= 1.0 for stats in reported)
+
+
+def test_parallel_map_lanes_to_does_not_hold_up_other_lanes() -> None:
+    large_release = threading.Event()
+    results: list[str] = []
+
+    def _fun(item: str) -> str:
+        if item.startswith("large"):
+            assert large_release.wait(timeout=10)
+        return item
+
+    def _result_callback(*, map_in: str, map_out: str) -> bool:
+        results.append(map_out)
+        if len(results) == 20:
+            large_release.set()
+        return True
+
+    small = [f"small{i}" for i in range(20)]
+    large = [f"large{i}" for i in range(3)]
+    assert utils.parallel_map_lanes_to(
+        fun=_fun,
+        lanes=[ParallelMapLane(iterable=large, n=1), ParallelMapLane(iterable=small, n=2)],
+        result_callback=_result_callback,
+    )
+    # All the small items completed while the large lane was busy
+    assert sorted(results[:20]) == sorted(small)
+    assert sorted(results[20:]) == large
+
+
+def test_parallel_map_to_raises_exceptions() -> None:
+    def _fun(item: int) -> int:
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        utils.parallel_map_to(fun=_fun, iterable=range(3), result_callback=lambda *, map_in, map_out: True, n=2)
+
+
 class CacheTester:
     def __init__(self, val: int) -> None:
         self.val = val
@@ -0,0 +1,45 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+"""
+from astacus.coordinator.plugins.clickhouse.async_object_storage import RohmuAsyncObjectStorage, ThreadSafeRohmuStorage
+from pathlib import Path
+from pytest_mock import MockerFixture
+
+import pytest
+import rohmu
+import threading
+
+
+@pytest.mark.parametrize("list_parallel", [1, 4])
+async def test_rohmu_async_object_storage_lists_all_levels(tmp_path: Path, list_parallel: int) -> None:
+    config = rohmu.LocalObjectStorageConfig(directory=tmp_path)
+    transfer = rohmu.get_transfer_from_model(config)
+    keys = ["top", "abc/def", "abc/ghi/jkl", "xyz/uvw"]
+    for key in keys:
+        transfer.store_file_from_memory(key, b"data")
+    object_storage = RohmuAsyncObjectStorage(storage=ThreadSafeRohmuStorage(config=config), list_parallel=list_parallel)
+    items = await object_storage.list_items()
+    assert sorted(item.key for item in items) == sorted(keys)
+    assert sorted([item async for item in object_storage.iter_items()], key=lambda item: item.key) == sorted(
+        items, key=lambda item: item.key
+    )
+
+
+async def test_rohmu_async_object_storage_reuses_a_transfer_per_thread(tmp_path: Path, mocker: MockerFixture) -> None:
+    config = rohmu.LocalObjectStorageConfig(directory=tmp_path)
+    transfer = rohmu.get_transfer_from_model(config)
+    keys = [f"prefix-{i}/key" for i in range(10)]
+    for key in keys:
+        transfer.store_file_from_memory(key, b"data")
+    object_storage = RohmuAsyncObjectStorage(storage=ThreadSafeRohmuStorage(config=config), list_parallel=2)
+    creating_threads: list[int] = []
+
+    def _get_transfer_from_model(*args, **kwargs):
+        creating_threads.append(threading.get_ident())
+        return transfer
+
+    mocker.patch.object(rohmu, "get_transfer_from_model", side_effect=_get_transfer_from_model)
+    for _ in range(2):
+        assert sorted(item.key for item in await object_storage.list_items()) == keys
+    assert len(creating_threads) == len(set(creating_threads))
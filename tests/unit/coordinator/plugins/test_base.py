@@ -4,8 +4,9 @@ Copyright (c) 2021 Aiven Ltd
 See LICENSE for details
 """
 
-from astacus.common import ipc, utils
+from astacus.common import exceptions, ipc, magic, utils
 from astacus.common.asyncstorage import AsyncHexDigestStorage, AsyncJsonStorage
+from astacus.common.cachingjsonstorage import CachingJsonStorage
 from astacus.common.ipc import ManifestMin, Plugin, SnapshotHash
 from astacus.common.op import Op
 from astacus.common.progress import Progress
@@ -14,11 +15,13 @@ from astacus.coordinator.cluster import Cluster
 from astacus.coordinator.config import CoordinatorNode
 from astacus.coordinator.plugins.base import (
     BackupManifestStep,
+    BackupNameStep,
     ComputeKeptBackupsStep,
     DeleteBackupAndDeltaManifestsStep,
     DeleteBackupManifestsStep,
     DeleteDanglingHexdigestsStep,
     DeltaManifestsStep,
+    HexdigestIndexUpdate,
     ListBackupsStep,
     ListDeltaBackupsStep,
     ListHexdigestsStep,
@@ -26,6 +29,7 @@ from astacus.coordinator.plugins.base import (
     SnapshotStep,
     Step,
     StepsContext,
+    UpdateHexdigestIndexStep,
     UploadBlocksStep,
     UploadManifestStep,
 )
@@ -40,6 +44,7 @@ import dataclasses
 import datetime
 import httpx
 import json
+import mmap
 import msgspec
 import pytest
 import respx
@@ -146,8 +151,18 @@ def manifest_with_hashes(hashes: dict[str, bytes], index: int) -> ipc.BackupMani
                 result_url="", hashes=get_sample_hashes(), storage="fake", validate_file_hashes=True
             ),
         ),
+        (
+            [ipc.NodeFeatures.validate_file_hashes, ipc.NodeFeatures.upload_checkpoints],
+            ipc.SnapshotUploadRequestV20261018(
+                result_url="",
+                hashes=get_sample_hashes(),
+                storage="fake",
+                validate_file_hashes=True,
+                checkpoint_id="checkpoint",
+            ),
+        ),
     ],
-    ids=["no_feature", "validate_file_hashes"],
+    ids=["no_feature", "validate_file_hashes", "upload_checkpoints"],
 )
 async def test_upload_step_uses_new_request_if_supported(
     node_features: Sequence[ipc.NodeFeatures],
@@ -160,7 +175,7 @@ async def test_upload_step_uses_new_request_if_supported(
     context.set_result(
         SnapshotStep, [ipc.SnapshotResult(hostname="localhost", az="az1", files=1, total_size=2, hashes=sample_hashes)]
     )
-    upload_step = UploadBlocksStep(storage_name="fake")
+    upload_step = UploadBlocksStep(storage_name="fake", checkpoint_id="checkpoint")
     with respx.mock:
         metadata_request = respx.get("http://node_1/metadata").respond(
             json=msgspec.to_builtins(
@@ -187,6 +202,129 @@ async def test_upload_step_uses_new_request_if_supported(
         assert status_request.called
 
 
+async def test_list_hexdigests_step_reuses_listing_on_retry(single_node_cluster: Cluster) -> None:
+    hexdigest_storage = MemoryHexDigestStorage(items={"a": b"a"})
+    step = ListHexdigestsStep(hexdigest_storage=AsyncHexDigestStorage(hexdigest_storage))
+    assert await step.run_step(single_node_cluster, StepsContext(attempt=1)) == {"a"}
+    hexdigest_storage.items["b"] = b"b"
+    assert await step.run_step(single_node_cluster, StepsContext(attempt=2)) == {"a"}
+
+
+@pytest.mark.parametrize(
+    "listed_ago,expected_hexdigests",
+    [(None, {"a", "b"}), (600, {"a"}), (7200, {"a", "b"})],
+    ids=["missing", "fresh", "stale"],
+)
+async def test_list_hexdigests_step_uses_listing_until_it_is_stale(
+    single_node_cluster: Cluster, listed_ago: int | None, expected_hexdigests: set[str]
+) -> None:
+    hexdigest_storage = MemoryHexDigestStorage(items={"a": b"a", "b": b"b"})
+    json_items: dict[str, bytes] = {}
+    if listed_ago is not None:
+        listed_at = utils.now() - datetime.timedelta(seconds=listed_ago)
+        json_items[magic.JSON_HEXDIGEST_LISTING] = msgspec.json.encode(
+            ipc.HexdigestListing(listed_at=listed_at, hexdigests=["a"])
+        )
+    step = ListHexdigestsStep(
+        hexdigest_storage=AsyncHexDigestStorage(hexdigest_storage),
+        json_storage=AsyncJsonStorage(MemoryJsonStorage(items=json_items)),
+        listing_max_age=datetime.timedelta(hours=1),
+    )
+    assert await step.run_step(single_node_cluster, StepsContext()) == expected_hexdigests
+    listing = msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_LISTING], type=ipc.HexdigestListing)
+    assert set(listing.hexdigests) == expected_hexdigests
+    assert utils.now() - listing.listed_at < datetime.timedelta(hours=1)
+
+
+async def test_list_hexdigests_step_sees_listing_updated_by_another_coordinator(
+    single_node_cluster: Cluster, context: StepsContext
+) -> None:
+    stored_hashes = {"a": b"a", "b": b"b"}
+    hexdigest_storage = AsyncHexDigestStorage(MemoryHexDigestStorage(items=stored_hashes))
+    backend_storage = MemoryJsonStorage(items={})
+    # Each operation of a coordinator has its own caching storage, over the persistent cache of the coordinator
+    first_cache_storage = MemoryJsonStorage(items={})
+
+    def _first_coordinator_json_storage() -> AsyncJsonStorage:
+        return AsyncJsonStorage(CachingJsonStorage(backend_storage=backend_storage, cache_storage=first_cache_storage))
+
+    def _list_step() -> ListHexdigestsStep:
+        return ListHexdigestsStep(
+            hexdigest_storage=hexdigest_storage,
+            json_storage=_first_coordinator_json_storage(),
+            listing_max_age=datetime.timedelta(hours=1),
+        )
+
+    assert await _list_step().run_step(single_node_cluster, StepsContext()) == {"a", "b"}
+    assert await _list_step().run_step(single_node_cluster, StepsContext()) == {"a", "b"}
+    second_json_storage = AsyncJsonStorage(
+        CachingJsonStorage(backend_storage=backend_storage, cache_storage=MemoryJsonStorage(items={}))
+    )
+    context.set_result(
+        UpdateHexdigestIndexStep,
+        HexdigestIndexUpdate(index=ipc.HexdigestIndex(references={"a": 1}), unreferenced_hexdigests={"b"}),
+    )
+    cleanup_step = DeleteDanglingHexdigestsStep(
+        json_storage=second_json_storage, hexdigest_storage=hexdigest_storage, index_step=UpdateHexdigestIndexStep
+    )
+    await cleanup_step.run_step(single_node_cluster, context)
+    assert stored_hashes == {"a": b"a"}
+    # A deleted hexdigest in the listing would not be uploaded again by the next backup
+    assert await _list_step().run_step(single_node_cluster, StepsContext()) == {"a"}
+
+
+async def test_upload_step_in_batches(context: StepsContext) -> None:
+    node_urls = ["http://node_1", "http://node_2"]
+    cluster = Cluster(nodes=[CoordinatorNode(url=url) for url in node_urls])
+    shared_hashes = [ipc.SnapshotHash(hexdigest=f"shared{i}", size=10) for i in range(6)]
+    context.set_result(ListHexdigestsStep, {"shared0"})
+    context.set_result(
+        SnapshotStep,
+        [
+            ipc.SnapshotResult(hostname="node1", hashes=[ipc.SnapshotHash(hexdigest="own1", size=10), *shared_hashes]),
+            ipc.SnapshotResult(hostname="node2", hashes=[ipc.SnapshotHash(hexdigest="own2", size=10), *shared_hashes]),
+        ],
+    )
+    uploaded: dict[str, list[list[str]]] = {url: [] for url in node_urls}
+    progresses: list[Progress] = []
+    cluster.set_progress_handler(progresses.append)
+
+    def _upload(request: httpx.Request) -> httpx.Response:
+        node_url = f"{request.url.scheme}://{request.url.host}"
+        hexdigests = [h["hexdigest"] for h in json.loads(request.content)["hashes"]]
+        uploaded[node_url].append(hexdigests)
+        op_id = len(uploaded[node_url])
+        respx.get(f"{node_url}/upload/{op_id}").respond(
+            content=msgspec.json.encode(
+                ipc.SnapshotUploadResult(
+                    hostname=node_url,
+                    progress=Progress(handled=len(hexdigests), total=len(hexdigests), final=True),
+                    total_size=10 * len(hexdigests),
+                )
+            )
+        )
+        return httpx.Response(
+            status_code=HTTPStatus.OK, json=Op.StartResult(op_id=op_id, status_url=f"{node_url}/upload/{op_id}").jsondict()
+        )
+
+    with respx.mock:
+        for node_url in node_urls:
+            respx.get(f"{node_url}/metadata").respond(json=msgspec.to_builtins(ipc.MetadataResult(version="0.1")))
+            respx.post(f"{node_url}/upload").mock(side_effect=_upload)
+        upload_step = UploadBlocksStep(storage_name="fake", upload_batch_size=20)
+        results = await upload_step.run_step(cluster=cluster, context=context)
+    # Each node first uploads what only it has, and then takes shared hashes in batches of 2
+    assert [batches[0][0] for batches in uploaded.values()] == ["own1", "own2"]
+    assert all(len(batch) <= 2 for batches in uploaded.values() for batch in batches)
+    all_uploaded = [h for batches in uploaded.values() for batch in batches for h in batch]
+    assert sorted(all_uploaded) == ["own1", "own2", "shared1", "shared2", "shared3", "shared4", "shared5"]
+    assert [(result.hostname, result.total_size) for result in results] == [
+        (node_url, 10 * sum(len(batch) for batch in uploaded[node_url])) for node_url in node_urls
+    ]
+    assert progresses[-1] == Progress(handled=7, total=7)
+    assert cluster.progress_handler is not None
+
+
 BACKUPS_FOR_RETENTION_TEST = {
     "b1": msgspec.json.encode(make_manifest("2020-01-01T11:00Z", "2020-01-01T13:00Z")),
     "b2": msgspec.json.encode(make_manifest("2020-01-02T11:00Z", "2020-01-02T13:00Z")),
@@ -364,6 +502,155 @@ async def test_delete_dangling_hexdigests_step(
     assert stored_hashes == expected_hashes
 
 
+@pytest.mark.parametrize(
+    "index_update,expected_hashes",
+    [
+        (
+            HexdigestIndexUpdate(index=ipc.HexdigestIndex(references={"a": 1}), unreferenced_hexdigests={"c"}),
+            {"a": b"a", "b": b"b"},
+        ),
+        (
+            HexdigestIndexUpdate(index=ipc.HexdigestIndex(references={"a": 1}), unreferenced_hexdigests=None),
+            {"a": b"a"},
+        ),
+    ],
+)
+async def test_delete_dangling_hexdigests_step_uses_index_update(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+    index_update: HexdigestIndexUpdate,
+    expected_hashes: dict[str, bytes],
+) -> None:
+    stored_hashes = {"a": b"a", "b": b"b", "c": b"c"}
+    async_digest_storage = AsyncHexDigestStorage(storage=MemoryHexDigestStorage(items=stored_hashes))
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items={}))
+    context.set_result(UpdateHexdigestIndexStep, index_update)
+    step = DeleteDanglingHexdigestsStep(
+        json_storage=async_json_storage, hexdigest_storage=async_digest_storage, index_step=UpdateHexdigestIndexStep
+    )
+    await step.run_step(single_node_cluster, context)
+    assert stored_hashes == expected_hashes
+
+
+@pytest.mark.parametrize(
+    "index_update,expected_listing",
+    [
+        (HexdigestIndexUpdate(index=ipc.HexdigestIndex(references={"a": 1}), unreferenced_hexdigests={"b"}), ["a", "c"]),
+        (HexdigestIndexUpdate(index=ipc.HexdigestIndex(references={"a": 1}), unreferenced_hexdigests=None), ["a"]),
+    ],
+    ids=["unreferenced", "rebuilt index"],
+)
+async def test_delete_dangling_hexdigests_step_updates_listing_before_deleting(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+    index_update: HexdigestIndexUpdate,
+    expected_listing: list[str],
+) -> None:
+    stored_hashes = {"a": b"a", "b": b"b", "c": b"c"}
+    listed_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    json_items = {
+        magic.JSON_HEXDIGEST_LISTING: msgspec.json.encode(
+            ipc.HexdigestListing(listed_at=listed_at, hexdigests=["a", "b", "c"])
+        )
+    }
+    async_digest_storage = AsyncHexDigestStorage(storage=MemoryHexDigestStorage(items=stored_hashes))
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items))
+
+    async def _check_listing_first(hexdigests: Sequence[str], **kwargs) -> None:
+        listing = msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_LISTING], type=ipc.HexdigestListing)
+        assert not set(listing.hexdigests) & set(hexdigests)
+
+    context.set_result(UpdateHexdigestIndexStep, index_update)
+    step = DeleteDanglingHexdigestsStep(
+        json_storage=async_json_storage, hexdigest_storage=async_digest_storage, index_step=UpdateHexdigestIndexStep
+    )
+    with mock.patch.object(async_digest_storage, "delete_hexdigests", side_effect=_check_listing_first) as delete:
+        await step.run_step(single_node_cluster, context)
+    assert delete.called
+    listing = msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_LISTING], type=ipc.HexdigestListing)
+    assert listing.hexdigests == expected_listing
+    # Refreshed if the storage was listed
+    assert (listing.listed_at == listed_at) == (index_update.unreferenced_hexdigests is not None)
+
+
+def hexdigest_index_items(index: ipc.HexdigestIndex, manifests: Sequence[ipc.BackupManifest]) -> dict[str, bytes]:
+    items = {m.filename: msgspec.json.encode(m) for m in manifests}
+    items[magic.JSON_HEXDIGEST_INDEX] = msgspec.json.encode(index)
+    return items
+
+
+async def test_update_hexdigest_index_step_only_reads_added_and_removed_backups(
+    single_node_cluster: Cluster, context: StepsContext
+) -> None:
+    removed = manifest_with_hashes({"a": b"a", "b": b"b", "e": b"e"}, 0)
+    kept = manifest_with_hashes({"b": b"b", "c": b"c"}, 1)
+    added = manifest_with_hashes({"a": b"a", "d": b"d"}, 2)
+    index = ipc.HexdigestIndex(manifests=[removed.filename, kept.filename], references={"a": 1, "b": 2, "c": 1, "e": 1})
+    # The kept backup is not in storage: it must not be downloaded again
+    json_items = hexdigest_index_items(index, [removed, added])
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items))
+    context.set_result(ComputeKeptBackupsStep, [ManifestMin.from_manifest(kept), ManifestMin.from_manifest(added)])
+    update = await UpdateHexdigestIndexStep(json_storage=async_json_storage).run_step(single_node_cluster, context)
+    assert update.unreferenced_hexdigests == {"e"}
+    expected_index = ipc.HexdigestIndex(
+        manifests=[kept.filename, added.filename], references={"a": 1, "b": 1, "c": 1, "d": 1}
+    )
+    assert update.index == expected_index
+    assert msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_INDEX], type=ipc.HexdigestIndex) == expected_index
+
+
+@pytest.mark.parametrize(
+    "index,rebuild",
+    [
+        (None, False),
+        (ipc.HexdigestIndex(manifests=["some-manifest-0", "some-manifest-5"], references={"a": 1}), False),
+        (ipc.HexdigestIndex(manifests=["some-manifest-0"], references={"a": 3}), True),
+    ],
+    ids=["missing index", "missing removed manifest", "consistency check"],
+)
+async def test_update_hexdigest_index_step_rebuilds_index(
+    single_node_cluster: Cluster, context: StepsContext, index: ipc.HexdigestIndex | None, rebuild: bool
+) -> None:
+    kept = manifest_with_hashes({"a": b"a", "b": b"b"}, 0)
+    json_items = {kept.filename: msgspec.json.encode(kept)}
+    if index is not None:
+        json_items = hexdigest_index_items(index, [kept])
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items))
+    context.set_result(ComputeKeptBackupsStep, [ManifestMin.from_manifest(kept)])
+    step = UpdateHexdigestIndexStep(json_storage=async_json_storage, rebuild=rebuild)
+    update = await step.run_step(single_node_cluster, context)
+    assert update.unreferenced_hexdigests is None
+    assert update.index.manifests == [kept.filename]
+    assert update.index.references == {"a": 1, "b": 1}
+    assert update.index.rebuilt_at is not None
+    assert magic.JSON_HEXDIGEST_INDEX in json_items
+
+
+@pytest.mark.parametrize("rebuilt_days_ago,expect_deleted", [(None, True), (8, True), (1, False)])
+async def test_cleanup_eventually_deletes_hexdigests_of_failed_uploads(
+    single_node_cluster: Cluster, context: StepsContext, rebuilt_days_ago: int | None, expect_deleted: bool
+) -> None:
+    kept = manifest_with_hashes({"a": b"a"}, 0)
+    rebuilt_at = None if rebuilt_days_ago is None else utils.now() - datetime.timedelta(days=rebuilt_days_ago)
+    index = ipc.HexdigestIndex(manifests=[kept.filename], references={"a": 1}, rebuilt_at=rebuilt_at)
+    json_items = hexdigest_index_items(index, [kept])
+    # "orphan" was uploaded by a failed backup: no manifest refers to it and it never was in the index
+    stored_hashes = {"a": b"a", "orphan": b"orphan"}
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items))
+    async_digest_storage = AsyncHexDigestStorage(storage=MemoryHexDigestStorage(items=stored_hashes))
+    context.set_result(ComputeKeptBackupsStep, [ManifestMin.from_manifest(kept)])
+    index_step = UpdateHexdigestIndexStep(json_storage=async_json_storage, max_age=datetime.timedelta(days=7))
+    context.set_result(UpdateHexdigestIndexStep, await index_step.run_step(single_node_cluster, context))
+    step = DeleteDanglingHexdigestsStep(
+        json_storage=async_json_storage, hexdigest_storage=async_digest_storage, index_step=UpdateHexdigestIndexStep
+    )
+    await step.run_step(single_node_cluster, context)
+    assert ("orphan" not in stored_hashes) == expect_deleted
+    assert "a" in stored_hashes
+    stored_index = msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_INDEX], type=ipc.HexdigestIndex)
+    assert (stored_index.rebuilt_at != rebuilt_at) == expect_deleted
+
+
 async def test_delete_backup_and_delta_manifests_raises_when_delta_steps_are_missing(
     single_node_cluster: Cluster, context: StepsContext
 ) -> None:
@@ -389,6 +676,136 @@ async def test_upload_manifest_step_generates_correct_backup_name(
     assert "backup-2020-01-07T05:00:00+00:00" in async_json_storage.storage.items
 
 
+async def test_upload_manifest_step_does_not_rewrite_hexdigest_index(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+) -> None:
+    context.attempt_start = datetime.datetime(2020, 1, 7, 5, 0, tzinfo=datetime.timezone.utc)
+    context.set_result(
+        SnapshotStep,
+        [DefaultedSnapshotResult(hashes=[SnapshotHash(hexdigest="a", size=1), SnapshotHash(hexdigest="b", size=1)])],
+    )
+    context.set_result(UploadBlocksStep, [ipc.SnapshotUploadResult()])
+    index = ipc.HexdigestIndex(manifests=["backup-2020-01-06T05:00:00+00:00"], references={"a": 1})
+    json_items = {magic.JSON_HEXDIGEST_INDEX: msgspec.json.encode(index)}
+    async_json_storage = AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items))
+    step = UploadManifestStep(json_storage=async_json_storage, plugin=Plugin.files)
+    await step.run_step(cluster=single_node_cluster, context=context)
+    # The next cleanup adds the backup to the index
+    assert msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_INDEX], type=ipc.HexdigestIndex) == index
+
+
+async def test_upload_manifest_step_adds_backup_to_hexdigest_listing(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+) -> None:
+    context.set_result(
+        SnapshotStep,
+        [DefaultedSnapshotResult(hashes=[SnapshotHash(hexdigest="a", size=1), SnapshotHash(hexdigest="b", size=1)])],
+    )
+    context.set_result(UploadBlocksStep, [ipc.SnapshotUploadResult()])
+    listed_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    json_items = {
+        magic.JSON_HEXDIGEST_LISTING: msgspec.json.encode(ipc.HexdigestListing(listed_at=listed_at, hexdigests=["c"]))
+    }
+    step = UploadManifestStep(
+        json_storage=AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items)), plugin=Plugin.files
+    )
+    await step.run_step(cluster=single_node_cluster, context=context)
+    assert msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_LISTING], type=ipc.HexdigestListing) == ipc.HexdigestListing(
+        listed_at=listed_at, hexdigests=["a", "b", "c"]
+    )
+
+
+async def test_upload_manifest_step_updates_hexdigest_listing_before_storing_manifest(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+) -> None:
+    context.attempt_start = datetime.datetime(2020, 1, 7, 5, 0, tzinfo=datetime.timezone.utc)
+    context.set_result(SnapshotStep, [DefaultedSnapshotResult(hashes=[SnapshotHash(hexdigest="a", size=1)])])
+    context.set_result(UploadBlocksStep, [ipc.SnapshotUploadResult()])
+    listed_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    json_items = {
+        magic.JSON_HEXDIGEST_LISTING: msgspec.json.encode(ipc.HexdigestListing(listed_at=listed_at, hexdigests=["c"]))
+    }
+    json_storage = MemoryJsonStorage(items=json_items)
+    step = UploadManifestStep(json_storage=AsyncJsonStorage(storage=json_storage), plugin=Plugin.files)
+    original_upload = json_storage.upload_json_bytes
+
+    def _upload(name: str, data: bytes | mmap.mmap) -> bool:
+        if name.startswith(magic.JSON_BACKUP_PREFIX):
+            listing = msgspec.json.decode(json_items[magic.JSON_HEXDIGEST_LISTING], type=ipc.HexdigestListing)
+            assert listing.hexdigests == ["a", "c"]
+        return original_upload(name, data)
+
+    with mock.patch.object(MemoryJsonStorage, "upload_json_bytes", side_effect=_upload):
+        await step.run_step(cluster=single_node_cluster, context=context)
+    assert "backup-2020-01-07T05:00:00+00:00" in json_items
+
+
+async def test_upload_manifest_step_deletes_hexdigest_listing_it_fails_to_update(
+    single_node_cluster: Cluster,
+    context: StepsContext,
+) -> None:
+    context.attempt_start = datetime.datetime(2020, 1, 7, 5, 0, tzinfo=datetime.timezone.utc)
+    context.set_result(SnapshotStep, [DefaultedSnapshotResult(hashes=[SnapshotHash(hexdigest="a", size=1)])])
+    context.set_result(UploadBlocksStep, [ipc.SnapshotUploadResult()])
+    listed_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    json_items = {
+        magic.JSON_HEXDIGEST_LISTING: msgspec.json.encode(ipc.HexdigestListing(listed_at=listed_at, hexdigests=["c"]))
+    }
+    step = UploadManifestStep(
+        json_storage=AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items)), plugin=Plugin.files
+    )
+    with mock.patch("astacus.coordinator.plugins.base.upload_hexdigest_listing", side_effect=exceptions.TransientException):
+        await step.run_step(cluster=single_node_cluster, context=context)
+    # The next backups list the storage instead of trusting a listing without the hexdigests of this one
+    assert magic.JSON_HEXDIGEST_LISTING not in json_items
+    assert "backup-2020-01-07T05:00:00+00:00" in json_items
+
+
+@pytest.mark.parametrize("node_features", [[], [ipc.NodeFeatures.snapshot_state_columns]])
+async def test_upload_manifest_step_stores_state_columns_if_supported(
+    node_features: Sequence[ipc.NodeFeatures],
+    single_node_cluster: Cluster,
+    context: StepsContext,
+) -> None:
+    context.attempt_start = datetime.datetime(2020, 1, 7, 5, 0, tzinfo=datetime.timezone.utc)
+    state = ipc.SnapshotState(
+        root_globs=["**"],
+        files=[
+            ipc.SnapshotFile(relative_path="top", file_size=3, mtime_ns=1, content_b64="dG9w"),
+            ipc.SnapshotFile(relative_path="a/b/c", file_size=1000, mtime_ns=2, hexdigest="h1"),
+            ipc.SnapshotFile(
+                relative_path="a/b/d",
+                file_size=2048,
+                mtime_ns=3,
+                hexdigest="h2",
+                chunks=[SnapshotHash(hexdigest="h3", size=1024), SnapshotHash(hexdigest="h4", size=1024)],
+            ),
+            ipc.SnapshotFile(relative_path="a/e", file_size=1000, mtime_ns=4, hexdigest="h1"),
+        ],
+    )
+    context.set_result(SnapshotStep, [DefaultedSnapshotResult(state=state)])
+    context.set_result(UploadBlocksStep, [ipc.SnapshotUploadResult()])
+    json_items: dict[str, bytes] = {}
+    step = UploadManifestStep(
+        json_storage=AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items)), plugin=Plugin.files
+    )
+    with respx.mock:
+        respx.get("http://node_1/metadata").respond(
+            json=msgspec.to_builtins(
+                ipc.MetadataResult(version="0.1", features=[feature.value for feature in node_features])
+            ),
+        )
+        await step.run_step(cluster=single_node_cluster, context=context)
+    manifest = msgspec.json.decode(json_items["backup-2020-01-07T05:00:00+00:00"], type=ipc.BackupManifest)
+    snapshot_result = manifest.snapshot_results[0]
+    assert (snapshot_result.state_columns is not None) == bool(node_features)
+    assert snapshot_result.get_state() == state
+    assert snapshot_result.get_root_globs() == ["**"]
+
+
 @pytest.mark.parametrize(
     "node_features,expected_request",
     [
@@ -497,3 +914,15 @@ async def test_list_delta_backups(p: ListDeltasParam) -> None:
     context.set_result(BackupManifestStep, p.basebackup_manifest)
     backup_names = [b.filename for b in await step.run_step(cluster=cluster, context=context)]
     assert backup_names == p.expected_deltas
+
+
+async def test_backup_name_step_selects_the_latest_backup(single_node_cluster: Cluster, context: StepsContext) -> None:
+    json_items = {
+        "backup-2020-01-06T05:00:00+00:00": b"{}",
+        "backup-2020-01-07T05:00:00+00:00": b"{}",
+        "delta-2020-01-08T05:00:00+00:00": b"{}",
+        magic.JSON_HEXDIGEST_INDEX: b"{}",
+        magic.JSON_HEXDIGEST_LISTING: b"{}",
+    }
+    step = BackupNameStep(json_storage=AsyncJsonStorage(storage=MemoryJsonStorage(items=json_items)), requested_name="")
+    assert await step.run_step(single_node_cluster, context) == "backup-2020-01-07T05:00:00+00:00"
@@ -45,6 +45,10 @@ def test_backup(fail_at: int | None, app: FastAPI, client: TestClient, storage:
                 json={"progress": {"final": True}, "hashes": [{"hexdigest": "HASH", "size": 42}]},
                 status_code=200 if fail_at != 3 else 500,
             )
+            respx.get(f"{node.url}/snapshot/result/page").respond(
+                json={"result": {"progress": {"final": True}, "hashes": []}, "hashes": [{"hexdigest": "HASH", "size": 42}]},
+                status_code=200 if fail_at != 3 else 500,
+            )
 
             # Failure point 4: upload call fails
             respx.post(f"{node.url}/upload").respond(
@@ -177,6 +181,9 @@ def test_backup_stats(mock_time: Mock, app: FastAPI, client: TestClient) -> None
             respx.get(f"{node.url}/snapshot/result").respond(
                 json={"progress": {"final": True}, "hashes": [{"hexdigest": "HASH", "size": 42}]}
             )
+            respx.get(f"{node.url}/snapshot/result/page").respond(
+                json={"result": {"progress": {"final": True}, "hashes": []}, "hashes": [{"hexdigest": "HASH", "size": 42}]}
+            )
             respx.post(f"{node.url}/upload").respond(json={"op_id": 43, "status_url": f"{node.url}/upload/result"})
             respx.get(f"{node.url}/upload/result").respond(json={"progress": {"final": True}})
 
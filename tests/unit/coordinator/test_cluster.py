@@ -0,0 +1,207 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+"""
+from astacus.common import ipc
+from astacus.common.op import Op
+from astacus.common.progress import Progress
+from astacus.common.statsd import StatsClient
+from astacus.coordinator.cluster import Cluster, ConnectionStatsTracer, WaitResultError
+from astacus.coordinator.config import CoordinatorNode, PollConfig
+from unittest.mock import Mock
+
+import asyncio
+import httpx
+import msgspec
+import pytest
+import respx
+
+NODE_URL = "http://node_1"
+
+
+def _progress_response(progress: Progress) -> httpx.Response:
+    return httpx.Response(200, content=msgspec.json.encode(ipc.NodeResult(progress=progress)))
+
+
+@pytest.fixture(name="cluster")
+def fixture_cluster() -> Cluster:
+    return Cluster(nodes=[CoordinatorNode(url=NODE_URL)], poll_config=PollConfig(delay_start=0, maximum_failures=2))
+
+
+async def test_wait_successful_results_fetches_full_result_once_final(cluster: Cluster) -> None:
+    start_result = Op.StartResult(
+        op_id=1, status_url=f"{NODE_URL}/snapshot/1", progress_url=f"{NODE_URL}/snapshot/1/progress"
+    ).jsondict()
+    seen_progress: list[Progress] = []
+    cluster.set_progress_handler(seen_progress.append)
+    with respx.mock:
+        progress_route = respx.get(f"{NODE_URL}/snapshot/1/progress").mock(
+            side_effect=[
+                _progress_response(Progress(handled=1, total=2)),
+                _progress_response(Progress(handled=2, total=2, final=True)),
+            ]
+        )
+        result_route = respx.get(f"{NODE_URL}/snapshot/1").respond(
+            content=msgspec.json.encode(ipc.NodeResult(hostname="node1", progress=Progress(handled=2, total=2, final=True)))
+        )
+        results = await cluster.wait_successful_results(start_results=[start_result], result_class=ipc.NodeResult)
+    assert progress_route.call_count == 2
+    assert result_route.call_count == 1
+    assert [result.hostname for result in results] == ["node1"]
+    assert [progress.handled for progress in seen_progress] == [1, 2, 2]
+
+
+async def test_wait_successful_results_polls_full_result_without_progress_url(cluster: Cluster) -> None:
+    start_result = {"op_id": 1, "status_url": f"{NODE_URL}/snapshot/1"}
+    with respx.mock:
+        result_route = respx.get(f"{NODE_URL}/snapshot/1").mock(
+            side_effect=[
+                httpx.Response(200, content=msgspec.json.encode(ipc.NodeResult(progress=Progress(handled=1, total=2)))),
+                httpx.Response(200, content=msgspec.json.encode(ipc.NodeResult(progress=Progress(final=True)))),
+            ]
+        )
+        results = await cluster.wait_successful_results(start_results=[start_result], result_class=ipc.NodeResult)
+    assert result_route.call_count == 2
+    assert results[0].progress.final
+
+
+async def test_wait_successful_results_fails_on_failed_progress(cluster: Cluster) -> None:
+    start_result = Op.StartResult(
+        op_id=1, status_url=f"{NODE_URL}/snapshot/1", progress_url=f"{NODE_URL}/snapshot/1/progress"
+    ).jsondict()
+    failed_progress = Progress(failed=1, final=True)
+    with respx.mock:
+        respx.get(f"{NODE_URL}/snapshot/1/progress").mock(return_value=_progress_response(failed_progress))
+        result_route = respx.get(f"{NODE_URL}/snapshot/1").respond(json={})
+        with pytest.raises(WaitResultError):
+            await cluster.wait_successful_results(start_results=[start_result], result_class=ipc.NodeResult)
+    assert result_route.call_count == 0
+
+
+async def test_wait_successful_results_polls_nodes_concurrently() -> None:
+    node_urls = ["http://node_1", "http://node_2"]
+    stats = Mock(spec=StatsClient)
+    cluster = Cluster(
+        nodes=[CoordinatorNode(url=url) for url in node_urls], poll_config=PollConfig(delay_start=0), stats=stats
+    )
+    start_results = [
+        Op.StartResult(op_id=1, status_url=f"{url}/snapshot/1", progress_url=f"{url}/snapshot/1/progress").jsondict()
+        for url in node_urls
+    ]
+    both_polled = asyncio.Barrier(len(node_urls))
+
+    async def _poll_progress(request: httpx.Request) -> httpx.Response:
+        # Deadlocks unless the nodes are polled at the same time
+        await asyncio.wait_for(both_polled.wait(), timeout=5)
+        return _progress_response(Progress(final=True))
+
+    with respx.mock:
+        for url in node_urls:
+            respx.get(f"{url}/snapshot/1/progress").mock(side_effect=_poll_progress)
+            respx.get(f"{url}/snapshot/1").respond(
+                content=msgspec.json.encode(ipc.NodeResult(hostname=url, progress=Progress(final=True)))
+            )
+        results = await cluster.wait_successful_results(start_results=start_results, result_class=ipc.NodeResult)
+    assert [result.hostname for result in results] == node_urls
+    polled_nodes = {(call.kwargs["tags"]["node"], call.kwargs["tags"]["endpoint"]) for call in stats.timing.call_args_list}
+    assert polled_nodes == {(node, endpoint) for node in ["node_1", "node_2"] for endpoint in ["progress", "result"]}
+    assert all(call.kwargs["inc_value"] > 0 for call in stats.increase.call_args_list)
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 5, 100])
+async def test_wait_successful_snapshot_results_assembles_pages(page_size: int) -> None:
+    cluster = Cluster(
+        nodes=[CoordinatorNode(url=NODE_URL)], poll_config=PollConfig(delay_start=0, result_page_size=page_size)
+    )
+    snapshot_result = ipc.SnapshotResult(
+        hostname="node1",
+        progress=Progress(final=True),
+        state=ipc.SnapshotState(
+            root_globs=["*"],
+            files=[
+                ipc.SnapshotFile(relative_path=f"file{i}", file_size=100, mtime_ns=0, hexdigest=f"digest{i}")
+                for i in range(4)
+            ],
+        ),
+        files=4,
+        total_size=400,
+        hashes=[ipc.SnapshotHash(hexdigest=f"digest{i}", size=100) for i in range(4)],
+    )
+
+    def _get_page(request: httpx.Request) -> httpx.Response:
+        cursor, limit = int(request.url.params["cursor"]), int(request.url.params["limit"])
+        assert limit == page_size
+        return httpx.Response(200, content=msgspec.json.encode(snapshot_result.get_page(cursor=cursor, limit=limit)))
+
+    start_result = Op.StartResult(
+        op_id=1, status_url=f"{NODE_URL}/snapshot/1", progress_url=f"{NODE_URL}/snapshot/1/progress"
+    ).jsondict()
+    with respx.mock:
+        respx.get(f"{NODE_URL}/snapshot/1/progress").mock(return_value=_progress_response(Progress(final=True)))
+        page_route = respx.get(f"{NODE_URL}/snapshot/1/page").mock(side_effect=_get_page)
+        results = await cluster.wait_successful_snapshot_results(start_results=[start_result])
+    assert results == [snapshot_result]
+    assert page_route.call_count == -(-8 // page_size)
+
+
+async def test_cluster_reuses_http_client_until_closed(cluster: Cluster) -> None:
+    with respx.mock:
+        respx.get(f"{NODE_URL}/metadata").respond(json={})
+        await cluster.request_from_nodes("metadata", method="get", caller="test")
+        http_client = cluster._get_http_client()  # pylint: disable=protected-access
+        await cluster.request_from_nodes("metadata", method="get", caller="test")
+        assert cluster._get_http_client() is http_client  # pylint: disable=protected-access
+    await cluster.aclose()
+    assert http_client.is_closed
+
+
+async def test_connection_stats_tracer() -> None:
+    stats = Mock(spec=StatsClient)
+    new_connection = ConnectionStatsTracer(stats=stats, url=f"{NODE_URL}/metadata")
+    for event_name in [
+        "connection.connect_tcp.started",
+        "connection.connect_tcp.complete",
+        "connection.start_tls.started",
+        "connection.start_tls.complete",
+        "http11.send_request_headers.started",
+        "http11.send_request_headers.complete",
+    ]:
+        await new_connection(event_name, {})
+    reused_connection = ConnectionStatsTracer(stats=stats, url=f"{NODE_URL}/metadata")
+    await reused_connection("http11.send_request_headers.started", {})
+    assert [call.args[0] for call in stats.timing.call_args_list] == [
+        "astacus_node_http_connect_tcp_duration",
+        "astacus_node_http_start_tls_duration",
+    ]
+    assert [call.kwargs["tags"] for call in stats.increase.call_args_list] == [
+        {"node": "node_1", "connection": "new"},
+        {"node": "node_1", "connection": "reused"},
+    ]
+
+
+@pytest.mark.parametrize("metadata_ttl,expected_requests", [(300, 1), (0, 3)])
+async def test_get_nodes_metadata_is_cached(metadata_ttl: float, expected_requests: int) -> None:
+    cluster = Cluster(nodes=[CoordinatorNode(url=NODE_URL)], metadata_ttl=metadata_ttl)
+    with respx.mock:
+        metadata_route = respx.get(f"{NODE_URL}/metadata").respond(
+            content=msgspec.json.encode(ipc.MetadataResult(version="1.0", features=["feature"]))
+        )
+        for _ in range(3):
+            assert await cluster.get_nodes_metadata() == [ipc.MetadataResult(version="1.0", features=["feature"])]
+    assert metadata_route.call_count == expected_requests
+
+
+async def test_get_nodes_metadata_does_not_cache_failures() -> None:
+    nodes = [CoordinatorNode(url="http://node_1"), CoordinatorNode(url="http://node_2")]
+    cluster = Cluster(nodes=nodes)
+    metadata = ipc.MetadataResult(version="1.0", features=["feature"])
+    with respx.mock:
+        node_1_route = respx.get("http://node_1/metadata").respond(content=msgspec.json.encode(metadata))
+        node_2_route = respx.get("http://node_2/metadata").mock(
+            side_effect=[httpx.Response(500), httpx.Response(200, content=msgspec.json.encode(metadata))]
+        )
+        assert await cluster.get_nodes_metadata() == [metadata, ipc.MetadataResult(version="", features=[])]
+        assert await cluster.get_nodes_metadata(nodes=nodes[1:]) == [metadata]
+        assert await cluster.get_nodes_metadata() == [metadata, metadata]
+    assert node_1_route.call_count == 1
+    assert node_2_route.call_count == 2
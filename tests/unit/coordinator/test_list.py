@@ -21,6 +21,7 @@ from astacus.common.rohmustorage import MultiRohmuStorage
 from astacus.coordinator import api
 from astacus.coordinator.api import get_cache_entries_from_list_response
 from astacus.coordinator.list import compute_deduplicated_snapshot_file_stats, list_backups
+from astacus.coordinator.plugins.base import to_state_columns
 from fastapi.testclient import TestClient
 from os import PathLike
 from pytest_mock import MockerFixture
@@ -28,6 +29,7 @@ from tests.utils import create_rohmu_config
 from unittest import mock
 
 import datetime
+import msgspec
 import pytest
 
 
@@ -222,6 +224,15 @@ def test_compute_deduplicated_snapshot_file_stats(backup_manifest: BackupManifes
     assert (num_files, total_size) == (6, 6000)
 
 
+def test_compute_deduplicated_snapshot_file_stats_from_state_columns(backup_manifest: BackupManifest) -> None:
+    columns_manifest = msgspec.structs.replace(
+        backup_manifest, snapshot_results=[to_state_columns(result) for result in backup_manifest.snapshot_results]
+    )
+    assert all(result.state is None for result in columns_manifest.snapshot_results)
+    num_files, total_size = compute_deduplicated_snapshot_file_stats(columns_manifest)
+    assert (num_files, total_size) == (6, 6000)
+
+
 def test_api_list_deduplication(backup_manifest: BackupManifest, tmpdir: PathLike) -> None:
     """Test the list backup operation correctly deduplicates snapshot files when computing stats."""
     multi_rohmu_storage = MultiRohmuStorage(config=create_rohmu_config(tmpdir))
@@ -0,0 +1,27 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+"""
+from astacus.common import ipc
+from astacus.common.asyncstorage import AsyncJsonStorage
+from astacus.common.cachingjsonstorage import CachingJsonStorage
+from astacus.coordinator.manifest import download_hexdigest_index, upload_hexdigest_index
+from tests.unit.storage import MemoryJsonStorage
+
+
+def create_coordinator_json_storage(backend_storage: MemoryJsonStorage) -> AsyncJsonStorage:
+    return AsyncJsonStorage(
+        storage=CachingJsonStorage(backend_storage=backend_storage, cache_storage=MemoryJsonStorage(items={}))
+    )
+
+
+async def test_hexdigest_index_is_not_served_from_the_cache() -> None:
+    backend_storage = MemoryJsonStorage(items={})
+    first = create_coordinator_json_storage(backend_storage)
+    second = create_coordinator_json_storage(backend_storage)
+    old_index = ipc.HexdigestIndex(manifests=["backup-1"], references={"a": 1})
+    new_index = ipc.HexdigestIndex(manifests=["backup-1", "backup-2"], references={"a": 2, "b": 1})
+    await upload_hexdigest_index(first, old_index)
+    assert await download_hexdigest_index(first) == old_index
+    await upload_hexdigest_index(second, new_index)
+    assert await download_hexdigest_index(first) == new_index
@@ -24,7 +24,7 @@ import msgspec
 import pytest
 import respx
 
-BACKUP_NAME = "dummybackup"
+BACKUP_NAME = "backup-dummy"
 
 BACKUP_MANIFEST = ipc.BackupManifest(
     start=datetime(2020, 1, 1, 21, 43, tzinfo=UTC),
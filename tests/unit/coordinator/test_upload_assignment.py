@@ -0,0 +1,119 @@
+"""
+Copyright (c) 2026 Aiven Ltd
+See LICENSE for details
+"""
+from astacus.common import ipc
+from astacus.common.asyncstorage import AsyncJsonStorage
+from astacus.common.ipc import Plugin
+from astacus.common.progress import Progress
+from astacus.coordinator.plugins.base import build_node_index_datas
+from astacus.coordinator.upload_assignment import (
+    download_upload_history,
+    estimate_upload_costs,
+    fit_upload_cost,
+    UploadBatchScheduler,
+    UploadCost,
+    UploadSample,
+)
+from tests.unit.storage import MemoryJsonStorage
+
+import datetime
+import msgspec
+import pytest
+
+START = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _upload_result(hostname: str, *, size: int, files: int, seconds: float) -> ipc.SnapshotUploadResult:
+    return ipc.SnapshotUploadResult(
+        hostname=hostname,
+        progress=Progress(handled=files, total=files, final=True),
+        total_size=size,
+        start=START,
+        end=START + datetime.timedelta(seconds=seconds),
+    )
+
+
+def test_fit_upload_cost_separates_bytes_and_files() -> None:
+    cost = UploadCost(seconds_per_byte=1e-6, seconds_per_file=0.01)
+    samples = [
+        UploadSample(size=size, files=files, seconds=cost.estimate(size=size, files=files))
+        for size, files in [(10_000_000, 10), (1_000_000, 1000), (5_000_000, 200)]
+    ]
+    fitted = fit_upload_cost(samples)
+    assert fitted is not None
+    assert fitted.seconds_per_byte == pytest.approx(cost.seconds_per_byte)
+    assert fitted.seconds_per_file == pytest.approx(cost.seconds_per_file)
+
+
+def test_fit_upload_cost_attributes_proportional_samples_to_bytes() -> None:
+    samples = [UploadSample(size=1000, files=10, seconds=2.0), UploadSample(size=2000, files=20, seconds=4.0)]
+    assert fit_upload_cost(samples) == UploadCost(seconds_per_byte=0.002)
+    assert fit_upload_cost([]) is None
+
+
+def test_estimate_upload_costs() -> None:
+    results = [
+        _upload_result("fast", size=1000, files=10, seconds=1.0),
+        _upload_result("slow", size=1000, files=10, seconds=3.0),
+        # Without timing (older nodes) or not finished: ignored
+        ipc.SnapshotUploadResult(hostname="slow", progress=Progress(total=1, final=True), total_size=1),
+        ipc.SnapshotUploadResult(hostname="fast", progress=Progress(total=1), total_size=1, start=START, end=START),
+    ]
+    costs = estimate_upload_costs(results, ["fast", "slow", "new"])
+    assert costs is not None
+    assert [cost.estimate(size=1000, files=0) for cost in costs] == pytest.approx([1.0, 3.0, 2.0])
+    assert estimate_upload_costs(results[2:], ["fast"]) is None
+
+
+def test_build_node_index_datas_balances_expected_upload_time() -> None:
+    hashes = [ipc.SnapshotHash(hexdigest=f"hash{i}", size=100) for i in range(8)]
+    snapshots = [ipc.SnapshotResult(hashes=hashes), ipc.SnapshotResult(hashes=hashes)]
+    by_size = build_node_index_datas(hexdigests=set(), snapshots=snapshots, node_indices=[0, 1])
+    assert [len(data.sshashes) for data in by_size] == [4, 4]
+    costs = [UploadCost(seconds_per_byte=1.0), UploadCost(seconds_per_byte=3.0)]
+    by_cost = build_node_index_datas(hexdigests=set(), snapshots=snapshots, node_indices=[0, 1], costs=costs)
+    assert [len(data.sshashes) for data in by_cost] == [6, 2]
+
+
+async def test_download_upload_history_uses_latest_backups() -> None:
+    def _manifest(hostname: str) -> bytes:
+        return msgspec.json.encode(
+            ipc.BackupManifest(
+                start=START,
+                attempt=1,
+                snapshot_results=[],
+                upload_results=[_upload_result(hostname, size=1, files=1, seconds=1.0)],
+                plugin=Plugin.files,
+            )
+        )
+
+    json_storage = AsyncJsonStorage(
+        storage=MemoryJsonStorage(
+            items={
+                "backup-1": _manifest("node1"),
+                "backup-2": _manifest("node2"),
+                "backup-3": _manifest("node3"),
+                "delta-4": _manifest("node4"),
+            }
+        )
+    )
+    history = await download_upload_history(json_storage, backups=2)
+    assert sorted(result.hostname for result in history) == ["node2", "node3"]
+    assert not await download_upload_history(json_storage, backups=0)
+
+
+def test_upload_batch_scheduler_shares_replicated_hashes() -> None:
+    own = [ipc.SnapshotHash(hexdigest=f"own{i}", size=100) for i in range(2)]
+    shared = [ipc.SnapshotHash(hexdigest=f"shared{i}", size=10) for i in range(4)]
+    snapshots = [ipc.SnapshotResult(hashes=[*shared, own[0]]), ipc.SnapshotResult(hashes=[own[1], *shared])]
+    scheduler = UploadBatchScheduler(hexdigests={"shared3"}, snapshots=snapshots, batch_size=20)
+    assert scheduler.total == 5
+    # Own hashes first, even if larger than the batch size
+    assert scheduler.next_batch(0) == [own[0]]
+    # The first node is faster, and gets to most of the shared hashes
+    assert scheduler.next_batch(0) == shared[0:2]
+    assert scheduler.next_batch(1) == [own[1]]
+    assert scheduler.next_batch(0) == [shared[2]]
+    assert scheduler.next_batch(1) == []
+    assert scheduler.next_batch(0) == []
@@ -7,7 +7,7 @@ from astacus.common import ipc, magic, utils
 from astacus.common.progress import Progress
 from astacus.common.snapshot import SnapshotGroup
 from astacus.common.storage import FileStorage
-from astacus.node.download import Downloader
+from astacus.node.download import download_snapshot, Downloader, link_or_copy_file
 from astacus.node.sqlite_snapshot import SQLiteSnapshot
 from astacus.node.uploader import Uploader
 from fastapi.testclient import TestClient
@@ -16,10 +16,13 @@ from pytest_mock import MockerFixture
 from tests.unit.node.conftest import build_snapshot_and_snapshotter, create_files_at_path
 
 import msgspec
+import os
 import pytest
+import stat
 
 
 @pytest.mark.parametrize("src_is_dst", [True, False])
+@pytest.mark.parametrize("large_parallel", [0, 1])
 def test_download(
     storage: FileStorage,
     uploader: Uploader,
@@ -28,6 +31,7 @@ def test_download(
     dst: Path,
     db: Path,
     src_is_dst: bool,
+    large_parallel: int,
 ) -> None:
     if src_is_dst:
         dst = src
@@ -58,7 +62,10 @@ def test_download(
     db2 = Path(root / "db2")
 
     snapshot, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, db2, SQLiteSnapshot, [SnapshotGroup("**")])
-    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1)
+    # With the lanes, the "foobig" files are downloaded in the lane of the large objects
+    downloader = Downloader(
+        storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1, large_parallel=large_parallel, large_size=1000
+    )
     with snapshotter.lock:
         downloader.download_from_storage(progress=Progress(), snapshotstate=ss1)
 
@@ -72,6 +79,185 @@ def test_download(
         assert ssfile1.equals_excluding_mtime(ssfile2)
 
 
+def test_download_chunked_files(
+    storage: FileStorage, uploader: Uploader, root: Path, src: Path, dst: Path, db: Path
+) -> None:
+    big = bytes(i % 251 for i in range(5120))
+    create_files_at_path(src, [("big", big), ("big2", big), ("small", b"small" * 100)])
+    groups = [SnapshotGroup("**", embedded_file_size_max=0, chunk_size=1024)]
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, groups)
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+        hashes = list(snapshot.get_all_digests())
+
+    uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes, progress=Progress(), parallel=1)
+    big_file = snapshot.get_file("big")
+    assert big_file is not None
+    assert big_file.hexdigest not in storage.list_hexdigests()
+    assert {chunk.hexdigest for chunk in big_file.chunks} <= set(storage.list_hexdigests())
+
+    dst2 = Path(root / "dst2")
+    dst2.mkdir()
+    dst3 = Path(root / "dst3")
+    dst3.mkdir()
+    snapshot, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, root / "db2", SQLiteSnapshot, groups)
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1)
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=Progress(), snapshotstate=ss1)
+    assert (dst2 / "big").read_bytes() == big
+    assert (dst2 / "big2").read_bytes() == big
+    assert (dst2 / "small").read_bytes() == b"small" * 100
+
+
+@pytest.mark.parametrize("hardlink_duplicates", [False, True])
+def test_download_duplicate_files(
+    storage: FileStorage, uploader: Uploader, root: Path, src: Path, dst: Path, db: Path, hardlink_duplicates: bool
+) -> None:
+    content = b"duplicate" * magic.DEFAULT_EMBEDDED_FILE_SIZE
+    create_files_at_path(src, [("a", content), ("b", content), ("c", content)])
+    # Only files with the same metadata can be hardlinked
+    for name in ["a", "b", "c"]:
+        os.utime(src / name, ns=(1_000_000_000, 1_000_000_000))
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, [SnapshotGroup("**")])
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+        hashes = list(snapshot.get_all_digests())
+    uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes, progress=Progress(), parallel=1)
+
+    dst2 = Path(root / "dst2")
+    dst2.mkdir()
+    dst3 = Path(root / "dst3")
+    dst3.mkdir()
+    snapshot, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, root / "db2", SQLiteSnapshot, [SnapshotGroup("**")])
+    downloader = Downloader(
+        storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1, hardlink_duplicates=hardlink_duplicates
+    )
+    progress = Progress()
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=progress, snapshotstate=ss1)
+    assert [(dst2 / name).read_bytes() for name in ["a", "b", "c"]] == [content] * 3
+    assert len({(dst2 / name).stat().st_ino for name in ["a", "b", "c"]}) == (1 if hardlink_duplicates else 3)
+    # The content is downloaded once, and then each of the files is restored
+    assert progress.finished_successfully
+    assert progress.total == len(content) + 3
+
+
+def test_download_skips_present_files_and_copies_local_duplicates(
+    storage: FileStorage, root: Path, src: Path, dst: Path, db: Path
+) -> None:
+    content = b"duplicate" * magic.DEFAULT_EMBEDDED_FILE_SIZE
+    create_files_at_path(src, [("a", content), ("b", content), ("c", b"other" * magic.DEFAULT_EMBEDDED_FILE_SIZE)])
+    _, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, [SnapshotGroup("**")])
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+
+    # Nothing was uploaded: the files must be restored from the destination
+    dst2 = Path(root / "dst2")
+    create_files_at_path(dst2, [("a", content), ("c", b"other" * magic.DEFAULT_EMBEDDED_FILE_SIZE), ("extra", b"x")])
+    dst3 = Path(root / "dst3")
+    dst3.mkdir()
+    _, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, root / "db2", SQLiteSnapshot, [SnapshotGroup("**")])
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1)
+    progress = Progress()
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=progress, snapshotstate=ss1)
+    assert (dst2 / "b").read_bytes() == content
+    assert not (dst2 / "extra").exists()
+    assert progress.finished_successfully
+    # Only the copy of "b" was done
+    assert progress.total == 1
+
+
+def test_download_reuses_local_files_at_other_paths(
+    storage: FileStorage, root: Path, src: Path, dst: Path, db: Path
+) -> None:
+    content = b"moved" * magic.DEFAULT_EMBEDDED_FILE_SIZE
+    create_files_at_path(src, [("new/name", content)])
+    _, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, [SnapshotGroup("**")])
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+
+    # Nothing was uploaded: the file must be restored from its old path, which is then deleted
+    dst2 = Path(root / "dst2")
+    create_files_at_path(dst2, [("old/name", content)])
+    dst3 = Path(root / "dst3")
+    dst3.mkdir()
+    _, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, root / "db2", SQLiteSnapshot, [SnapshotGroup("**")])
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1)
+    progress = Progress()
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=progress, snapshotstate=ss1)
+    assert (dst2 / "new/name").read_bytes() == content
+    assert not (dst2 / "old/name").exists()
+    assert progress.finished_successfully
+    assert progress.total == 1
+
+
+def test_download_does_not_hardlink_local_files_with_other_metadata(
+    storage: FileStorage, root: Path, src: Path, dst: Path, db: Path
+) -> None:
+    content = b"moved" * magic.DEFAULT_EMBEDDED_FILE_SIZE
+    create_files_at_path(src, [("new/name", content)])
+    mtime_ns = (src / "new/name").stat().st_mtime_ns
+    _, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, [SnapshotGroup("**")])
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+
+    dst2 = Path(root / "dst2")
+    create_files_at_path(dst2, [("old/name", content)])
+    os.chmod(dst2 / "old/name", 0o604)
+    os.utime(dst2 / "old/name", ns=(mtime_ns - 1_000_000_000, mtime_ns - 1_000_000_000))
+    dst3 = Path(root / "dst3")
+    dst3.mkdir()
+    _, snapshotter = build_snapshot_and_snapshotter(dst2, dst3, root / "db2", SQLiteSnapshot, [SnapshotGroup("**")])
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1, hardlink_duplicates=True)
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=Progress(), snapshotstate=ss1)
+    restored = (dst2 / "new/name").stat()
+    assert (dst2 / "new/name").read_bytes() == content
+    assert restored.st_mtime_ns == mtime_ns
+    assert stat.S_IMODE(restored.st_mode) == 0o660 & ~utils.get_umask()
+
+
+def test_link_or_copy_file(tmp_path: Path) -> None:
+    src = tmp_path / "src"
+    src.write_bytes(b"content")
+    assert link_or_copy_file(src, tmp_path / "copy") in {"reflink", "copy_file_range", "copy"}
+    assert (tmp_path / "copy").read_bytes() == b"content"
+    assert (tmp_path / "copy").stat().st_ino != src.stat().st_ino
+    # The destination is replaced
+    (tmp_path / "link").write_bytes(b"old content that is longer")
+    assert link_or_copy_file(src, tmp_path / "link", hardlink=True) == "hardlink"
+    assert (tmp_path / "link").stat().st_ino == src.stat().st_ino
+
+
+def test_download_snapshot_decodes_state_columns(storage: FileStorage) -> None:
+    state = ipc.SnapshotState(
+        root_globs=["**"],
+        files=[
+            ipc.SnapshotFile(relative_path="a/b", file_size=1, mtime_ns=1, hexdigest="h1"),
+            ipc.SnapshotFile(relative_path="c", file_size=2, mtime_ns=2, content_b64="Yw=="),
+        ],
+    )
+    manifest = ipc.BackupManifest(
+        start=utils.now(),
+        attempt=1,
+        snapshot_results=[
+            ipc.SnapshotResult(),
+            ipc.SnapshotResult(state=None, state_columns=ipc.SnapshotStateColumns.from_state(state)),
+        ],
+        upload_results=[],
+        plugin=ipc.Plugin.files,
+    )
+    storage.upload_json("backup-1", manifest)
+    assert download_snapshot(storage, "backup-1", 1).get_state() == state
+
+
 def test_api_download(client: TestClient, mocker: MockerFixture) -> None:
     mocker.patch.object(utils, "http_request")
     response = client.post("/node/download")
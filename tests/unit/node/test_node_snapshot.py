@@ -6,7 +6,8 @@ See LICENSE for details
 from astacus.common import ipc, magic, utils
 from astacus.common.progress import Progress
 from astacus.common.snapshot import SnapshotGroup
-from astacus.common.storage import JsonObject
+from astacus.common.storage import FileStorage, JsonObject
+from astacus.common.upload_checkpoint import UploadCheckpoint
 from astacus.node.snapshot_op import SnapshotOp
 from astacus.node.sqlite_snapshot import SQLiteSnapshot
 from astacus.node.uploader import Uploader
@@ -157,6 +158,52 @@ def test_api_snapshot_error(client: TestClient, mocker: MockerFixture) -> None:
     assert progress["final"]
 
 
+def test_api_snapshot_progress(client: TestClient) -> None:
+    response = client.post("/node/lock?locker=x&ttl=10")
+    assert response.status_code == 200, response.json()
+    response = client.post("/node/snapshot", json={"groups": [{"root_glob": "*"}]})
+    assert response.status_code == 200, response.json()
+    start_result = response.json()
+    assert start_result["progress_url"] == start_result["status_url"] + "/progress"
+
+    response = client.get(start_result["progress_url"])
+    assert response.status_code == 200, response.json()
+    assert "hashes" not in response.json()
+    progress_result = msgspec.json.decode(response.content, type=ipc.NodeResult)
+    assert progress_result.progress.finished_successfully
+
+    response = client.get(start_result["status_url"].replace("/1", "/2") + "/progress")
+    assert response.status_code == 404, response.json()
+
+
+def test_api_snapshot_result_pages(client: TestClient) -> None:
+    response = client.post("/node/lock?locker=x&ttl=10")
+    assert response.status_code == 200, response.json()
+    response = client.post("/node/snapshot", json={"groups": [{"root_glob": "*", "embedded_file_size_max": 0}]})
+    assert response.status_code == 200, response.json()
+    status_url = response.json()["status_url"]
+    full_result = msgspec.json.decode(client.get(status_url).content, type=ipc.SnapshotResult)
+    assert full_result.state is not None and full_result.hashes is not None
+    assert (len(full_result.state.files), len(full_result.hashes)) == (4, 4)
+
+    pages = []
+    cursor: int | None = 0
+    while cursor is not None:
+        response = client.get(f"{status_url}/page", params={"cursor": cursor, "limit": 3})
+        assert response.status_code == 200, response.json()
+        page = msgspec.json.decode(response.content, type=ipc.SnapshotResultPage)
+        pages.append(page)
+        cursor = page.next_cursor
+    assert [(len(page.files), len(page.hashes)) for page in pages] == [(3, 0), (1, 2), (0, 2)]
+    assert pages[0].result is not None and pages[0].result.state is not None
+    assert not pages[0].result.state.files
+    assert [f for page in pages for f in page.files] == list(full_result.state.files)
+    assert [h for page in pages for h in page.hashes] == list(full_result.hashes)
+
+    response = client.get(f"{status_url}/page", params={"limit": 0})
+    assert response.status_code == 422, response.json()
+
+
 @pytest.mark.timeout(2)
 @pytest.mark.parametrize(
     "truncate_to,hashes_in_second_snapshot",
@@ -186,3 +233,103 @@ def test_snapshot_file_size_changed(
         os.truncate(path, truncate_to)
         snapshotter.perform_snapshot(progress=Progress())
         assert len(list(snapshot.get_all_digests())) == hashes_in_second_snapshot
+
+
+@pytest.mark.parametrize("validate_file_hashes", [True, False])
+def test_upload_reads_each_file_once(
+    uploader: Uploader, storage: FileStorage, src: Path, db: Path, mocker: MockerFixture, validate_file_hashes: bool
+) -> None:
+    create_files_at_path(src, [("kept", b"kept" * 100), ("changed", b"old" * 100)])
+    snapshot, snapshotter = build_snapshot_and_snapshotter(
+        src, src, db, SQLiteSnapshot, [SnapshotGroup("**", embedded_file_size_max=0)]
+    )
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        hashes = list(snapshot.get_all_digests())
+    kept = snapshot.get_file("kept")
+    assert kept is not None
+    # Same size, modified after the snapshot
+    changed_stat = (src / "changed").stat()
+    (src / "changed").write_bytes(b"new" * 100)
+    os.utime(src / "changed", ns=(changed_stat.st_atime_ns, changed_stat.st_mtime_ns + 1_000_000_000))
+    opens = mocker.spy(utils.SizeLimitedFile, "__init__")
+    progress = Progress()
+    uploader.write_hashes_to_storage(
+        snapshot=snapshot, hashes=hashes, parallel=1, progress=progress, validate_file_hashes=validate_file_hashes
+    )
+    # When validating, the modification is noticed from the file status, without opening the file
+    assert opens.call_count == (1 if validate_file_hashes else 2)
+    if validate_file_hashes:
+        assert storage.list_hexdigests() == [kept.hexdigest]
+        assert progress.failed == 1
+    else:
+        assert len(storage.list_hexdigests()) == 2
+        assert progress.failed == 0
+
+
+def test_upload_of_file_with_changed_hash_is_not_recorded(
+    storage: FileStorage, src: Path, db: Path, tmp_path: Path, mocker: MockerFixture
+) -> None:
+    create_files_at_path(src, [("changed", b"old" * 100)])
+    snapshot, snapshotter = build_snapshot_and_snapshotter(
+        src, src, db, SQLiteSnapshot, [SnapshotGroup("**", embedded_file_size_max=0)]
+    )
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        hashes = list(snapshot.get_all_digests())
+    # Same size and modification time as in the snapshot, only the content tells
+    changed_stat = (src / "changed").stat()
+    (src / "changed").write_bytes(b"new" * 100)
+    os.utime(src / "changed", ns=(changed_stat.st_atime_ns, changed_stat.st_mtime_ns))
+    delete = mocker.patch.object(FileStorage, "delete_hexdigest", side_effect=OSError("delete failed"))
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage="fake")
+    checkpoint.start_session("session")
+    progress = Progress()
+    uploader = Uploader(storage=storage, checkpoint=checkpoint)
+    assert uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes, parallel=1, progress=progress) == (0, 0)
+    assert [call.args[0] for call in delete.call_args_list] == [hashes[0].hexdigest]
+    assert checkpoint.get_uploaded(hashes[0].hexdigest) is None
+    assert progress.failed == 1
+
+
+def test_upload_does_not_replace_or_delete_existing_objects(storage: FileStorage, src: Path, db: Path) -> None:
+    create_files_at_path(src, [("changed", b"old" * 100)])
+    snapshot, snapshotter = build_snapshot_and_snapshotter(
+        src, src, db, SQLiteSnapshot, [SnapshotGroup("**", embedded_file_size_max=0)]
+    )
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        hashes = list(snapshot.get_all_digests())
+    # Stored by an earlier backup, but missing from the hexdigests known by the coordinator
+    storage.upload_hexdigest_bytes(hashes[0].hexdigest, b"old" * 100)
+    changed_stat = (src / "changed").stat()
+    (src / "changed").write_bytes(b"new" * 100)
+    os.utime(src / "changed", ns=(changed_stat.st_atime_ns, changed_stat.st_mtime_ns))
+    progress = Progress()
+    uploader = Uploader(storage=storage)
+    assert uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes, parallel=1, progress=progress) == (0, 0)
+    assert storage.download_hexdigest_bytes(hashes[0].hexdigest) == b"old" * 100
+    assert not progress.failed
+
+
+def test_upload_skips_hexdigests_uploaded_in_checkpoint_session(
+    storage: FileStorage, src: Path, db: Path, tmp_path: Path, mocker: MockerFixture
+) -> None:
+    create_files_at_path(src, [("first", b"first" * 100), ("second", b"second" * 100)])
+    snapshot, snapshotter = build_snapshot_and_snapshotter(
+        src, src, db, SQLiteSnapshot, [SnapshotGroup("**", embedded_file_size_max=0)]
+    )
+    with snapshotter.lock:
+        snapshotter.perform_snapshot(progress=Progress())
+        hashes = list(snapshot.get_all_digests())
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.db", storage="fake")
+    checkpoint.start_session("session")
+    uploader = Uploader(storage=storage, checkpoint=checkpoint)
+    first_sizes = uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes[:1], parallel=1, progress=Progress())
+    assert first_sizes == (hashes[0].size, hashes[0].size)
+    upload = mocker.spy(FileStorage, "upload_hexdigest_from_file")
+    progress = Progress()
+    assert uploader.write_hashes_to_storage(snapshot=snapshot, hashes=hashes, parallel=1, progress=progress) == (1100, 1100)
+    assert [call.args[1] for call in upload.call_args_list] == [hashes[1].hexdigest]
+    assert progress.handled == 2
+    assert not progress.failed
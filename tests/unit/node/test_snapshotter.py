@@ -2,16 +2,20 @@
 Copyright (c) 2023 Aiven Ltd
 See LICENSE for details
 """
+from astacus.common.ipc import SnapshotFile, SnapshotHash
 from astacus.common.progress import Progress
 from astacus.common.snapshot import SnapshotGroup
-from astacus.node.snapshotter import hash_hexdigest_readable
-from astacus.node.sqlite_snapshot import SQLiteSnapshot
+from astacus.node import snapshotter as snapshotter_module
+from astacus.node.snapshotter import hash_hexdigest_and_chunks_path, hash_hexdigest_path, hash_hexdigest_readable, HashEngine
+from astacus.node.sqlite_snapshot import SQLiteSnapshot, SQLiteSnapshotter
 from io import BytesIO
 from pathlib import Path
+from pytest_mock import MockerFixture
 from tests.unit.node.conftest import build_snapshot_and_snapshotter, create_files_at_path
 from time import sleep
 
 import base64
+import os
 import pytest
 
 
@@ -134,3 +138,225 @@ def test_snapshotter_release_hash_unlinks_files_but_keeps_metadata(src: Path, ds
     assert not (dst / release).exists()
     assert (dst / keep).exists()
     assert snapshot.get_file(release) is not None
+
+
+def test_snapshot_diff(src: Path, dst: Path, db: Path) -> None:
+    create_files_at_path(src, [("same", b"same content"), ("changed", b"old content"), ("extra", b"extra")])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0)]
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, groups)
+    snapshotter.perform_snapshot(progress=Progress())
+    same = snapshot.get_file("same")
+    changed = snapshot.get_file("changed")
+    assert same is not None and changed is not None
+    target = [
+        SnapshotFile(relative_path="new", file_size=1, mtime_ns=0, hexdigest="new"),
+        # The mtime is not compared
+        SnapshotFile(relative_path="same", file_size=same.file_size, mtime_ns=0, hexdigest=same.hexdigest),
+        SnapshotFile(relative_path="changed", file_size=changed.file_size, mtime_ns=0, hexdigest="other"),
+    ]
+    with snapshot.diff(target) as diff:
+        assert list(diff.get_present_indexes()) == [1]
+        assert list(diff.get_extra_paths()) == ["extra"]
+        assert not list(diff.get_local_sources())
+    # The comparison can be done again
+    with snapshot.diff(target[:1]) as diff:
+        assert not list(diff.get_present_indexes())
+        assert sorted(diff.get_extra_paths()) == ["changed", "extra", "same"]
+    # The content of the missing files is found at other paths, but not at the paths being restored
+    moved = [
+        SnapshotFile(relative_path="moved", file_size=same.file_size, mtime_ns=0, hexdigest=same.hexdigest),
+        SnapshotFile(relative_path="extra", file_size=changed.file_size, mtime_ns=0, hexdigest=changed.hexdigest),
+        SnapshotFile(relative_path="same", file_size=changed.file_size, mtime_ns=0, hexdigest=changed.hexdigest),
+    ]
+    with snapshot.diff(moved) as diff:
+        assert [source.relative_path for source in diff.get_local_sources()] == ["changed"]
+
+
+@pytest.mark.parametrize("src_is_dst", [True, False])
+def test_persistent_snapshot_db_is_reused_without_rehashing(
+    src: Path, dst: Path, db: Path, src_is_dst: bool, mocker: MockerFixture
+) -> None:
+    if src_is_dst:
+        dst = src
+    create_files_at_path(src, [("kept", b"kept" * 100), ("changed", b"old" * 100)])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0)]
+    snapshot = SQLiteSnapshot(dst, db, persistent=True)
+    snapshotter = SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=2)
+    snapshotter.perform_snapshot(progress=Progress())
+    kept = snapshot.get_file("kept")
+    assert kept is not None
+    # Simulate a restart of the node process
+    snapshot.get_connection().close()
+    sleep(0.01)
+    create_files_at_path(src, [("changed", b"new" * 100)])
+    hash_spy = mocker.spy(snapshotter_module, "hash_hexdigest_readable")
+    snapshot = SQLiteSnapshot(dst, db, persistent=True)
+    snapshotter = SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=2)
+    assert len(snapshot) == 2
+    snapshotter.perform_snapshot(progress=Progress())
+    assert snapshot.get_file("kept") == kept
+    changed = snapshot.get_file("changed")
+    assert changed is not None
+    assert changed.hexdigest == hash_hexdigest_readable(BytesIO(b"new" * 100))
+    assert hash_spy.call_count == 1
+
+
+def test_persistent_snapshot_db_is_rebuilt_for_another_root(src: Path, dst: Path, db: Path) -> None:
+    create_files_at_path(src, [("abc", b"abc" * 100)])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0)]
+    snapshot = SQLiteSnapshot(dst, db, persistent=True)
+    SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=2).perform_snapshot(progress=Progress())
+    assert len(snapshot) == 1
+    assert isinstance(snapshot, SQLiteSnapshot)
+    snapshot.get_connection().close()
+    assert len(SQLiteSnapshot(src, db, persistent=True)) == 0
+
+
+def test_persistent_snapshot_db_is_rebuilt_when_corrupted(src: Path, dst: Path, db: Path) -> None:
+    db.write_bytes(b"this is not a sqlite database" * 1000)
+    snapshot = SQLiteSnapshot(dst, db, persistent=True)
+    assert len(snapshot) == 0
+
+
+def test_non_persistent_snapshot_db_is_recreated(src: Path, dst: Path, db: Path) -> None:
+    create_files_at_path(src, [("abc", b"abc" * 100)])
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, [SnapshotGroup("**")])
+    snapshotter.perform_snapshot(progress=Progress())
+    assert len(snapshot) == 1
+    assert isinstance(snapshot, SQLiteSnapshot)
+    snapshot.get_connection().close()
+    assert len(SQLiteSnapshot(dst, db)) == 0
+
+
+@pytest.mark.parametrize("hash_engine", list(HashEngine))
+def test_snapshotter_hash_engines_compute_the_same_digests(src: Path, dst: Path, db: Path, hash_engine: HashEngine) -> None:
+    files = [(f"file{i}", bytes([i]) * (1000 + i)) for i in range(20)] + [("embedded", b"small")]
+    create_files_at_path(src, files)
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=100)]
+    snapshot = SQLiteSnapshot(dst, db)
+    snapshotter = SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=2, hash_engine=hash_engine)
+    snapshotter.perform_snapshot(progress=Progress())
+    assert len(snapshot) == len(files)
+    for path, content in files:
+        snapshotfile = snapshot.get_file(path)
+        assert snapshotfile is not None
+        if path == "embedded":
+            assert snapshotfile.hexdigest == ""
+            assert snapshotfile.content_b64 == base64.b64encode(content).decode()
+        else:
+            assert snapshotfile.hexdigest == hash_hexdigest_readable(BytesIO(content))
+            assert snapshotfile.content_b64 is None
+
+
+@pytest.mark.parametrize("read_buffer", [1, 7, 1024, 1 << 20])
+def test_hash_hexdigest_path_reads_only_file_size_bytes(tmp_path: Path, read_buffer: int) -> None:
+    path = tmp_path / "file"
+    path.write_bytes(b"abcdefgh" * 1000)
+    expected = hash_hexdigest_readable(BytesIO((b"abcdefgh" * 1000)[:5000]))
+    assert hash_hexdigest_path(path, 5000, read_buffer=read_buffer) == expected
+
+
+def _chunk_hashes(content: bytes, chunk_size: int) -> list[SnapshotHash]:
+    return [
+        SnapshotHash(
+            hexdigest=hash_hexdigest_readable(BytesIO(content[i : i + chunk_size])), size=len(content[i : i + chunk_size])
+        )
+        for i in range(0, len(content), chunk_size)
+    ]
+
+
+@pytest.mark.parametrize("read_buffer", [1, 7, 100, 1 << 20])
+def test_hash_hexdigest_and_chunks_path(tmp_path: Path, read_buffer: int) -> None:
+    path = tmp_path / "file"
+    content = bytes(range(256)) * 10
+    path.write_bytes(content + b"ignored")
+    hexdigest, chunks = hash_hexdigest_and_chunks_path(path, len(content), 1000, read_buffer=read_buffer)
+    assert hexdigest == hash_hexdigest_readable(BytesIO(content))
+    assert chunks == _chunk_hashes(content, 1000)
+    assert [chunk.size for chunk in chunks] == [1000, 1000, 560]
+
+
+@pytest.mark.parametrize("hash_engine", list(HashEngine))
+def test_snapshotter_chunks_large_files(src: Path, dst: Path, db: Path, hash_engine: HashEngine) -> None:
+    big = bytes(i % 251 for i in range(5120))
+    create_files_at_path(src, [("big", big), ("small", b"s" * 500)])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=100, chunk_size=1024)]
+    snapshot = SQLiteSnapshot(dst, db)
+    snapshotter = SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=2, hash_engine=hash_engine)
+    snapshotter.perform_snapshot(progress=Progress())
+    bigfile = snapshot.get_file("big")
+    assert bigfile is not None
+    assert bigfile.hexdigest == hash_hexdigest_readable(BytesIO(big))
+    assert bigfile.chunks == _chunk_hashes(big, 1024)
+    smallfile = snapshot.get_file("small")
+    assert smallfile is not None
+    assert smallfile.chunks == ()
+    assert {file.relative_path: file.chunks for file in snapshot.get_all_files()} == {
+        "big": bigfile.chunks,
+        "small": (),
+    }
+    assert list(snapshot.get_files_for_digest(bigfile.hexdigest)) == [bigfile]
+    # Only the chunks of the chunked file need to be stored
+    assert sorted(snapshot.get_all_digests(), key=lambda h: h.hexdigest) == sorted(
+        [*bigfile.chunks, SnapshotHash(hexdigest=smallfile.hexdigest, size=500)], key=lambda h: h.hexdigest
+    )
+    [chunk] = snapshot.get_chunks_for_digest(bigfile.chunks[1].hexdigest)
+    assert (chunk.relative_path, chunk.offset, chunk.size) == ("big", 1024, 1024)
+    with chunk.open_for_reading(dst) as f:
+        assert f.read() == big[1024:2048]
+        # Positions are relative to the chunk, so a rereading reader stays within it
+        assert f.tell() == 1024
+        assert f.seek(0) == 0
+        assert f.read(10) == big[1024:1034]
+        assert f.seek(0, os.SEEK_END) == 1024
+        assert not f.read()
+        assert f.seek(-4, os.SEEK_END) == 1020
+        assert f.seek(2, os.SEEK_CUR) == 1022
+        assert f.read() == big[2046:2048]
+
+
+def test_snapshotter_modified_chunked_file_keeps_unchanged_chunks(src: Path, dst: Path, db: Path) -> None:
+    content = b"a" * 1024 + b"b" * 1024 + b"c" * 100
+    create_files_at_path(src, [("file", content)])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0, chunk_size=1024)]
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, groups)
+    snapshotter.perform_snapshot(progress=Progress())
+    before = snapshot.get_file("file")
+    assert before is not None
+    sleep(0.01)
+    create_files_at_path(src, [("file", content + b"d" * 2000)])
+    snapshotter.perform_snapshot(progress=Progress())
+    after = snapshot.get_file("file")
+    assert after is not None
+    assert after.chunks[:2] == before.chunks[:2]
+    assert len(after.chunks) == 5
+    assert after.hexdigest != before.hexdigest
+
+
+def test_snapshotter_rehashes_files_when_chunk_size_changes(src: Path, dst: Path, db: Path) -> None:
+    content = bytes(range(256)) * 10
+    create_files_at_path(src, [("file", content)])
+    snapshot = SQLiteSnapshot(dst, db)
+    for chunk_size, expected_chunks in [
+        (None, ()),
+        (1000, _chunk_hashes(content, 1000)),
+        (500, _chunk_hashes(content, 500)),
+    ]:
+        groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0, chunk_size=chunk_size)]
+        SQLiteSnapshotter(src=src, dst=dst, snapshot=snapshot, groups=groups, parallel=1).perform_snapshot(
+            progress=Progress()
+        )
+        snapshotfile = snapshot.get_file("file")
+        assert snapshotfile is not None
+        assert snapshotfile.chunks == expected_chunks
+
+
+def test_snapshotter_release_chunk_unlinks_chunked_file(src: Path, dst: Path, db: Path) -> None:
+    create_files_at_path(src, [("file", b"x" * 3000)])
+    groups = [SnapshotGroup(root_glob="**", embedded_file_size_max=0, chunk_size=1024)]
+    snapshot, snapshotter = build_snapshot_and_snapshotter(src, dst, db, SQLiteSnapshot, groups)
+    snapshotter.perform_snapshot(progress=Progress())
+    snapshotfile = snapshot.get_file("file")
+    assert snapshotfile is not None
+    snapshotter.release([chunk.hexdigest for chunk in snapshotfile.chunks], progress=Progress())
+    assert not (dst / "file").exists()
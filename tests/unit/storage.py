@@ -62,6 +62,9 @@ class MemoryHexDigestStorage(HexDigestStorage):
             self.download_hexdigest_to_file(hexdigest, f)
         os.rename(tempfilename, filename)
 
+    def hexdigest_exists(self, hexdigest: str) -> bool:
+        return hexdigest in self.items
+
     def list_hexdigests(self) -> list[str]:
         return list(self.items.keys())
 